@@ -0,0 +1,240 @@
+"""
+Find the largest training batch size and crop size that fit a memory budget. Every probe runs one
+synthetic forward+backward+optimizer step of the yaml model in a fresh process, and reports the peak
+memory of every component: the inputs, the resnet34 attention features, the reference histogram,
+the warpnet correlation (quadratic in the crop size), the dense unet decode, the loss, backward and
+the optimizer state.
+
+python -m benchmarks.capacity_planner --hypes_yaml hypes_yaml/config.yaml --memory_gb 8 \
+    --output hypes_yaml/config_planned.yaml
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+import torch
+import yaml
+
+from benchmarks.common import synthetic_batch, proc_status
+from hypes_yaml import yaml_utils
+from utils import helper, loss
+
+
+class MemoryTracker(object):
+    """
+    Peak memory of consecutive phases, the cuda allocator peak on gpu or the resident set high
+    water mark(linux) on cpu
+    """
+
+    def __init__(self, use_gpu):
+        self.use_gpu = use_gpu
+        # what is already resident before the step: weights, and on cpu the python/torch runtime
+        resident = torch.cuda.memory_allocated() if use_gpu else proc_status('VmRSS')
+        self.components = {'resident': resident}
+        self.peak = resident
+
+    def begin(self):
+        if self.use_gpu:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+            self.base = torch.cuda.memory_allocated()
+        else:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            self.base = proc_status('VmRSS')
+
+    def end(self, name):
+        if self.use_gpu:
+            torch.cuda.synchronize()
+            peak = torch.cuda.max_memory_allocated()
+        else:
+            peak = proc_status('VmHWM')
+        self.components[name] = max(peak - self.base, 0)
+        self.peak = max(self.peak, peak)
+
+
+def probe(hypes, batch_size, crop_size, use_gpu):
+    """
+    One training step with a synthetic batch
+    :return: dict of the total peak bytes and the peak increase of every component
+    """
+    model = helper.create_model(hypes).train()
+    att_model = helper.create_att_model(pretrained=False)
+    criterion = helper.setup_loss(hypes)
+    optimizer = helper.setup_optimizer(hypes['train_params']['solver'], model)
+    if use_gpu:
+        model.cuda()
+        att_model.cuda()
+
+    tracker = MemoryTracker(use_gpu)
+    tracker.begin()
+    input_l, input_image, ref_ab, ref_gray = synthetic_batch(batch_size, crop_size)
+    gt_ab = ref_ab.clone()
+    if use_gpu:
+        input_l, input_image, ref_ab, ref_gray, gt_ab = \
+            [x.cuda() for x in (input_l, input_image, ref_ab, ref_gray, gt_ab)]
+    tracker.end('inputs')
+
+    tracker.begin()
+    res_features = model.extract_res_features(att_model, torch.cat([input_image, ref_gray], 0))
+    tracker.end('attention')
+    tracker.begin()
+    ref_hist = model.reference_histogram(ref_ab)
+    tracker.end('histogram')
+    tracker.begin()
+    sim_feature = model.warp_net.forward_paired(ref_hist, *res_features)
+    tracker.end('warpnet')
+    tracker.begin()
+    out_dict = model.decode(input_l, sim_feature)
+    tracker.end('decode')
+    tracker.begin()
+    final_loss = loss.loss_sum(hypes, criterion, out_dict, gt_ab)
+    tracker.end('loss')
+    tracker.begin()
+    final_loss.backward()
+    tracker.end('backward')
+    tracker.begin()
+    optimizer.step()
+    tracker.end('optimizer')
+    return {'peak_bytes': tracker.peak, 'components': tracker.components}
+
+
+def run_probe(opt, batch_size, crop_size):
+    """
+    Probe in a new process, so an out of memory error or kill does not take the planner down
+    :return: probe result, None if it ran out of memory
+    """
+    result = subprocess.run([sys.executable, '-m', 'benchmarks.capacity_planner', '--probe',
+                             '--hypes_yaml', opt.hypes_yaml, '--batch_size', str(batch_size),
+                             '--crop_size', str(crop_size)] + (['--use_gpu'] if opt.use_gpu else []),
+                            capture_output=True, text=True)
+    lines = [line for line in result.stdout.splitlines() if line.startswith('PROBE')]
+    if result.returncode or not lines:
+        return None
+    return json.loads(lines[0][len('PROBE'):])
+
+
+class Planner(object):
+    """
+    Cached probes against the budget
+    """
+
+    def __init__(self, opt, budget):
+        self.opt = opt
+        self.budget = budget
+        self.results = {}
+
+    def fits(self, batch_size, crop_size):
+        key = (batch_size, crop_size)
+        if key not in self.results:
+            self.results[key] = run_probe(self.opt, batch_size, crop_size)
+            result = self.results[key]
+            print('batch %3d crop %4d: %s' % (batch_size, crop_size, 'out of memory' if result is None else
+                                              '%.0f MB' % (result['peak_bytes'] / 1024 ** 2)))
+        result = self.results[key]
+        return result is not None and result['peak_bytes'] <= self.budget
+
+    def max_batch(self, crop_size, limit):
+        """
+        Exponential then binary search of the largest batch size that fits
+        """
+        if not self.fits(1, crop_size):
+            return 0
+        low, high = 1, 2
+        while high <= limit and self.fits(high, crop_size):
+            low, high = high, high * 2
+        high = min(high, limit + 1)
+        while high - low > 1:
+            middle = (low + high) // 2
+            low, high = (middle, high) if self.fits(middle, crop_size) else (low, middle)
+        return low
+
+    def max_crop(self, batch_size, limit):
+        """
+        Binary search of the largest crop size(multiple of 32) that fits
+        """
+        low, high = 0, limit // 32 + 1
+        while high - low > 1:
+            middle = (low + high) // 2
+            low, high = (middle, high) if self.fits(batch_size, middle * 32) else (low, middle)
+        return low * 32
+
+
+def print_components(result):
+    total = result['peak_bytes'] / 1024 ** 2
+    print('%-12s %10s' % ('component', 'peak MB'))
+    for name, value in result['components'].items():
+        print('%-12s %10.1f' % (name, value / 1024 ** 2))
+    print('%-12s %10.1f' % ('total', total))
+
+
+def meminfo(key):
+    with open('/proc/meminfo') as f:
+        for line in f:
+            if line.startswith(key):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def default_budget(use_gpu):
+    if use_gpu:
+        return torch.cuda.get_device_properties(0).total_memory
+    return meminfo('MemAvailable')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="training batch/crop size capacity planner")
+    parser.add_argument('--hypes_yaml', type=str, default='hypes_yaml/config.yaml')
+    parser.add_argument('--memory_gb', type=float, default=0,
+                        help='memory budget, default is the gpu memory or the available cpu memory')
+    parser.add_argument('--margin', type=float, default=0.9,
+                        help='fraction of the budget to plan with, room for fragmentation and logging')
+    parser.add_argument('--use_gpu', action='store_true')
+    parser.add_argument('--max_batch_size', type=int, default=256)
+    parser.add_argument('--max_crop_size', type=int, default=1024)
+    parser.add_argument('--objective', type=str, default='batch', choices=['batch', 'crop'],
+                        help='batch: largest batch at the yaml crop size, crop: largest crop at the yaml batch size')
+    parser.add_argument('--output', type=str, default='',
+                        help='write a copy of the yaml with the planned batch_size/crop_size')
+    # internal, a single probe
+    parser.add_argument('--probe', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--batch_size', type=int, default=1, help=argparse.SUPPRESS)
+    parser.add_argument('--crop_size', type=int, default=256, help=argparse.SUPPRESS)
+    opt = parser.parse_args()
+
+    hypes = yaml_utils.load_yaml(opt.hypes_yaml, argparse.Namespace(model_dir=''))
+    if opt.probe:
+        try:
+            result = probe(hypes, opt.batch_size, opt.crop_size, opt.use_gpu)
+        except (MemoryError, torch.cuda.OutOfMemoryError):
+            return
+        print('PROBE' + json.dumps(result))
+        return
+
+    budget = (opt.memory_gb * 1024 ** 3 if opt.memory_gb else default_budget(opt.use_gpu)) * opt.margin
+    train_params = hypes['train_params']
+    batch_size, crop_size = train_params['batch_size'], train_params.get('crop_size', 256)
+    print('planning with %.0f MB on %s' % (budget / 1024 ** 2, 'gpu' if opt.use_gpu else 'cpu'))
+
+    planner = Planner(opt, budget)
+    if opt.objective == 'batch':
+        batch_size = planner.max_batch(crop_size, opt.max_batch_size)
+    else:
+        crop_size = planner.max_crop(batch_size, opt.max_crop_size)
+    if not batch_size or not crop_size:
+        raise ValueError('batch size %d with crop size %d does not fit in %.0f MB' %
+                         (train_params['batch_size'], train_params.get('crop_size', 256), budget / 1024 ** 2))
+
+    print('largest fit: batch size %d, crop size %d' % (batch_size, crop_size))
+    print_components(planner.results[(batch_size, crop_size)])
+
+    if opt.output:
+        train_params['batch_size'], train_params['crop_size'] = batch_size, crop_size
+        with open(opt.output, 'w') as f:
+            yaml.dump(hypes, f)
+        print('written to %s' % opt.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+Speed and quality cost of predicting ab at a lower resolution with guided upsampling, measured on
+the validation set of the yaml file. The ground truth is used as its own reference like in training.
+
+For every chroma scale it reports
+    - oracle PSNR: ground truth ab downscaled and guided-upsampled, the cost of the upsampling alone
+    - PSNR: model output vs ground truth
+    - PSNR vs full: model output vs the full resolution model output
+    - time per image
+
+python -m benchmarks.chroma_scale_benchmark --model_dir logs/your_model_folder --scales 1 2 4
+"""
+import argparse
+import time
+
+import torch
+import torch.nn.functional as F
+from torchvision import transforms
+
+from hypes_yaml import yaml_utils
+from utils import helper, inference, loss
+from utils.color_space_convert import lab_to_rgb
+from models.customized_layers import guided_upsample
+from datasets.OldPhotoDataset import OldPhotoDataset
+from datasets.customized_transform import TolABTensor
+
+
+def main():
+    parser = argparse.ArgumentParser(description="low resolution chroma benchmark")
+    parser.add_argument('--hypes_yaml', type=str, default='hypes_yaml/config.yaml',
+                        help='only used when model_dir is not given')
+    parser.add_argument('--model_dir', type=str, default='',
+                        help='trained model, random weights are used if not given(timing only)')
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--max_images', type=int, default=0, help='0 means the whole validation set')
+    opt = parser.parse_args()
+
+    hypes = yaml_utils.load_yaml(opt.hypes_yaml, opt)
+    torch.set_grad_enabled(False)
+    if opt.model_dir:
+        model, att_model, _ = inference.load_models(hypes, opt.model_dir)
+    else:
+        print('no model_dir given, the model PSNR columns are meaningless with random weights')
+        torch.manual_seed(0)
+        att_model = helper.create_att_model(pretrained=False)
+        model = helper.create_model(hypes).eval()
+
+    dataset = OldPhotoDataset(hypes['val_file'], transform=transforms.Compose([TolABTensor()]))
+    num_images = len(dataset) if opt.max_images <= 0 else min(opt.max_images, len(dataset))
+
+    results = {scale: {'oracle': 0., 'psnr': 0., 'psnr_full': 0., 'time': 0.} for scale in opt.scales}
+    for i in range(num_images):
+        data = dataset[i]
+        input_image, input_l = data['input_image'].unsqueeze(0), data['input_L'].unsqueeze(0)
+        gt_l, gt_ab = data['gt_L'].unsqueeze(0), data['gt_ab'].unsqueeze(0)
+        target = lab_to_rgb(gt_l, gt_ab)
+
+        full_output = None
+        for scale in sorted(opt.scales):
+            start_time = time.perf_counter()
+            output = inference.colorize(model, att_model, input_image, input_l, gt_ab, input_image,
+                                        chroma_scale=scale)
+            results[scale]['time'] += time.perf_counter() - start_time
+            if full_output is None:
+                full_output = output
+
+            size = inference.low_resolution_size(gt_l.shape[2], gt_l.shape[3], scale)
+            oracle_ab = guided_upsample(F.interpolate(gt_l, size=size, mode='area'),
+                                        F.interpolate(gt_ab, size=size, mode='area'), gt_l) \
+                if scale > 1 else gt_ab
+            results[scale]['oracle'] += loss.batch_psnr(lab_to_rgb(gt_l, oracle_ab), target, 1.)
+            results[scale]['psnr'] += loss.batch_psnr(output, target, 1.)
+            results[scale]['psnr_full'] += loss.batch_psnr(output, full_output, 1.)
+
+    print('%d validation images' % num_images)
+    print('%-7s %-17s %-10s %-17s %s' % ('scale', 'oracle PSNR(dB)', 'PSNR(dB)', 'PSNR vs full(dB)',
+                                         'time/image(s)'))
+    for scale in sorted(opt.scales):
+        result = {key: value / num_images for key, value in results[scale].items()}
+        print('%-7d %-17.2f %-10.2f %-17.2f %.3f' % (scale, result['oracle'], result['psnr'],
+                                                     result['psnr_full'], result['time']))
+
+
+if __name__ == '__main__':
+    main()
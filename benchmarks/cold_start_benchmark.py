@@ -0,0 +1,63 @@
+"""
+Cold start time of an inference worker: loading the colorization and attention models in a fresh
+process from the pth checkpoint versus from the memory mapped weight store(utils/weight_store.py).
+
+python -m utils.weight_store --model_dir logs/your_model_folder
+python -m benchmarks.cold_start_benchmark --model_dir logs/your_model_folder
+"""
+import argparse
+import subprocess
+import sys
+
+PTH_LOAD = '''
+from utils import helper
+att_model = helper.create_att_model(pretrained=%s)
+model = helper.create_model(hypes)
+helper.load_saved_model(model_dir, model)
+'''
+
+STORE_LOAD = '''
+from utils import helper, weight_store
+manifest = weight_store.read_manifest(model_dir)
+model = weight_store.load_module(model_dir, 'net', lambda: helper.create_model(hypes), manifest=manifest)
+att_model = weight_store.load_module(model_dir, 'att', lambda: helper.create_att_model(pretrained=False),
+                                     manifest=manifest)
+'''
+
+TEMPLATE = '''
+import argparse, time
+from hypes_yaml import yaml_utils
+model_dir = %r
+hypes = yaml_utils.load_yaml(None, argparse.Namespace(model_dir=model_dir))
+import torch, utils.helper
+start_time = time.perf_counter()
+%s
+print('COLD_START %%f' %% (time.perf_counter() - start_time))
+'''
+
+
+def cold_start(model_dir, load_code):
+    """
+    Seconds to load the models in a new python process, imports excluded
+    """
+    output = subprocess.run([sys.executable, '-c', TEMPLATE % (model_dir, load_code)],
+                            capture_output=True, text=True, check=True).stdout
+    return float([line for line in output.splitlines() if line.startswith('COLD_START')][0].split()[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="inference cold start benchmark")
+    parser.add_argument('--model_dir', type=str, required=True,
+                        help='model folder with a pth checkpoint, converted with utils.weight_store')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--offline', action='store_true',
+                        help='skip the imagenet resnet34 weights(torch hub cache) in the pth path')
+    opt = parser.parse_args()
+
+    for name, code in [('pth', PTH_LOAD % (not opt.offline)), ('weight store', STORE_LOAD)]:
+        times = [cold_start(opt.model_dir, code) for _ in range(opt.repeat)]
+        print('%-13s best %.3fs, mean %.3fs' % (name, min(times), sum(times) / len(times)))
+
+
+if __name__ == '__main__':
+    main()
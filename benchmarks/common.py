@@ -0,0 +1,76 @@
+"""
+Shared helpers for the cpu benchmarks: synthetic inputs, timing and peak memory
+"""
+import time
+
+import cv2
+import numpy as np
+import torch
+
+
+def synthetic_batch(batch_size, size):
+    """
+    Random model inputs with the same shape/range as the TolABTensor outputs
+    :return: input_l, input_image, ref_ab, ref_gray
+    """
+    input_l = torch.rand(batch_size, 1, size, size) * 2 - 1
+    input_image = torch.rand(batch_size, 1, size, size)
+    ref_ab = (torch.rand(batch_size, 2, size, size) * 2 - 1) * 0.5
+    ref_gray = torch.rand(batch_size, 1, size, size)
+    return input_l, input_image, ref_ab, ref_gray
+
+
+def add_synthetic_textures(rng):
+    """
+    Random line textures for machines without data/texture2
+    """
+    from utils.texture_libs import texture_bank
+
+    for name, count in [('texture%02d', 12), ('dust%02d', 8)]:
+        for code in range(1, count + 1):
+            texture = np.zeros((1024, 1024, 3), np.uint8)
+            for _ in range(20):
+                start, end = rng.randint(0, 1024, 2), rng.randint(0, 1024, 2)
+                cv2.line(texture, tuple(map(int, start)), tuple(map(int, end)), (255, 255, 255), 3)
+            texture_bank.add(name % code, texture)
+
+
+def time_call(func, steps, warmup=1):
+    """
+    Average seconds per call of func
+    """
+    for _ in range(warmup):
+        func()
+    start_time = time.perf_counter()
+    for _ in range(steps):
+        func()
+    return (time.perf_counter() - start_time) / steps
+
+
+def proc_status(key):
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith(key):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def peak_memory(func):
+    """
+    Peak resident memory increase in bytes while running func. On cpu it resets the linux high
+    water mark (VmHWM) through /proc/self/clear_refs, so it only works on linux.
+    :return: func output, peak bytes
+    """
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        output = func()
+        torch.cuda.synchronize()
+        return output, torch.cuda.max_memory_allocated() - base
+
+    with open('/proc/self/clear_refs', 'w') as f:
+        f.write('5')
+    base = proc_status('VmRSS')
+    output = func()
+    return output, max(proc_status('VmHWM') - base, 0)
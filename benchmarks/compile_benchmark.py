@@ -0,0 +1,98 @@
+"""
+Compare the eager and torch.compile step time of the colorization model on cpu, and make sure
+the model code stays free of graph breaks.
+
+python -m benchmarks.compile_benchmark --hypes_yaml hypes_yaml/config.yaml
+"""
+import argparse
+import time
+
+import torch
+import torch._dynamo
+
+from hypes_yaml import yaml_utils
+from utils import helper
+from benchmarks.common import synthetic_batch
+
+
+def count_graph_breaks(model, att_model, inputs):
+    """
+    Run dynamo explain on the model and return the number of graph breaks and their reasons
+    """
+    torch._dynamo.reset()
+    explanation = torch._dynamo.explain(model)(*inputs, att_model)
+    reasons = [str(reason.reason) for reason in explanation.break_reasons]
+    return explanation.graph_break_count, reasons
+
+
+def time_step(model, att_model, inputs, steps, warmup, train):
+    """
+    Average time of one forward (and backward if train) step
+    """
+    def step():
+        if train:
+            model.zero_grad()
+            out_dict = model(*inputs, att_model)
+            out_dict['output'].abs().mean().backward()
+        else:
+            with torch.no_grad():
+                model(*inputs, att_model)
+
+    for _ in range(warmup):
+        step()
+    start_time = time.perf_counter()
+    for _ in range(steps):
+        step()
+    return (time.perf_counter() - start_time) / steps
+
+
+def main():
+    parser = argparse.ArgumentParser(description="eager vs compiled benchmark")
+    parser.add_argument('--hypes_yaml', type=str, default='hypes_yaml/config.yaml')
+    parser.add_argument('--size', type=int, default=128, help='input size, must be divisible by 32')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--threads', type=int, default=0, help='torch intra-op threads, 0 keeps the default')
+    parser.add_argument('--train', action='store_true', help='time forward+backward instead of inference')
+    opt = parser.parse_args()
+    opt.model_dir = ''
+
+    if opt.threads > 0:
+        torch.set_num_threads(opt.threads)
+
+    hypes = yaml_utils.load_yaml(opt.hypes_yaml, opt)
+    hypes['compile']['flag'] = True
+
+    torch.manual_seed(0)
+    att_model = helper.create_att_model(pretrained=False)
+    model = helper.create_model(hypes)
+    model.train() if opt.train else model.eval()
+    inputs = synthetic_batch(opt.batch_size, opt.size)
+
+    graph_breaks, reasons = count_graph_breaks(model, att_model, inputs)
+    print('graph breaks: %d' % graph_breaks)
+    for reason in reasons:
+        print('\t- %s' % reason)
+
+    eager_time = time_step(model, att_model, inputs, opt.steps, opt.warmup, opt.train)
+
+    torch._dynamo.reset()
+    compiled_model = helper.compile_model(model, hypes)
+    start_time = time.perf_counter()
+    time_step(compiled_model, att_model, inputs, 1, 0, opt.train)
+    compile_time = time.perf_counter() - start_time
+    compiled_time = time_step(compiled_model, att_model, inputs, opt.steps, opt.warmup, opt.train)
+
+    print('%s step, batch %d, size %d, %d threads' % ('train' if opt.train else 'inference',
+                                                    opt.batch_size, opt.size, torch.get_num_threads()))
+    print('eager:    %.4f s/step' % eager_time)
+    print('compiled: %.4f s/step (first call incl. compilation %.2f s)' % (compiled_time, compile_time))
+    print('speedup:  %.2fx' % (eager_time / compiled_time))
+
+    if graph_breaks > 0:
+        raise SystemExit('model code is expected to be graph-break free')
+
+
+if __name__ == '__main__':
+    main()
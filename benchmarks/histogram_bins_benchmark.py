@@ -0,0 +1,93 @@
+"""
+Speed/memory vs quality trade-off of the reference histogram bin count and the optional low-rank
+histogram projection. Quality is measured as the PSNR of the ab channels decoded back from the soft
+histogram (the center of the strongest bin), i.e. how much color resolution survives the binning
+before warping. It is a proxy, compare checkpoints trained with each setting for the final PSNR.
+
+python -m benchmarks.histogram_bins_benchmark --bins 32 64 128 256 --proj fixed --proj_channels 64
+"""
+import argparse
+import copy
+import math
+
+import torch
+import torch.nn.functional as F
+
+from hypes_yaml import yaml_utils
+from utils import helper
+from benchmarks.common import synthetic_batch, time_call, peak_memory
+
+
+def smooth_ab(batch_size, size, seed=0):
+    """
+    Random low frequency ab fields in the value range of TolABTensor
+    """
+    generator = torch.Generator().manual_seed(seed)
+    ab = (torch.rand(batch_size, 2, 4, 4, generator=generator) * 2 - 1) * 0.6
+    return F.interpolate(ab, size=(size, size), mode='bicubic', align_corners=False).clamp(-1, 1)
+
+
+def histogram_psnr(model, ab):
+    """
+    PSNR(data range 2) between ab and the ab decoded from its local histogram, None if the
+    histogram goes through a learned projection that can't be inverted
+    """
+    hist_layer = model.hist_layer_local
+    hist = hist_layer(ab, ab)
+    if model.hist_proj is not None:
+        if model.hist_proj.learned:
+            return None
+        # the dct basis is orthonormal, so the transpose maps the coefficients back onto the bins
+        hist = F.conv_transpose2d(model.hist_proj(hist), model.hist_proj.weight)
+
+    batch_size, _, height, width = hist.shape
+    bins = hist_layer.bins
+    hist = hist.view(batch_size, 2, bins, height, width)
+    decoded = hist_layer.hist_layer.centers[hist.argmax(dim=2)]
+
+    mse = torch.mean((decoded - ab) ** 2).item()
+    return 10 * math.log10(4. / max(mse, 1e-12))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="histogram bins benchmark")
+    parser.add_argument('--hypes_yaml', type=str, default='hypes_yaml/config.yaml')
+    parser.add_argument('--bins', type=int, nargs='+', default=[32, 64, 128, 256])
+    parser.add_argument('--proj', type=str, default='none', help='also benchmark the none/learned/fixed projection')
+    parser.add_argument('--proj_channels', type=int, default=64)
+    parser.add_argument('--size', type=int, default=256, help='input size, must be divisible by 32')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=3)
+    opt = parser.parse_args()
+    opt.model_dir = ''
+
+    hypes = yaml_utils.load_yaml(opt.hypes_yaml, opt)
+    torch.manual_seed(0)
+    torch.set_grad_enabled(False)
+    att_model = helper.create_att_model(pretrained=False)
+    inputs = synthetic_batch(opt.batch_size, opt.size)
+    ab = smooth_ab(opt.batch_size, opt.size // 8)
+
+    settings = [(bins, 'none') for bins in opt.bins]
+    if opt.proj != 'none':
+        settings += [(bins, opt.proj) for bins in opt.bins if 2 * bins > opt.proj_channels]
+
+    print('%-6s %-9s %-11s %-12s %-10s %s' % ('bins', 'proj', 'params(M)', 'latency(ms)', 'peak(MB)',
+                                              'hist PSNR(dB)'))
+    for bins, proj in settings:
+        model_hypes = copy.deepcopy(hypes)
+        model_hypes['arch']['args'].update({'hist_bins': bins, 'hist_proj': proj,
+                                            'hist_proj_channels': opt.proj_channels})
+        model = helper.create_model(model_hypes).eval()
+
+        num_params = sum(param.numel() for param in model.parameters()) / 1e6
+        latency = time_call(lambda: model(*inputs, att_model), opt.steps)
+        _, peak = peak_memory(lambda: model(*inputs, att_model))
+        psnr = histogram_psnr(model, ab)
+
+        print('%-6d %-9s %-11.2f %-12.1f %-10.1f %s' % (bins, proj, num_params, latency * 1000, peak / 2 ** 20,
+                                                        'n/a' if psnr is None else '%.2f' % psnr))
+
+
+if __name__ == '__main__':
+    main()
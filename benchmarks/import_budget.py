@@ -0,0 +1,110 @@
+"""
+Import budget of the entry points: the inference/serving/video modules, the data generation script
+and the dataset module imported by every data loader worker. Each entry point is imported in a fresh
+interpreter, after the libraries it can not avoid(torch and torchvision), and the extra import time
+and the loaded modules are checked: none of the training-only dependencies(fastai, imgaug, lpips,
+tensorboardX, matplotlib, pandas) may be loaded, and the extra time must be within the budget.
+The exit code is 1 if any entry point is over.
+
+python -m benchmarks.import_budget
+python -m benchmarks.import_budget --entries inference data_generation --budget_scale 2
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# training-only dependencies that must stay out of the startup path
+FORBIDDEN = ('fastai', 'imgaug', 'utils.lpips_pytorch', 'tensorboardX', 'matplotlib', 'pandas', 'scipy.stats')
+
+# entry point -> (module, already required modules, budget seconds over them, forbidden modules)
+ENTRY_POINTS = {
+    'inference': ('utils.inference', ('torch', 'torchvision'), 0.5, FORBIDDEN),
+    'server': ('utils.server', ('torch', 'torchvision'), 0.5, FORBIDDEN),
+    'video': ('utils.video', ('torch', 'torchvision'), 0.5, FORBIDDEN),
+    'data_generation': ('utils.data_generation', (), 0.5, FORBIDDEN + ('torch',)),
+    'dataset': ('datasets.OldPhotoDataset', ('torch', 'torchvision'), 0.3, FORBIDDEN),
+}
+
+# runs in the fresh interpreter, prints the import time of the entry point and the new modules
+PROBE = '''
+import json, sys, time
+for name in %r:
+    __import__(name)
+before = set(sys.modules)
+start = time.perf_counter()
+__import__(%r)
+seconds = time.perf_counter() - start
+print('IMPORT' + json.dumps({'seconds': seconds, 'modules': sorted(sys.modules),
+                             'new': sorted(set(sys.modules) - before)}))
+'''
+
+
+def probe(module, required):
+    """
+    Import the module in a new interpreter
+    :return: dict of the import seconds, all loaded modules and the ones loaded by the module
+    """
+    result = subprocess.run([sys.executable, '-c', PROBE % (tuple(required), module)],
+                            capture_output=True, text=True)
+    lines = [line for line in result.stdout.splitlines() if line.startswith('IMPORT')]
+    if result.returncode or not lines:
+        raise ValueError('importing %s failed:\n%s' % (module, result.stderr))
+    return json.loads(lines[0][len('IMPORT'):])
+
+
+def slowest_imports(module, required, top=5):
+    """
+    Modules with the largest cumulative import time under the entry point, from python -X importtime
+    """
+    code = ';'.join(['import %s' % name for name in required] + ['import %s' % module])
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    times = []
+    for line in result.stderr.splitlines():
+        parts = line.split('|')
+        if len(parts) != 3 or not parts[1].strip().isdigit():
+            continue
+        if parts[2].strip() in required and parts[2] == ' ' + parts[2].strip():
+            # a top level required import is done, only what follows belongs to the entry point
+            times = []
+            continue
+        times.append((int(parts[1]), parts[2].strip()))
+    times = [(us, name) for us, name in times if name != module]
+    return sorted(times, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="import time budget of the entry points")
+    parser.add_argument('--entries', type=str, nargs='+', default=list(ENTRY_POINTS),
+                        choices=list(ENTRY_POINTS))
+    parser.add_argument('--repeats', type=int, default=3, help='the median import time is kept')
+    parser.add_argument('--budget_scale', type=float, default=1.,
+                        help='multiply the budgets, for slow machines or cold disks')
+    opt = parser.parse_args()
+
+    print('%-16s %-26s %10s %10s %8s  %s' % ('entry', 'module', 'extra s', 'budget s', 'modules', 'forbidden'))
+    failures = []
+    for entry in opt.entries:
+        module, required, budget, forbidden = ENTRY_POINTS[entry]
+        budget *= opt.budget_scale
+        results = [probe(module, required) for _ in range(opt.repeats)]
+        seconds = statistics.median(result['seconds'] for result in results)
+        loaded = [name for name in forbidden
+                  if any(m == name or m.startswith(name + '.') for m in results[0]['modules'])]
+        print('%-16s %-26s %10.3f %10.3f %8d  %s' % (entry, module, seconds, budget,
+                                                      len(results[0]['new']), ', '.join(loaded) or '-'))
+        if loaded or seconds > budget:
+            failures.append((entry, module, required))
+
+    if failures:
+        for entry, module, required in failures:
+            print('OVER BUDGET %s, slowest imports:' % entry)
+            for us, name in slowest_imports(module, required):
+                print('    %-40s %8.3f s' % (name, us / 1e6))
+        sys.exit(1)
+    print('all entry points within budget')
+
+
+if __name__ == '__main__':
+    main()
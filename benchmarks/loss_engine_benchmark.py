@@ -0,0 +1,125 @@
+"""
+Time the loss forward+backward of a training step with utils.loss.LossEngine against the previous
+per-term loop: every term called on its own, the histogram loss with the dense GaussianHistogram of
+every channel, the target re-interpolated and the color spaces converted by every intermediate term.
+
+python -m benchmarks.loss_engine_benchmark --hypes_yaml hypes_yaml/config.yaml --crop_size 256
+"""
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from benchmarks.common import time_call
+from hypes_yaml import yaml_utils
+from models import networks
+from utils import helper, loss
+from utils.color_space_convert import RgbToHsv, RgbToYuv
+
+
+def unfused_histogram(loss_func, input, target):
+    histlayer = networks.GaussianHistogram(bins=256, min=0, max=1, sigma=0.01).to(input.device)
+    losses = []
+    for i in range(input.shape[1]):
+        input_hist, _ = histlayer(torch.flatten(input[:, i, :, :], start_dim=1, end_dim=-1))
+        target_hist, _ = histlayer(torch.flatten(target[:, i, :, :], start_dim=1, end_dim=-1))
+        losses.append(loss_func.creterion(input_hist, target_hist))
+    return sum(losses)
+
+
+def unfused_term(loss_func, input, target):
+    if isinstance(loss_func, loss.HistogramLoss):
+        return unfused_histogram(loss_func, input, target)
+    return loss_func(input, target)
+
+
+def unfused_loss_sum(hypes, criterion, predict_dict, target_batch):
+    """
+    The loss sum before LossEngine, every term computes its own transforms
+    """
+    final_loss = 0
+    loss_param = hypes['train_params']['loss']
+    for name, loss_func in criterion.items():
+        if name not in loss_param:
+            continue
+        current_loss = unfused_term(loss_func, predict_dict['output'], target_batch)
+        if name == 'ssim':
+            current_loss = 1 - current_loss
+        final_loss = final_loss + loss_param[name]['weight'] * current_loss
+
+    intermediate_dict = hypes['train_params'].get('intermediate')
+    if not intermediate_dict:
+        return final_loss
+    for layer in intermediate_dict['layer']:
+        for name, loss_func in criterion.items():
+            if 'intermediate' not in name:
+                continue
+            origin_name = name.replace('intermediate_', '')
+            target = target_batch
+            if not hypes['color_pretrain']['flag']:
+                target = F.interpolate(target_batch, scale_factor=1 / hypes['arch']['args']['scale'],
+                                       mode='bicubic')
+            predict = predict_dict['aux']
+            if 'gray' in layer:
+                predict, target = predict.mean(1, keepdim=True), target.mean(1, keepdim=True)
+            elif 'hsv' in layer:
+                predict, target = RgbToHsv()(predict)[:, :2], RgbToHsv()(target)[:, :2]
+            elif 'yuv' in layer:
+                predict, target = RgbToYuv()(predict)[:, 1:], RgbToYuv()(target)[:, 1:]
+            weight = intermediate_dict['loss'][origin_name]['weight']
+            current_loss = weight * unfused_term(loss_func, predict, target)
+            if origin_name == 'ssim':
+                current_loss = weight - current_loss
+            final_loss = final_loss + current_loss
+    return final_loss
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fused loss engine benchmark")
+    parser.add_argument('--hypes_yaml', type=str, default='hypes_yaml/config.yaml')
+    parser.add_argument('--batch_size', type=int, default=0, help='default is the yaml batch size')
+    parser.add_argument('--crop_size', type=int, default=0, help='default is the yaml crop size')
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--use_gpu', action='store_true')
+    opt = parser.parse_args()
+
+    hypes = yaml_utils.load_yaml(opt.hypes_yaml, argparse.Namespace(model_dir=''))
+    hypes['train_params']['use_gpu'] = opt.use_gpu
+    batch_size = opt.batch_size or hypes['train_params']['batch_size']
+    crop_size = opt.crop_size or hypes['train_params'].get('crop_size', 256)
+    device = 'cuda' if opt.use_gpu else 'cpu'
+
+    torch.manual_seed(0)
+    channels = hypes['arch']['args']['input_channel']
+    output = (torch.rand(batch_size, channels, crop_size, crop_size, device=device) * 2 - 1).requires_grad_()
+    target = torch.rand(batch_size, channels, crop_size, crop_size, device=device) * 2 - 1
+    predict_dict = {'output': output}
+    if 'intermediate' in hypes['train_params']:
+        aux_size = crop_size // hypes['arch']['args']['scale']
+        predict_dict['aux'] = torch.rand(batch_size, 3, aux_size, aux_size, device=device, requires_grad=True)
+
+    criterion = helper.setup_loss(hypes)
+    engine = loss.LossEngine(hypes, criterion)
+
+    def step(func):
+        def run():
+            output.grad = None
+            func().backward()
+            if opt.use_gpu:
+                torch.cuda.synchronize()
+        return run
+
+    unfused = unfused_loss_sum(hypes, criterion, predict_dict, target)
+    fused, values = engine(predict_dict, target)
+    print('terms: %s' % ', '.join('%s=%.5f' % (name, value.item()) for name, value in values.items()))
+    print('loss unfused %.6f, engine %.6f' % (unfused.item(), fused.item()))
+
+    unfused_time = time_call(step(lambda: unfused_loss_sum(hypes, criterion, predict_dict, target)), opt.steps)
+    fused_time = time_call(step(lambda: engine(predict_dict, target)[0]), opt.steps)
+    print('%dx%d batch %d on %s, loss forward+backward per step:' % (crop_size, crop_size, batch_size, device))
+    print('%-10s %10.1f ms' % ('unfused', 1000 * unfused_time))
+    print('%-10s %10.1f ms  (%.2fx)' % ('engine', 1000 * fused_time, unfused_time / fused_time))
+
+
+if __name__ == '__main__':
+    main()
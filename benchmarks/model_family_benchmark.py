@@ -0,0 +1,105 @@
+"""
+Cost table of the model presets(hypes_yaml/model_presets.yaml): parameters, forward FLOPs, cpu
+latency and peak memory of one image, the shared resnet34 attention model included in the time,
+memory and FLOPs, but not in the parameters. Every preset runs in a fresh process, so the memory
+freed by the previous one does not hide its peak.
+
+python -m benchmarks.model_family_benchmark --presets large medium small tiny student --size 256
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+import torch
+import yaml
+from torch.utils.flop_counter import FlopCounterMode
+
+from benchmarks.common import synthetic_batch, time_call, peak_memory
+from hypes_yaml import yaml_utils
+from utils import helper
+
+
+def preset_hypes(hypes, preset):
+    """
+    Training yaml with the arch of the preset
+    """
+    hypes = dict(hypes)
+    args = dict(hypes['arch']['args'])
+    args.update(preset['args'] or {})
+    hypes['arch'] = {'backbone': preset['backbone'], 'args': args}
+    return hypes
+
+
+def measure(model, att_model, batch, steps):
+    """
+    :return: dict of params(M), gflops, latency(ms) and peak memory(MB)
+    """
+    forward = lambda: model(*batch, att_model)
+    with torch.no_grad():
+        # first call, before any other pass leaves freed memory behind
+        _, peak = peak_memory(forward)
+        with FlopCounterMode(display=False) as counter:
+            forward()
+        latency = time_call(forward, steps)
+    return {'params_m': sum(p.numel() for p in model.parameters()) / 1e6,
+            'gflops': counter.get_total_flops() / 1e9,
+            'latency_ms': latency * 1000,
+            'peak_memory_mb': peak / 1024 ** 2}
+
+
+def run_preset(opt, name):
+    """
+    Measure a preset in a new process
+    """
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.model_family_benchmark', '--worker', name,
+                             '--hypes_yaml', opt.hypes_yaml, '--presets_yaml', opt.presets_yaml,
+                             '--size', str(opt.size), '--steps', str(opt.steps)],
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads([line for line in output.splitlines() if line.startswith('RESULT')][0][len('RESULT'):])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="model family cost table")
+    parser.add_argument('--hypes_yaml', type=str, default='hypes_yaml/config.yaml')
+    parser.add_argument('--presets_yaml', type=str, default='hypes_yaml/model_presets.yaml')
+    parser.add_argument('--presets', type=str, nargs='+', default=[], help='default is all the presets')
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--output', type=str, default='', help='also write the table as json')
+    # internal, measure a single preset
+    parser.add_argument('--worker', type=str, default='', help=argparse.SUPPRESS)
+    opt = parser.parse_args()
+
+    with open(opt.presets_yaml) as f:
+        presets = yaml.safe_load(f)
+
+    if opt.worker:
+        hypes = yaml_utils.load_yaml(opt.hypes_yaml, argparse.Namespace(model_dir=''))
+        torch.manual_seed(0)
+        att_model = helper.create_att_model(pretrained=False)
+        model = helper.create_model(preset_hypes(hypes, presets[opt.worker])).eval()
+        print('RESULT' + json.dumps(measure(model, att_model, synthetic_batch(1, opt.size), opt.steps)))
+        return
+
+    names = opt.presets or list(presets)
+    for name in names:
+        if name not in presets:
+            raise ValueError('preset %s not found in %s' % (name, opt.presets_yaml))
+
+    print('%dx%d input, batch size 1' % (opt.size, opt.size))
+    print('| preset | params (M) | GFLOPs | latency (ms) | peak memory (MB) |')
+    print('|---|---|---|---|---|')
+    results = {}
+    for name in names:
+        results[name] = run_preset(opt, name)
+        print('| %s | %.2f | %.1f | %.0f | %.0f |' % (name, results[name]['params_m'], results[name]['gflops'],
+                                                    results[name]['latency_ms'], results[name]['peak_memory_mb']))
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Time to a target validation PSNR of the fixed crop size training against the progressive resolution
+schedule(train_params: progressive). Both schedules train the same model from the same seed on the
+same number of samples per epoch, with the training loss of train_nogan, and the PSNR is measured
+after every epoch on held out batches at the full crop size. The target is the final PSNR of the
+fixed schedule unless --target_psnr is given.
+
+python -m benchmarks.progressive_benchmark --hypes_yaml hypes_yaml/config.yaml --preset student \
+    --epochs 6 --samples_per_epoch 64 --stages 0:128 2:192 4:256
+"""
+import argparse
+import copy
+import time
+
+import torch
+import yaml
+
+from benchmarks.model_family_benchmark import preset_hypes
+from hypes_yaml import yaml_utils
+from utils import feature_pool, helper, loss
+from utils.color_space_convert import lab_to_rgb
+
+BATCH_KEYS = ('input_image', 'input_L', 'gt_ab', 'gt_L', 'ref_gray', 'ref_ab')
+
+
+def to_device(batch_data, device):
+    return [batch_data[key].to(device) for key in BATCH_KEYS]
+
+
+def evaluate(model, att_model, batches, device):
+    """
+    :return: mean PSNR of the rgb outputs
+    """
+    model.eval()
+    psnr = 0
+    with torch.no_grad():
+        for batch_data in batches:
+            input_batch, input_l, gt_ab, gt_l, ref_gray, ref_ab = to_device(batch_data, device)
+            output = torch.clamp(model(input_l, input_batch, ref_ab, ref_gray, att_model)['output'], -1., 1.)
+            psnr += loss.batch_psnr(lab_to_rgb(input_l, output), lab_to_rgb(gt_l, gt_ab), 1.)
+    return psnr / len(batches)
+
+
+def train_schedule(hypes, att_model, eval_batches, opt, device):
+    """
+    Train a new model with the schedule of the hypes
+    :return: list of (training seconds, PSNR) after every epoch
+    """
+    torch.manual_seed(0)
+    model = helper.create_model(hypes).to(device)
+    optimizer = helper.setup_optimizer(hypes['train_params']['solver'], model)
+    loss_engine = loss.LossEngine(hypes, helper.setup_loss(hypes))
+
+    history = []
+    seconds = 0.
+    stage = None
+    for epoch in range(opt.epochs):
+        stage_index, crop_size, batch_size = helper.progressive_stage(hypes, epoch)
+        if stage_index != stage:
+            stage = stage_index
+            loader_train, _ = helper.create_dataset(hypes, train=True, epoch=epoch)
+        if hasattr(loader_train.dataset, 'set_epoch'):
+            loader_train.dataset.set_epoch(epoch)
+
+        model.train()
+        samples = 0
+        start = time.perf_counter()
+        for batch_data in loader_train:
+            input_batch, input_l, gt_ab, _, ref_gray, ref_ab = to_device(batch_data, device)
+            optimizer.zero_grad()
+            out_dict = model(input_l, input_batch, ref_ab, ref_gray, att_model)
+            final_loss, _ = loss_engine(out_dict, gt_ab)
+            final_loss.backward()
+            optimizer.step()
+            samples += len(input_l)
+            if samples >= opt.samples_per_epoch:
+                break
+        if device == 'cuda':
+            torch.cuda.synchronize()
+        seconds += time.perf_counter() - start
+
+        psnr = evaluate(model, att_model, eval_batches, device)
+        history.append((seconds, psnr))
+        print('    epoch %d crop %d batch %d: %.1fs, PSNR %.3f' % (epoch, crop_size, batch_size, seconds, psnr))
+    return history
+
+
+def time_to_target(history, target):
+    return next((seconds for seconds, psnr in history if psnr >= target), None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="fixed against progressive resolution training")
+    parser.add_argument('--hypes_yaml', type=str, default='hypes_yaml/config.yaml')
+    parser.add_argument('--presets_yaml', type=str, default='hypes_yaml/model_presets.yaml')
+    parser.add_argument('--preset', type=str, default='', help='train a preset arch instead of the yaml one')
+    parser.add_argument('--epochs', type=int, default=6)
+    parser.add_argument('--samples_per_epoch', type=int, default=64)
+    parser.add_argument('--stages', type=str, nargs='+', default=[],
+                        help='epoch:crop_size of every stage, default is train_params: progressive: stages')
+    parser.add_argument('--eval_batches', type=int, default=4)
+    parser.add_argument('--target_psnr', type=float, default=0., help='default is the final fixed PSNR')
+    parser.add_argument('--use_gpu', action='store_true')
+    opt = parser.parse_args()
+
+    hypes = yaml_utils.load_yaml(opt.hypes_yaml, argparse.Namespace(model_dir=''))
+    if opt.preset:
+        with open(opt.presets_yaml) as f:
+            hypes = preset_hypes(hypes, yaml.safe_load(f)[opt.preset])
+    hypes['train_params']['use_gpu'] = opt.use_gpu
+    device = 'cuda' if opt.use_gpu else 'cpu'
+    att_model = feature_pool.get('resnet34_attention', device)
+
+    fixed = copy.deepcopy(hypes)
+    fixed['train_params']['progressive'] = {'flag': False}
+    progressive = copy.deepcopy(hypes)
+    progressive_params = dict(hypes['train_params'].get('progressive') or {}, flag=True)
+    if opt.stages:
+        progressive_params['stages'] = [{'epoch': int(epoch), 'crop_size': int(crop_size)}
+                                        for epoch, crop_size in (stage.split(':') for stage in opt.stages)]
+    if not progressive_params.get('stages'):
+        raise ValueError('no progressive stages in the yaml, set them with --stages')
+    progressive['train_params']['progressive'] = progressive_params
+
+    # held out batches at the full crop size, from the same data stream
+    torch.manual_seed(1)
+    loader_eval, _ = helper.create_dataset(fixed, train=True)
+    eval_batches = []
+    for batch_data in loader_eval:
+        eval_batches.append(batch_data)
+        if len(eval_batches) == opt.eval_batches:
+            break
+
+    results = {}
+    for name, schedule_hypes in [('fixed', fixed), ('progressive', progressive)]:
+        print('%s schedule' % name)
+        results[name] = train_schedule(schedule_hypes, att_model, eval_batches, opt, device)
+
+    target = opt.target_psnr or results['fixed'][-1][1]
+    print('time to PSNR %.3f:' % target)
+    for name, history in results.items():
+        seconds = time_to_target(history, target)
+        print('%-12s %10s  (final PSNR %.3f after %.1fs)' % (name, '%.1fs' % seconds if seconds is not None else 'not reached',
+                                                              history[-1][1], history[-1][0]))
+
+
+if __name__ == '__main__':
+    main()
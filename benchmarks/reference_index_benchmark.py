@@ -0,0 +1,59 @@
+"""
+Recall and query latency of the IVF-PQ reference index against exact search, on synthetic clustered
+unit length embeddings of the same size as the attention features(768).
+
+python -m benchmarks.reference_index_benchmark --size 100000 --nprobe 8 16 32
+"""
+import argparse
+import time
+
+import numpy as np
+
+from utils.reference_index import ReferenceIndex
+
+
+def synthetic_embeddings(size, dim=768, clusters=1000, seed=0):
+    """
+    Unit length embeddings drawn around random cluster centers, like photos of similar scenes
+    """
+    rng = np.random.RandomState(seed)
+    centers = rng.randn(clusters, dim).astype(np.float32)
+    x = centers[rng.randint(clusters, size=size)] + 0.5 * rng.randn(size, dim).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="reference index benchmark")
+    parser.add_argument('--size', type=int, default=50000, help='library size')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--nlist', type=int, default=256)
+    parser.add_argument('--pq_m', type=int, default=48)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[4, 16, 64])
+    opt = parser.parse_args()
+
+    embeddings = synthetic_embeddings(opt.size + opt.queries)
+    library, queries = embeddings[:opt.size], embeddings[opt.size:]
+    image_paths = ['%d.jpg' % i for i in range(opt.size)]
+
+    exact = ReferenceIndex(image_paths, library, 'exact')
+    start_time = time.perf_counter()
+    _, exact_ids = exact.search(queries, opt.k)
+    exact_time = (time.perf_counter() - start_time) / opt.queries
+
+    start_time = time.perf_counter()
+    ivfpq = ReferenceIndex(image_paths, library, 'ivfpq', opt.nlist, opt.pq_m)
+    print('%d embeddings, ivfpq trained in %.1fs, %d bytes per image instead of %d' %
+          (opt.size, time.perf_counter() - start_time, opt.pq_m, library.shape[1] * 4))
+    print('%-8s %-12s %s' % ('nprobe', 'recall@%d' % opt.k, 'ms/query'))
+    print('%-8s %-12.3f %.2f' % ('exact', 1., 1000 * exact_time))
+    for nprobe in opt.nprobe:
+        start_time = time.perf_counter()
+        _, ids = ivfpq.search(queries, opt.k, nprobe)
+        query_time = (time.perf_counter() - start_time) / opt.queries
+        recall = np.mean([len(set(a) & set(b)) / float(opt.k) for a, b in zip(ids, exact_ids)])
+        print('%-8d %-12.3f %.2f' % (nprobe, recall, 1000 * query_time))
+
+
+if __name__ == '__main__':
+    main()
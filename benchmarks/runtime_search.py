@@ -0,0 +1,121 @@
+"""
+Search the cpu runtime settings(utils/runtime.py) of a machine: number of inference processes,
+intra/inter op threads, channels last and oneDNN. Every candidate runs its processes at the same
+time, pinned to their own cores, and the total images per second decide. The best candidate is
+written as a runtime yaml for test.py/serve.py/video.py --runtime_yaml.
+
+python -m benchmarks.runtime_search --size 256 --output logs/runtime.yaml
+"""
+import argparse
+import itertools
+import os
+import subprocess
+import sys
+
+import yaml
+
+from utils.runtime import DEFAULT_RUNTIME
+
+
+def run_worker(opt):
+    """
+    One process of a candidate, prints its images per second
+    """
+    import torch
+
+    from benchmarks.common import synthetic_batch, time_call
+    from hypes_yaml import yaml_utils
+    from utils import helper, runtime
+
+    params = yaml.safe_load(opt.runtime)
+    runtime.apply_runtime(params, opt.process_index)
+    hypes = yaml_utils.load_yaml(opt.hypes_yaml, argparse.Namespace(model_dir=''))
+    model = helper.create_model(hypes).eval()
+    att_model = helper.create_att_model(pretrained=False).eval()
+    model, att_model, _ = runtime.prepare_models(params, model, att_model)
+
+    input_l, input_image, ref_ab, ref_gray = [runtime.to_memory_format(model, x)
+                                              for x in synthetic_batch(opt.batch_size, opt.size)]
+    with torch.no_grad():
+        seconds = time_call(lambda: model(input_l, input_image, ref_ab, ref_gray, att_model), opt.steps)
+    print('THROUGHPUT %f' % (opt.batch_size / seconds))
+
+
+def run_candidate(opt, params):
+    """
+    Start the processes of a candidate together
+    :return: summed images per second
+    """
+    workers = [subprocess.Popen([sys.executable, '-m', 'benchmarks.runtime_search', '--worker',
+                                 '--runtime', yaml.safe_dump(params), '--process_index', str(i),
+                                 '--hypes_yaml', opt.hypes_yaml, '--size', str(opt.size),
+                                 '--batch_size', str(opt.batch_size), '--steps', str(opt.steps)],
+                                stdout=subprocess.PIPE, text=True)
+               for i in range(params['processes'])]
+    throughput = 0.
+    for worker in workers:
+        output, _ = worker.communicate()
+        if worker.returncode:
+            raise ValueError('worker failed with %s' % params)
+        throughput += float([line for line in output.splitlines() if line.startswith('THROUGHPUT')][0].split()[1])
+    return throughput
+
+
+def candidates(opt, cores):
+    for processes in opt.processes:
+        if processes > cores:
+            continue
+        intra_threads = opt.intra_threads or [cores // processes]
+        for intra, inter, channels_last, mkldnn in itertools.product(intra_threads, opt.inter_threads,
+                                                                     opt.channels_last, opt.mkldnn):
+            params = dict(DEFAULT_RUNTIME)
+            params.update({'processes': processes, 'intra_op_threads': intra, 'inter_op_threads': inter,
+                           'pin_cores': processes > 1, 'channels_last': bool(channels_last),
+                           'mkldnn': bool(mkldnn), 'warmup_size': opt.size})
+            yield params
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cpu runtime settings search")
+    parser.add_argument('--hypes_yaml', type=str, default='hypes_yaml/config.yaml')
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=3)
+    parser.add_argument('--processes', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--intra_threads', type=int, nargs='+', default=[],
+                        help='default is all the cores of a process')
+    parser.add_argument('--inter_threads', type=int, nargs='+', default=[0])
+    parser.add_argument('--channels_last', type=int, nargs='+', default=[0, 1])
+    parser.add_argument('--mkldnn', type=int, nargs='+', default=[1, 0])
+    parser.add_argument('--output', type=str, default='', help='write the best settings to this yaml')
+    # internal, a single process of a candidate
+    parser.add_argument('--worker', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--runtime', type=str, help=argparse.SUPPRESS)
+    parser.add_argument('--process_index', type=int, default=0, help=argparse.SUPPRESS)
+    opt = parser.parse_args()
+
+    if opt.worker:
+        run_worker(opt)
+        return
+
+    cores = len(os.sched_getaffinity(0))
+    print('%d cores, %dx%d images, batch size %d' % (cores, opt.size, opt.size, opt.batch_size))
+    print('%-9s %-6s %-6s %-13s %-6s %s' % ('processes', 'intra', 'inter', 'channels_last', 'mkldnn', 'images/s'))
+    results = []
+    for params in candidates(opt, cores):
+        throughput = run_candidate(opt, params)
+        results.append((throughput, params))
+        print('%-9d %-6d %-6d %-13s %-6s %.3f' % (params['processes'], params['intra_op_threads'],
+                                                  params['inter_op_threads'], params['channels_last'],
+                                                  params['mkldnn'], throughput))
+
+    throughput, best = max(results, key=lambda x: x[0])
+    print('best: %.3f images/s with %s' % (throughput, best))
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            yaml.safe_dump({'runtime': best}, f, default_flow_style=False)
+        print('written to %s' % opt.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Load generator for the local inference server (serve.py). It keeps --concurrency requests in flight,
+then prints the client side latency/throughput and the server side batching statistics.
+
+python serve.py --model_dir logs/your_model_folder --max_batch_size 8 --max_wait_ms 10
+python -m benchmarks.server_load --concurrency 8 --requests 64 --size 256
+"""
+import argparse
+import base64
+import json
+import threading
+import time
+import urllib.request
+
+import cv2
+import numpy as np
+
+from utils.server import percentile
+
+
+def encode_image(image):
+    _, buffer = cv2.imencode('.png', image)
+    return base64.b64encode(buffer.tobytes()).decode('ascii')
+
+
+def request_body(opt):
+    """
+    Request with the given image pair, or with random images of --size
+    """
+    if opt.input_path and opt.ref_path:
+        input_image, ref_image = cv2.imread(opt.input_path, 0), cv2.imread(opt.ref_path)
+    else:
+        rng = np.random.RandomState(0)
+        input_image = rng.randint(0, 256, (opt.size, opt.size), dtype=np.uint8)
+        ref_image = rng.randint(0, 256, (opt.size, opt.size, 3), dtype=np.uint8)
+    return json.dumps({'input': encode_image(input_image),
+                       'reference': encode_image(ref_image)}).encode()
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="inference server load generator")
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000')
+    parser.add_argument('--input_path', type=str, default='')
+    parser.add_argument('--ref_path', type=str, default='')
+    parser.add_argument('--size', type=int, default=256, help='random image size without input_path')
+    parser.add_argument('--concurrency', type=int, default=8, help='requests in flight')
+    parser.add_argument('--requests', type=int, default=64, help='total number of requests')
+    opt = parser.parse_args()
+
+    body = request_body(opt)
+    # warm up the server
+    post(opt.url + '/colorize', body)
+
+    latencies, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(opt.requests))
+
+    def client():
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start_time = time.perf_counter()
+            try:
+                post(opt.url + '/colorize', body)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+                continue
+            with lock:
+                latencies.append(time.perf_counter() - start_time)
+
+    start_time = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(opt.concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - start_time
+
+    print('%d requests, %d errors, concurrency %d' % (opt.requests, len(errors), opt.concurrency))
+    print('throughput %.2f images/s' % (len(latencies) / elapsed))
+    print('latency p50 %.1f ms, p95 %.1f ms, p99 %.1f ms' % tuple(1000 * percentile(latencies, q)
+                                                               for q in (50, 95, 99)))
+    with urllib.request.urlopen(opt.url + '/stats') as response:
+        print('server stats %s' % json.dumps(json.loads(response.read()), indent=2))
+
+
+if __name__ == '__main__':
+    main()
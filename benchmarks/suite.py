@@ -0,0 +1,226 @@
+"""
+Cpu benchmark suite of the hot paths with synthetic inputs: histogram layers, warpnet, the full model
+forward+backward at several resolutions, color conversion, the training transforms/degradations and
+the dataset loader. Results are written as json and compared with a saved baseline, every case
+slower than the baseline by more than the threshold is flagged and the exit code is 1.
+
+python -m benchmarks.suite --output logs/benchmark_baseline.json
+python -m benchmarks.suite --baseline logs/benchmark_baseline.json --threshold 0.1
+"""
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from torchvision import transforms
+
+from benchmarks.common import synthetic_batch, time_call, add_synthetic_textures
+from hypes_yaml import yaml_utils
+from utils import helper
+from utils.color_space_convert import lab_to_rgb
+from utils.damage_libs import damage_generate
+from utils.texture_libs import crack_generate, dust_generate, texture_bank
+from models.networks import GaussianHistogram
+from models.warpnet import WarpNet
+from models.dense121_unet_histogram_attention import HistogramLayerLocal
+from datasets.OldPhotoDataset import OldPhotoDataset
+from datasets.customized_transform import RandomCropWindow, TolABTensor
+
+
+def synthetic_image(rng, height, width):
+    """
+    Smooth random rgb uint8 image, closer to a photo than white noise
+    """
+    return cv2.GaussianBlur(rng.randint(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 3)
+
+
+def gaussian_histogram_case(opt, rng):
+    layer = GaussianHistogram(bins=256, min=-1., max=1., sigma=0.01)
+    x = torch.rand(2, 32 * 32) * 2 - 1
+    return lambda: layer(x)
+
+
+def histogram_layer_local_case(opt, rng):
+    layer = HistogramLayerLocal()
+    ref = torch.rand(2, 2, 32, 32) * 2 - 1
+    return lambda: layer(ref, ref)
+
+
+def warpnet_forward_case(opt, rng):
+    warp_net = WarpNet().eval()
+    size = 256
+    features = [torch.randn(1, channel, size // scale, size // scale)
+                for channel, scale in ((64, 4), (128, 8), (256, 16), (512, 32))]
+    hist = torch.rand(1, 512, size // 8, size // 8)
+
+    def run():
+        with torch.no_grad():
+            warp_net(hist, *features, *features)
+    return run
+
+
+def model_train_step_case(size):
+    def setup(opt, rng):
+        hypes = yaml_utils.load_yaml(opt.hypes_yaml, argparse.Namespace(model_dir=''))
+        model = helper.create_model(hypes).train()
+        att_model = helper.create_att_model(pretrained=False)
+        batch = synthetic_batch(opt.batch_size, size)
+
+        def run():
+            model.zero_grad()
+            model(*batch, att_model)['output'].abs().mean().backward()
+        return run
+    return setup
+
+
+def lab_to_rgb_case(opt, rng):
+    input_l, _, ab, _ = synthetic_batch(opt.batch_size, 256)
+    return lambda: lab_to_rgb(input_l, ab)
+
+
+def tolab_tensor_case(opt, rng):
+    transform = TolABTensor()
+    gt_image = synthetic_image(rng, 256, 256)
+    sample = {'input_image': np.expand_dims(cv2.cvtColor(gt_image, cv2.COLOR_RGB2GRAY), -1),
+              'gt_image': gt_image, 'ref_image': gt_image}
+    return lambda: transform(dict(sample))
+
+
+def crack_generate_case(opt, rng):
+    image = cv2.cvtColor(synthetic_image(rng, 256, 256), cv2.COLOR_RGB2BGR)
+    return lambda: crack_generate(image.copy(), random.randint(1, 12))
+
+
+def dust_generate_case(opt, rng):
+    image = cv2.cvtColor(synthetic_image(rng, 256, 256), cv2.COLOR_RGB2BGR)
+    return lambda: dust_generate(image.copy(), random.randint(1, 8))
+
+
+def damage_generate_case(opt, rng):
+    image = synthetic_image(rng, 256, 256)
+    return lambda: damage_generate(image.copy(), threash=20)
+
+
+def old_photo_loader_case(opt, rng):
+    """
+    One epoch of the color training pipeline over 8 jpg images of 320x400
+    """
+    folder = tempfile.mkdtemp(prefix='benchmark_images_')
+    for i in range(8):
+        cv2.imwrite(os.path.join(folder, '%02d.jpg' % i), synthetic_image(rng, 320, 400))
+    dataset = OldPhotoDataset([folder], transform=transforms.Compose([RandomCropWindow(256), TolABTensor()]))
+    loader = DataLoader(dataset, batch_size=opt.batch_size, shuffle=True, num_workers=0)
+
+    def run():
+        for _ in loader:
+            pass
+    run.cleanup = lambda: shutil.rmtree(folder)
+    return run
+
+
+def benchmark_cases(sizes):
+    """
+    :return: list of (name, setup function), the setup returns the callable to time
+    """
+    cases = [('gaussian_histogram', gaussian_histogram_case),
+             ('histogram_layer_local', histogram_layer_local_case),
+             ('warpnet_forward', warpnet_forward_case)]
+    cases += [('model_train_step_%d' % size, model_train_step_case(size)) for size in sizes]
+    cases += [('lab_to_rgb', lab_to_rgb_case),
+              ('tolab_tensor', tolab_tensor_case),
+              ('crack_generate', crack_generate_case),
+              ('dust_generate', dust_generate_case),
+              ('damage_generate', damage_generate_case),
+              ('old_photo_loader', old_photo_loader_case)]
+    return cases
+
+
+def environment():
+    return {'python': platform.python_version(),
+            'torch': torch.__version__,
+            'threads': torch.get_num_threads(),
+            'cores': len(os.sched_getaffinity(0)),
+            'processor': platform.processor() or platform.machine()}
+
+
+def compare(results, baseline, threshold):
+    """
+    :return: dict of case name to relative change vs the baseline, and the regressed case names
+    """
+    changes, regressions = {}, []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        changes[name] = result['ms'] / baseline[name]['ms'] - 1
+        if changes[name] > threshold:
+            regressions.append(name)
+    return changes, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="cpu benchmark suite")
+    parser.add_argument('--hypes_yaml', type=str, default='hypes_yaml/config.yaml')
+    parser.add_argument('--cases', type=str, nargs='+', default=['*'], help='glob patterns of case names')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256],
+                        help='resolutions of the model forward+backward')
+    parser.add_argument('--batch_size', type=int, default=2)
+    parser.add_argument('--steps', type=int, default=3, help='calls per repeat')
+    parser.add_argument('--repeats', type=int, default=3, help='the fastest repeat is kept')
+    parser.add_argument('--output', type=str, default='', help='write the results json, e.g. a new baseline')
+    parser.add_argument('--baseline', type=str, default='', help='results json to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='flag cases slower by more than this')
+    opt = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    random.seed(0)
+    torch.manual_seed(0)
+    if not os.path.exists(os.path.join(texture_bank.texture_dir, 'texture01.jpg')):
+        print('data/texture2 not found, using synthetic textures')
+        add_synthetic_textures(rng)
+
+    baseline = {}
+    if opt.baseline:
+        with open(opt.baseline) as f:
+            baseline = json.load(f)['results']
+
+    print('%-24s %12s %12s %12s' % ('case', 'ms', 'median ms', 'vs baseline'))
+    results = {}
+    for name, setup in benchmark_cases(opt.sizes):
+        if not any(fnmatch.fnmatch(name, pattern) for pattern in opt.cases):
+            continue
+        func = setup(opt, rng)
+        times = [1000 * time_call(func, opt.steps, warmup=1 if i == 0 else 0) for i in range(opt.repeats)]
+        if hasattr(func, 'cleanup'):
+            func.cleanup()
+        results[name] = {'ms': min(times), 'median_ms': statistics.median(times)}
+
+        change = ''
+        if name in baseline:
+            change = '%+.1f%%' % (100 * (results[name]['ms'] / baseline[name]['ms'] - 1))
+        print('%-24s %12.2f %12.2f %12s' % (name, results[name]['ms'], results[name]['median_ms'], change))
+
+    if opt.output:
+        with open(opt.output, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f, indent=2)
+        print('results written to %s' % opt.output)
+
+    if baseline:
+        _, regressions = compare(results, baseline, opt.threshold)
+        if regressions:
+            print('REGRESSION over %.0f%%: %s' % (100 * opt.threshold, ', '.join(regressions)))
+            sys.exit(1)
+        print('no regression over %.0f%%' % (100 * opt.threshold))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+"""
+Per sample cpu time of the crack net training transforms: the full resolution chain
+(RandomBlur -> CrackGenerator -> RandomCrop -> TolABTensor) versus the crop-first chain
+(RandomCropWindow -> RandomBlur -> CrackGenerator -> CropPadding -> TolABTensor), for several
+source resolutions.
+
+python -m benchmarks.transform_benchmark --sizes 512 1024 2048 4096
+"""
+import argparse
+import os
+
+import cv2
+import numpy as np
+from torchvision import transforms
+
+from benchmarks.common import time_call, add_synthetic_textures
+from datasets.customized_transform import RandomBlur, CrackGenerator, RandomCrop, RandomCropWindow, \
+    CropPadding, TolABTensor
+from utils.texture_libs import texture_bank
+
+
+def main():
+    parser = argparse.ArgumentParser(description="training transform benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[512, 1024, 2048])
+    parser.add_argument('--steps', type=int, default=5)
+    opt = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    if not os.path.exists(os.path.join(texture_bank.texture_dir, 'texture01.jpg')):
+        print('data/texture2 not found, using synthetic textures')
+        add_synthetic_textures(rng)
+
+    full_chain = transforms.Compose([RandomBlur(), CrackGenerator(), RandomCrop(256), TolABTensor()])
+    crop_first_chain = transforms.Compose([RandomCropWindow(256, pad=16, upscale_later=True), RandomBlur(),
+                                           CrackGenerator(), CropPadding(), TolABTensor()])
+
+    print('%-7s %-17s %-17s %s' % ('size', 'full chain(ms)', 'crop first(ms)', 'speedup'))
+    for size in opt.sizes:
+        gt_image = cv2.GaussianBlur(rng.randint(0, 256, (size, size * 4 // 3, 3), dtype=np.uint8), (0, 0), 3)
+        input_image = np.expand_dims(cv2.cvtColor(gt_image, cv2.COLOR_RGB2GRAY), -1)
+
+        def sample():
+            return {'input_image': input_image.copy(), 'gt_image': gt_image.copy()}
+
+        full_time = time_call(lambda: full_chain(sample()), opt.steps)
+        crop_first_time = time_call(lambda: crop_first_chain(sample()), opt.steps)
+        print('%-7d %-17.1f %-17.1f %.1fx' % (size, 1000 * full_time, 1000 * crop_first_time,
+                                              full_time / crop_first_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""
+Time to turn a video into training frames: video2frame jpg dump plus re-reading the jpgs versus
+streaming the frames straight from the decoder(texture_libs.iter_video_frames).
+
+python -m benchmarks.video_ingest_benchmark --video film.mp4 --every_n 5
+"""
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import cv2
+
+from utils.texture_libs import iter_video_frames, video2frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description="video ingestion benchmark")
+    parser.add_argument('--video', type=str, required=True)
+    parser.add_argument('--every_n', type=int, default=1)
+    parser.add_argument('--scene_threshold', type=float, default=0.)
+    opt = parser.parse_args()
+
+    output_folder = tempfile.mkdtemp()
+    try:
+        start_time = time.perf_counter()
+        video2frame(opt.video, output_folder + os.sep, opt.every_n, opt.scene_threshold)
+        frames = [cv2.imread(path) for path in sorted(glob.glob(os.path.join(output_folder, '*.jpg')))]
+        dump_time = time.perf_counter() - start_time
+    finally:
+        shutil.rmtree(output_folder)
+
+    start_time = time.perf_counter()
+    streamed = sum(1 for _ in iter_video_frames(opt.video, opt.every_n, opt.scene_threshold))
+    stream_time = time.perf_counter() - start_time
+
+    print('jpg dump + read %d frames in %.2fs' % (len(frames), dump_time))
+    print('streamed        %d frames in %.2fs' % (streamed, stream_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""
+Per-call latency of WarpNet with the input/reference branches run separately (the old behaviour)
+and as one paired batch.
+
+python -m benchmarks.warpnet_benchmark --sizes 256 512
+"""
+import argparse
+
+import torch
+
+from models.warpnet import WarpNet, padding_customize
+from benchmarks.common import time_call
+
+
+def synthetic_features(batch_size, size):
+    """
+    Random resnet34 stage features and reference histogram for an input of size x size
+    """
+    features = [torch.randn(batch_size, channel, size // scale, size // scale)
+                for channel, scale in ((64, 4), (128, 8), (256, 16), (512, 32))]
+    hist = torch.rand(batch_size, 512, size // 8, size // 8)
+    return hist, features
+
+
+def separate_branch_forward(warp_net, B_hist, A_relus, B_relus, temperature=0.001 * 5):
+    """
+    The correlation computed by running every shared layer once per branch
+    """
+    A_features = [layer(x) for layer, x in zip((warp_net.layer2_1, warp_net.layer3_1,
+                                                warp_net.layer4_1, warp_net.layer5_1), A_relus)]
+    B_features = [layer(x) for layer, x in zip((warp_net.layer2_1, warp_net.layer3_1,
+                                                warp_net.layer4_1, warp_net.layer5_1), B_relus)]
+    A_features = [padding_customize(x, A_features[3]) for x in A_features[:3]] + [A_features[3]]
+    B_features = [padding_customize(x, B_features[3]) for x in B_features[:3]] + [B_features[3]]
+    A_features = warp_net.layer(torch.cat(A_features, 1))
+    B_features = warp_net.layer(torch.cat(B_features, 1))
+
+    return warp_net.correlate(B_hist, A_features, B_features, temperature)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="warpnet paired branch benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=1)
+    opt = parser.parse_args()
+
+    torch.manual_seed(0)
+    torch.set_grad_enabled(False)
+    warp_net = WarpNet().eval()
+
+    print('%-6s %-14s %-14s %s' % ('size', 'separate (ms)', 'paired (ms)', 'speedup'))
+    for size in opt.sizes:
+        hist, A_relus = synthetic_features(opt.batch_size, size)
+        _, B_relus = synthetic_features(opt.batch_size, size)
+        paired_relus = [torch.cat((a, b), 0) for a, b in zip(A_relus, B_relus)]
+
+        separate_time = time_call(lambda: separate_branch_forward(warp_net, hist, A_relus, B_relus),
+                                  opt.steps, opt.warmup)
+        paired_time = time_call(lambda: warp_net.forward_paired(hist, *paired_relus), opt.steps, opt.warmup)
+        print('%-6d %-14.2f %-14.2f %.2fx' % (size, separate_time * 1000, paired_time * 1000,
+                                             separate_time / paired_time))
+
+
+if __name__ == '__main__':
+    main()
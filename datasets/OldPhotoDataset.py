@@ -67,7 +67,10 @@ class OldPhotoDataset(Dataset):
                 match_json = json.load(f)
 
             random_seed = random.randint(0, len(match_json) - 1)
-            ref_name = os.path.join(os.path.dirname(gt_image_name), match_json[random_seed]['name'] + '.jpg')
+            ref_name = match_json[random_seed]['name']
+            if not ref_name.endswith(('.jpg', '.png')):
+                ref_name += '.jpg'
+            ref_name = os.path.join(os.path.dirname(gt_image_name), ref_name)
             ref_image = cv2.cvtColor(cv2.imread(ref_name), cv2.COLOR_BGR2RGB)
 
             data.update({'ref_image': ref_image})
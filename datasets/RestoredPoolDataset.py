@@ -0,0 +1,117 @@
+"""
+Pool of crack net restored training samples for colorization training with --crack_dir. The random
+degradations and the frozen crack net run once per pooled sample instead of once per training
+step, the colorization model samples batches from the pool, and a fraction of the pool is
+regenerated every epoch so the degradations keep changing.
+"""
+import os
+
+import torch
+
+from torch.utils.data import Dataset
+
+POOL_KEYS = ('input_image', 'input_L', 'gt_L', 'gt_ab', 'ref_gray', 'ref_ab')
+
+
+class RestoredPoolDataset(Dataset):
+    """
+    Fixed size pool of (degraded input, crack net restored L, ground truth, reference) samples, in
+    the format of OldPhotoDataset, input_L being the restored one. The oldest samples are replaced
+    first.
+    """
+
+    def __init__(self, size, dtype=torch.float16):
+        """
+        Args:
+            :param size: number of samples in the pool
+            :param dtype: storage type of the pool, float16 halves the memory
+        """
+        self.size = size
+        self.dtype = dtype
+        self.tensors = {}
+        self.filled = 0
+        self.next_slot = 0
+        # iterator of the degraded training loader, kept across refreshes
+        self.source = None
+
+    def __len__(self):
+        return self.filled
+
+    def __getitem__(self, idx):
+        return {key: value[idx].float() for key, value in self.tensors.items()}
+
+    def _next_batch(self, loader):
+        if self.source is not None:
+            batch = next(self.source, None)
+            if batch is not None:
+                return batch
+        # a new pass over the training data, with new random degradations
+        self.source = iter(loader)
+        return next(self.source)
+
+    def generate(self, loader, crack_net, count, use_gpu=False):
+        """
+        Degrade, restore with the crack net and write count samples
+        :param loader: training loader with the degradation transforms
+        :param crack_net: frozen crack net
+        :param count: number of samples to write
+        :param use_gpu: run the crack net on gpu
+        """
+        written = 0
+        while written < count:
+            batch = self._next_batch(loader)
+            input_l = batch['input_L'].cuda() if use_gpu else batch['input_L']
+            with torch.inference_mode():
+                batch['input_L'] = crack_net(input_l)['output'].cpu()
+
+            num = min(len(input_l), count - written)
+            slots = (torch.arange(num) + self.next_slot) % self.size
+            for key in POOL_KEYS:
+                if key not in batch:
+                    continue
+                value = batch[key][:num]
+                if key not in self.tensors:
+                    self.tensors[key] = torch.empty((self.size,) + tuple(value.shape[1:]), dtype=self.dtype)
+                self.tensors[key][slots] = value.to(self.dtype)
+
+            self.next_slot = (self.next_slot + num) % self.size
+            self.filled = min(self.filled + num, self.size)
+            written += num
+
+    def fill(self, loader, crack_net, use_gpu=False):
+        """
+        Generate the samples of the empty slots
+        """
+        self.generate(loader, crack_net, self.size - self.filled, use_gpu)
+
+    def refresh(self, loader, crack_net, fraction, use_gpu=False):
+        """
+        Replace the oldest fraction of the pool
+        """
+        self.generate(loader, crack_net, int(round(fraction * self.size)), use_gpu)
+
+    def save(self, path, crack_digest):
+        """
+        Write the pool, it is reused by the next run with the same crack net weights and pool size
+        :param crack_digest: result_cache.model_digest of the crack net
+        """
+        torch.save({'crack_digest': crack_digest, 'size': self.size, 'filled': self.filled,
+                    'next_slot': self.next_slot, 'tensors': self.tensors}, path)
+
+    def load(self, path, crack_digest, crop_size=None):
+        """
+        :param crack_digest: result_cache.model_digest of the crack net, a pool restored by other
+                             weights, e.g. before the crack net was trained again, is not loaded
+        :param crop_size: expected sample size, None accepts any
+        :return: whether a matching saved pool was loaded
+        """
+        if not path or not os.path.exists(path):
+            return False
+        saved = torch.load(path)
+        if saved.get('crack_digest') != crack_digest or saved['size'] != self.size:
+            return False
+        if crop_size and saved['tensors']['input_L'].shape[-1] != crop_size:
+            return False
+        self.tensors = {key: value.to(self.dtype) for key, value in saved['tensors'].items()}
+        self.filled, self.next_slot = saved['filled'], saved['next_slot']
+        return True
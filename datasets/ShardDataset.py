@@ -0,0 +1,224 @@
+"""
+Sequentially read tar shards for training from network/object storage. Every sample is a group of
+consecutive tar members with the same key: <key>.jpg(or .png) holds the ground truth and optional
+<key>.ref<i>.jpg hold references. Shards are split across distributed ranks and dataloader
+workers, and samples are mixed with an in memory shuffle buffer.
+
+Write shards from image folders:
+python -m datasets.ShardDataset --folders data/train_folder --output_dir data/train_shards --shard_size_mb 256
+"""
+import argparse
+import glob
+import io
+import json
+import os
+import random
+import tarfile
+
+import cv2
+import numpy as np
+import torch.distributed as dist
+
+from torch.utils.data import IterableDataset, get_worker_info
+from torchvision import transforms
+
+from datasets.customized_transform import ToTensor
+
+IMAGE_EXTENSIONS = ('.jpg', '.png')
+
+
+def list_shards(shards):
+    """
+    :param shards: a folder, a glob pattern or a list of shard paths
+    :return: sorted shard paths
+    """
+    if isinstance(shards, (list, tuple)):
+        return list(shards)
+    if os.path.isdir(shards):
+        shards = os.path.join(shards, '*.tar')
+    return sorted(glob.glob(shards))
+
+
+def iter_tar_samples(shard):
+    """
+    Read a tar shard front to back, without seeking
+    :return: generator of (key, {suffix: bytes})
+    """
+    key, sample = None, {}
+    with tarfile.open(shard, 'r|') as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            member_key, _, suffix = os.path.basename(member.name).partition('.')
+            if member_key != key and sample:
+                yield key, sample
+                sample = {}
+            key = member_key
+            sample[suffix] = tar.extractfile(member).read()
+    if sample:
+        yield key, sample
+
+
+def decode_image(buffer):
+    image = cv2.imdecode(np.frombuffer(buffer, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError('can not decode a shard image')
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+class ShardDataset(IterableDataset):
+    """
+    Same samples as OldPhotoDataset, read from tar shards. A random reference of the sample is used
+    when the shards were written with references.
+    """
+
+    def __init__(self, shards, transform=transforms.Compose([ToTensor()]), shuffle_buffer=1000, seed=0):
+        """
+        Args:
+            :param shards: folder, glob pattern or list of tar shards
+            :param transform: callable function to do transform on origin data pair
+            :param shuffle_buffer: number of encoded samples kept in memory for shuffling, 0 or 1
+                                   keeps the shard order. The images are decoded when a
+                                   sample leaves the buffer
+            :param seed: base seed of the shard order and the buffer, changed with set_epoch
+        """
+        self.shards = list_shards(shards)
+        if not self.shards:
+            raise ValueError('no shard found in %s' % shards)
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """
+        Reshuffle the shard order and buffer differently every epoch
+        """
+        self.epoch = epoch
+
+    def _my_shards(self, rng):
+        shards = list(self.shards)
+        # same permutation on every rank and worker, then every one takes its own slice
+        rng.shuffle(shards)
+        if dist.is_available() and dist.is_initialized():
+            shards = shards[dist.get_rank()::dist.get_world_size()]
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shards = shards[worker_info.id::worker_info.num_workers]
+        return shards
+
+    def _iter_samples(self, shards, rng):
+        # encoded bytes of the image and of one reference, a few hundred KB per sample in the buffer
+        for shard in shards:
+            for key, sample in iter_tar_samples(shard):
+                gt_suffix = [s for s in sample if s in ('jpg', 'png')]
+                if not gt_suffix:
+                    continue
+                refs = [s for s in sample if s.startswith('ref')]
+                yield {'gt_image': sample[gt_suffix[0]],
+                       'ref_image': sample[rng.choice(refs)] if refs else None,
+                       'image_name': '%s/%s' % (os.path.basename(shard), key)}
+
+    def __iter__(self):
+        rng = random.Random(self.seed + self.epoch)
+        samples = self._iter_samples(self._my_shards(rng), random.Random(rng.random()))
+        if self.shuffle_buffer <= 1:
+            for data in samples:
+                yield self._transform(data)
+            return
+
+        # the buffer differs between workers, so every worker gets its own stream
+        worker_info = get_worker_info()
+        buffer_rng = random.Random((self.seed + self.epoch) * 1000 + (worker_info.id if worker_info else 0))
+        buffer = []
+        for data in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(data)
+                continue
+            index = buffer_rng.randrange(len(buffer))
+            data, buffer[index] = buffer[index], data
+            yield self._transform(data)
+        buffer_rng.shuffle(buffer)
+        for data in buffer:
+            yield self._transform(data)
+
+    def _transform(self, encoded):
+        gt_image = decode_image(encoded['gt_image'])
+        input_image = np.expand_dims(cv2.cvtColor(gt_image, cv2.COLOR_BGR2GRAY), -1)
+        data = {'input_image': input_image, 'gt_image': gt_image}
+        if encoded['ref_image'] is not None:
+            data['ref_image'] = decode_image(encoded['ref_image'])
+
+        image_name = encoded['image_name']
+        if self.transform:
+            data = self.transform(data)
+        data['image_name'] = image_name
+        return data
+
+
+def write_shards(folders, output_dir, shard_size_mb=256, refs_per_sample=0, seed=0):
+    """
+    Pack the images of the folders into tar shards, in a random order so every shard is a mix. The
+    encoded image bytes are stored as they are.
+    :param folders: image folders, like train_file in the yaml
+    :param output_dir: shard folder
+    :param shard_size_mb: a new shard is started above this size
+    :param refs_per_sample: store the first references of matches/<image>.json with every sample
+    :return: list of the written shards
+    """
+    images = []
+    for folder in folders:
+        images += sorted([os.path.join(folder, x) for x in os.listdir(folder) if x.endswith(IMAGE_EXTENSIONS)])
+    random.Random(seed).shuffle(images)
+    os.makedirs(output_dir, exist_ok=True)
+
+    def add(tar, name, path):
+        with open(path, 'rb') as f:
+            buffer = f.read()
+        info = tarfile.TarInfo(name)
+        info.size = len(buffer)
+        tar.addfile(info, io.BytesIO(buffer))
+        return len(buffer)
+
+    shards, tar, size = [], None, 0
+    for i, image in enumerate(images):
+        if tar is None or size > shard_size_mb * 1024 * 1024:
+            if tar is not None:
+                tar.close()
+            shards.append(os.path.join(output_dir, 'shard-%05d.tar' % len(shards)))
+            tar, size = tarfile.open(shards[-1], 'w'), 0
+
+        # the key can not contain a dot, the part after the first dot is the suffix
+        key = '%08d' % i
+        size += add(tar, '%s.%s' % (key, image.rsplit('.', 1)[1]), image)
+        if refs_per_sample:
+            folder, image_name = os.path.split(image)
+            with open(os.path.join(folder, 'matches', os.path.splitext(image_name)[0] + '.json')) as f:
+                matches = json.load(f)
+            for j, match in enumerate(matches[:refs_per_sample]):
+                ref_name = match['name']
+                if not ref_name.endswith(IMAGE_EXTENSIONS):
+                    ref_name += '.jpg'
+                size += add(tar, '%s.ref%d.%s' % (key, j, ref_name.rsplit('.', 1)[1]),
+                            os.path.join(folder, ref_name))
+    if tar is not None:
+        tar.close()
+    return shards
+
+
+def main():
+    parser = argparse.ArgumentParser(description="write tar shards from image folders")
+    parser.add_argument('--folders', type=str, nargs='+', required=True)
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--shard_size_mb', type=float, default=256)
+    parser.add_argument('--refs_per_sample', type=int, default=0,
+                        help='store references from the matches json files, see ref_json')
+    parser.add_argument('--seed', type=int, default=0)
+    opt = parser.parse_args()
+
+    shards = write_shards(opt.folders, opt.output_dir, opt.shard_size_mb, opt.refs_per_sample, opt.seed)
+    print('%d shards written to %s' % (len(shards), opt.output_dir))
+
+
+if __name__ == '__main__':
+    main()
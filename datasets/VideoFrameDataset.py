@@ -0,0 +1,92 @@
+"""
+Training samples streamed from color videos, without dumping the frames to disk first
+"""
+import queue
+import threading
+
+import cv2
+import numpy as np
+
+from torch.utils.data import IterableDataset, get_worker_info
+from torchvision import transforms
+
+from datasets.customized_transform import ToTensor
+from utils.texture_libs import iter_video_frames
+
+
+class VideoFrameDataset(IterableDataset):
+    """
+    Every kept frame of the videos becomes one sample in the same format as OldPhotoDataset. The
+    videos are split between the dataloader workers, each worker decodes its videos in one
+    sequential pass on a background thread that stays at most buffer_size frames ahead.
+    """
+
+    def __init__(self, videos, transform=transforms.Compose([ToTensor()]), every_n=1, scene_threshold=0.,
+                 buffer_size=32):
+        """
+        Args:
+            :param videos: list of color video paths
+            :param transform: callable function to do transform on origin data pair
+            :param every_n: keep every n-th frame
+            :param scene_threshold: drop near duplicate frames, see texture_libs.iter_video_frames
+            :param buffer_size: max number of decoded frames waiting to be transformed
+        """
+        self.videos = videos
+        self.transform = transform
+        self.every_n = every_n
+        self.scene_threshold = scene_threshold
+        self.buffer_size = buffer_size
+
+    @staticmethod
+    def _put(frame_queue, item, stop):
+        """
+        Block until the item is queued or the consumer stopped
+        """
+        while not stop.is_set():
+            try:
+                frame_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _decode(self, videos, frame_queue, stop):
+        try:
+            for video in videos:
+                for index, image in iter_video_frames(video, self.every_n, self.scene_threshold):
+                    if not self._put(frame_queue, (video, index, image), stop):
+                        return
+        except Exception as e:
+            self._put(frame_queue, e, stop)
+            return
+        self._put(frame_queue, None, stop)
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        videos = self.videos
+        if worker_info is not None:
+            videos = videos[worker_info.id::worker_info.num_workers]
+
+        frame_queue = queue.Queue(maxsize=self.buffer_size)
+        stop = threading.Event()
+        decoder = threading.Thread(target=self._decode, args=(videos, frame_queue, stop), daemon=True)
+        decoder.start()
+        try:
+            while True:
+                item = frame_queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                video, index, image = item
+
+                gt_image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+                input_image = np.expand_dims(cv2.cvtColor(gt_image, cv2.COLOR_BGR2GRAY), -1)
+                data = {'input_image': input_image, 'gt_image': gt_image}
+                if self.transform:
+                    data = self.transform(data)
+
+                data['image_name'] = '%s#%06d' % (video, index)
+                yield data
+        finally:
+            stop.set()
@@ -1,16 +1,15 @@
 """
 Classes for customized transform for our data
 """
+import abc
 from random import randint
 
 import cv2
 import numpy as np
 import torch
-import imgaug.augmenters as iaa
 
 from skimage.color import rgb2lab, lab2rgb
-from utils.texture_libs import crack_generate, dust_generate
-from utils.damage_libs import damage_generate
+from utils.texture_libs import crack_generate, dust_generate, random_crack_code, resize_window
 
 
 class CrackGenerator(object):
@@ -20,13 +19,20 @@ class CrackGenerator(object):
 
     def __call__(self, sample):
         input_image, gt_image = sample['input_image'], sample['gt_image']
-        # crack generation
-        code = randint(1, 12)
-        processed_image, _ = crack_generate(cv2.cvtColor(input_image, cv2.COLOR_GRAY2BGR).copy(), code)
+        # place the textures as on the full image if only a crop window was kept
+        window, mean_color = None, None
+        if 'window' in sample:
+            window = sample['window']['top'], sample['window']['left'], \
+                sample['window']['full_height'], sample['window']['full_width']
+            mean_color = sample['window']['middle_row_mean']
+
+        # crack generation, the frames of the texture_video yaml section are crack textures as well
+        code = random_crack_code()
+        processed_image, _ = crack_generate(cv2.cvtColor(input_image, cv2.COLOR_GRAY2BGR).copy(), code, window)
 
         # dust generation
         code = randint(1, 8)
-        processed_image = dust_generate(processed_image.copy(), code)
+        processed_image = dust_generate(processed_image.copy(), code, window, mean_color)
 
         processed_image = np.expand_dims(cv2.cvtColor(processed_image, cv2.COLOR_BGR2GRAY), -1)
         sample.update({'input_image': processed_image})
@@ -38,6 +44,8 @@ class DamageGenerator(object):
     damage generation
     """
     def __call__(self, sample):
+        from utils.damage_libs import damage_generate
+
         input_image = sample['input_image']
         processed_image = damage_generate(input_image.copy(), threash=20)
         sample.update({'input_image': processed_image})
@@ -97,6 +105,116 @@ class RandomCrop(object):
         return {'input_image': input_image, 'gt_image': gt_image, 'ref_image': ref_image}
 
 
+def upscale_small(image, new_h, new_w):
+    """
+    Resize an image smaller than the crop size up like RandomCrop does
+    """
+    h, w = image.shape[:2]
+    if h < new_h:
+        image = cv2.resize(image, None, fx=new_h / h, fy=new_h / h)
+    if w < new_w:
+        image = cv2.resize(image, None, fx=new_w / w, fy=new_w / w)
+    return image
+
+
+class RandomCropWindow(object):
+    """
+    Crop-first version of RandomCrop with the same sample distribution. The crop windows are chosen
+    from the image sizes only, then only the windows are cut out, so RandomBlur, CrackGenerator and
+    TolABTensor never touch the full resolution image. The input and ground truth windows keep `pad`
+    extra pixels on each side(where the image has them) for the blur, remove them with CropPadding
+    after the degradations. The reference window is resized directly from the reference.
+    Args:
+        output_size (tuple or int): Desired output size. If int, square crop
+            is made.
+        pad: extra pixels around the input window
+        upscale_later: images smaller than the crop are kept at their size, so the degradations run
+            on them as before RandomCrop, and CropPadding upscales and crops them. Without it they are
+            upscaled here
+    """
+
+    def __init__(self, output_size=256, pad=0, upscale_later=False):
+        assert isinstance(output_size, (int, tuple))
+        if isinstance(output_size, int):
+            self.output_size = (output_size, output_size)
+        else:
+            assert len(output_size) == 2
+            self.output_size = output_size
+        self.pad = pad
+        self.upscale_later = upscale_later
+
+    def __call__(self, sample):
+        input_image, gt_image = sample['input_image'], sample['gt_image']
+        h, w = input_image.shape[:2]
+        new_h, new_w = self.output_size
+        small = h < new_h or w < new_w
+        if small:
+            upscaled_gt = upscale_small(gt_image, new_h, new_w)
+            if not self.upscale_later:
+                gt_image, input_image = upscaled_gt, upscale_small(input_image, new_h, new_w)
+        else:
+            upscaled_gt = gt_image
+        full_h, full_w = upscaled_gt.shape[:2]
+
+        # the reference window of the reference resized to the ground truth size
+        top = 0 if full_h == new_h else np.random.randint(0, full_h - new_h)
+        left = 0 if full_w == new_w else np.random.randint(0, full_w - new_w)
+        if 'ref_image' not in sample:
+            ref_image = upscaled_gt[top: top + new_h, left: left + new_w].copy()
+        else:
+            ref_image = resize_window(sample['ref_image'], full_h, full_w, top, left, new_h, new_w)
+
+        if small and self.upscale_later:
+            # the whole small image goes through the degradations, CropPadding crops it
+            window = {'top': 0, 'left': 0, 'full_height': h, 'full_width': w, 'pad': (0, 0, 0, 0),
+                      'middle_row_mean': np.mean(input_image[h // 2, :]), 'upscale': (new_h, new_w)}
+            return {'input_image': input_image, 'gt_image': gt_image, 'ref_image': ref_image, 'window': window}
+
+        # the ground truth window plus padding
+        h, w = input_image.shape[:2]
+        top = 0 if h == new_h else np.random.randint(0, h - new_h)
+        left = 0 if w == new_w else np.random.randint(0, w - new_w)
+        pad_top, pad_left = min(self.pad, top), min(self.pad, left)
+        pad_bottom, pad_right = min(self.pad, h - top - new_h), min(self.pad, w - left - new_w)
+
+        window = {'top': top - pad_top, 'left': left - pad_left, 'full_height': h, 'full_width': w,
+                  'pad': (pad_top, pad_bottom, pad_left, pad_right),
+                  'middle_row_mean': np.mean(input_image[h // 2, :])}
+        input_image = input_image[top - pad_top: top + new_h + pad_bottom,
+                                  left - pad_left: left + new_w + pad_right]
+        gt_image = gt_image[top - pad_top: top + new_h + pad_bottom,
+                            left - pad_left: left + new_w + pad_right]
+
+        return {'input_image': input_image, 'gt_image': gt_image, 'ref_image': ref_image, 'window': window}
+
+
+class CropPadding(object):
+    """
+    Remove the padding RandomCropWindow kept around the input and ground truth windows, or upscale
+    and crop the images it kept whole(upscale_later)
+    """
+
+    def __call__(self, sample):
+        window = sample.pop('window')
+        input_image, gt_image = sample['input_image'], sample['gt_image']
+        if 'upscale' in window:
+            new_h, new_w = window['upscale']
+            input_image = upscale_small(input_image, new_h, new_w)
+            gt_image = upscale_small(gt_image, new_h, new_w)
+            h, w = gt_image.shape[:2]
+            top = 0 if h == new_h else np.random.randint(0, h - new_h)
+            left = 0 if w == new_w else np.random.randint(0, w - new_w)
+            sample.update({'input_image': input_image[top: top + new_h, left: left + new_w],
+                           'gt_image': gt_image[top: top + new_h, left: left + new_w]})
+            return sample
+
+        pad_top, pad_bottom, pad_left, pad_right = window['pad']
+        h, w = gt_image.shape[:2]
+        sample.update({'input_image': input_image[pad_top: h - pad_bottom, pad_left: w - pad_right],
+                       'gt_image': gt_image[pad_top: h - pad_bottom, pad_left: w - pad_right]})
+        return sample
+
+
 class RandomFlip(object):
     """
     Flip both input image and ground truth
@@ -116,58 +234,84 @@ class RandomFlip(object):
         return sample
 
 
-class RandomBlur(object):
+class LazyAugmenter(abc.ABC):
+    """
+    Base of the imgaug transforms, imgaug is only imported and the augmenter built on the first call,
+    so the pipelines that do not use them never load imgaug
+    """
+
+    def __init__(self):
+        self.seq = None
+
+    @abc.abstractmethod
+    def build(self, iaa):
+        """
+        :param iaa: the imgaug.augmenters module
+        :return: the augmenter
+        """
+
+    def augment(self, image):
+        if self.seq is None:
+            import imgaug.augmenters as iaa
+            self.seq = self.build(iaa)
+        return self.seq(image=image)
+
+
+class RandomBlur(LazyAugmenter):
     """
     Gaussian Blur and noise
     """
 
+    def build(self, iaa):
+        return iaa.Sequential([iaa.GaussianBlur(sigma=(0.0, 3.0)),
+                               iaa.AdditiveGaussianNoise(loc=0, scale=(0.0, 0.05 * 255), per_channel=0.5)])
+
     def __call__(self, sample):
         input_image, gt_image = sample['input_image'], sample['gt_image']
 
-        seq = iaa.Sequential([iaa.GaussianBlur(sigma=(0.0, 3.0)),
-                              iaa.AdditiveGaussianNoise(loc=0, scale=(0.0, 0.05 * 255), per_channel=0.5)])
-
-        input_image = seq(image=input_image)
+        input_image = self.augment(input_image)
         sample.update({'input_image': input_image.copy(), 'gt_image': gt_image.copy()})
 
         return sample
 
 
-class RandomAffine(object):
+class RandomAffine(LazyAugmenter):
     """
     Apply Random Affine Transformation to the reference image
     """
 
-    def __call__(self, sample):
-        ref_image = sample['ref_image']
+    def build(self, iaa):
         aug = iaa.Affine(
             scale={"x": (0.8, 1.2), "y": (0.8, 1.2)},
             translate_percent={"x": (-0.2, 0.2), "y": (-0.2, 0.2)},
             rotate=(-25, 25),
             shear=(-8, 8)
         )
-        seq = iaa.Sequential([aug])
-        ref_image = seq(image=ref_image)
+        return iaa.Sequential([aug])
+
+    def __call__(self, sample):
+        ref_image = self.augment(sample['ref_image'])
 
         sample.update({'ref_image': ref_image})
 
         return sample
 
 
-class RandomHueSaturation(object):
+class RandomHueSaturation(LazyAugmenter):
     """
     Add random hue and saturation to image
     """
 
-    def __call__(self, sample):
-        ref_image = sample['ref_image']
+    def build(self, iaa):
         aug = iaa.WithHueAndSaturation([
             iaa.WithChannels(0, iaa.Add((-20, 20))),
             iaa.WithChannels(1, [iaa.Multiply((0.8, 1.2)),
                                  iaa.LinearContrast((0.75, 1.25))])
         ])
-        seq = iaa.Sequential([aug])
-        ref_image = seq(image=ref_image)
+        return iaa.Sequential([aug])
+
+    def __call__(self, sample):
+        ref_image = self.augment(sample['ref_image'])
 
         sample.update({'ref_image': ref_image})
 
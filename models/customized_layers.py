@@ -67,6 +67,43 @@ class GaussianHistogram(nn.Module):
         return hist, hist_dist
 
 
+def box_filter(x, radius):
+    """
+    Mean over a (2r+1)x(2r+1) window, the borders are normalized by the number of valid pixels
+    :param x: (N, C, H, W)
+    :param radius: window radius
+    :return:
+    """
+    return F.avg_pool2d(x, 2 * radius + 1, stride=1, padding=radius, count_include_pad=False)
+
+
+def guided_upsample(guide_lr, src_lr, guide_hr, radius=2, eps=1e-3):
+    """
+    Fast guided filter upsampling(He et al. 2015). The local linear model mapping the guide to the
+    source is fitted at low resolution, then its coefficients are upsampled and applied to the full
+    resolution guide, so the edges of the output follow the full resolution guide.
+    :param guide_lr: low resolution guide, (N, 1, h, w)
+    :param src_lr: low resolution signal to upsample, (N, C, h, w)
+    :param guide_hr: full resolution guide, (N, 1, H, W)
+    :param radius: box filter radius at low resolution
+    :param eps: regularization, larger value gives smoother output
+    :return: upsampled signal, (N, C, H, W)
+    """
+    mean_i = box_filter(guide_lr, radius)
+    mean_p = box_filter(src_lr, radius)
+    cov_ip = box_filter(guide_lr * src_lr, radius) - mean_i * mean_p
+    var_i = box_filter(guide_lr * guide_lr, radius) - mean_i * mean_i
+
+    a = cov_ip / (var_i + eps)
+    b = mean_p - a * mean_i
+
+    size = (guide_hr.shape[2], guide_hr.shape[3])
+    mean_a = F.interpolate(box_filter(a, radius), size=size, mode='bilinear', align_corners=False)
+    mean_b = F.interpolate(box_filter(b, radius), size=size, mode='bilinear', align_corners=False)
+
+    return mean_a * guide_hr + mean_b
+
+
 if __name__ == '__main__':
     dims = 3
     data = 1 + torch.randn((dims, 224, 224))
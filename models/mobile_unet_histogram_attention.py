@@ -0,0 +1,242 @@
+"""
+A lightweight student of Dense121UnetHistogramAttention for interactive previews: mobilenet-v2 style
+inverted residual encoder, narrow depthwise separable decoders and a slim correspondence module.
+It has the same interface as the teacher, so it can be trained by distillation and served alike.
+"""
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.dense121_unet_histogram_attention import HistogramLayerLocal, HistogramProjection
+from models.networks import FusedAttentionExtractModule, IMAGENET_MEAN, IMAGENET_STD
+from models.warpnet import WarpNet
+
+
+class InvertedResidual(nn.Module):
+    """
+    Mobilenet-v2 block: 1x1 expansion, 3x3 depthwise and 1x1 linear projection
+    Args:
+        in_channels: input channel num
+        out_channels: output channel num
+        stride: stride of the depthwise convolution
+        expand_ratio: channel expansion of the hidden layer
+    """
+
+    def __init__(self, in_channels, out_channels, stride=1, expand_ratio=4):
+        super(InvertedResidual, self).__init__()
+        hidden_channels = in_channels * expand_ratio
+        self.use_residual = stride == 1 and in_channels == out_channels
+        self.conv = nn.Sequential(
+            nn.Conv2d(in_channels, hidden_channels, kernel_size=1, bias=False),
+            nn.ReLU6(inplace=True),
+            nn.Conv2d(hidden_channels, hidden_channels, kernel_size=3, stride=stride, padding=1,
+                      groups=hidden_channels, bias=False),
+            nn.ReLU6(inplace=True),
+            nn.Conv2d(hidden_channels, out_channels, kernel_size=1, bias=True),
+        )
+
+    def forward(self, x):
+        if self.use_residual:
+            return x + self.conv(x)
+        return self.conv(x)
+
+
+class SeparableConv(nn.Sequential):
+    """
+    3x3 depthwise followed by 1x1 pointwise convolution
+    """
+
+    def __init__(self, in_channels, out_channels):
+        super(SeparableConv, self).__init__(
+            nn.Conv2d(in_channels, in_channels, kernel_size=3, padding=1, groups=in_channels, bias=False),
+            nn.Conv2d(in_channels, out_channels, kernel_size=1, bias=True),
+            nn.ReLU(inplace=True),
+        )
+
+
+class LiteFusionModule(nn.Module):
+    """
+    Fuse the encoder feature with the warped histogram and the similarity map
+    """
+
+    def __init__(self, in_features, out_features):
+        super(LiteFusionModule, self).__init__()
+        self.conv = nn.Conv2d(in_features, out_features, kernel_size=1)
+        self.block = InvertedResidual(out_features, out_features)
+
+    def forward(self, feature):
+        return self.block(self.conv(feature))
+
+
+class LiteUp(nn.Module):
+    """
+    Bilinear upscaling, concatenation with the skip feature and a separable convolution
+    """
+
+    def __init__(self, current_channels, prev_channels, out_channels):
+        super(LiteUp, self).__init__()
+        self.conv = nn.Sequential(
+            nn.Conv2d(current_channels + prev_channels, out_channels, kernel_size=1, bias=False),
+            SeparableConv(out_channels, out_channels),
+        )
+
+    def forward(self, x1, x2):
+        x1 = F.interpolate(x1, size=x2.shape[2:], mode='bilinear', align_corners=True)
+        return self.conv(torch.cat([x2, x1], dim=1))
+
+
+class LiteWarpNet(WarpNet):
+    """
+    WarpNet with slim feature layers: every resnet34 level is projected by a 1x1 convolution and
+    resized to the 1/8 grid, followed by a single separable residual block. The correlation and the
+    histogram warping are the ones of WarpNet.
+    Args:
+        feature_channel: channels per resnet34 level after projection
+        inter_channels: channels of the correlation embedding
+        hist_channels: channels of the reference histogram
+    """
+
+    def __init__(self, feat1=64, feat2=128, feat3=256, feat4=512, feature_channel=32, inter_channels=64,
+                 hist_channels=512):
+        # skip the WarpNet layers, only its forward_paired/correlate are reused
+        nn.Module.__init__(self)
+        self.hist_channels = hist_channels
+        self.feature_channel = feature_channel
+        self.in_channels = feature_channel * 4
+        self.inter_channels = inter_channels
+
+        self.projections = nn.ModuleList([nn.Sequential(nn.Conv2d(feat, feature_channel, kernel_size=1),
+                                                        nn.PReLU())
+                                          for feat in [feat1, feat2, feat3, feat4]])
+        self.layer = InvertedResidual(self.in_channels, self.in_channels, expand_ratio=2)
+
+        self.theta = nn.Conv2d(self.in_channels, self.inter_channels, kernel_size=1)
+        self.phi = nn.Conv2d(self.in_channels, self.inter_channels, kernel_size=1)
+
+    def encode(self, relu2_1, relu3_1, relu4_1, relu5_1):
+        size = relu3_1.shape[2:]
+        features = []
+        for projection, feature in zip(self.projections, [relu2_1, relu3_1, relu4_1, relu5_1]):
+            feature = projection(feature)
+            if feature.shape[2] > size[0]:
+                feature = F.adaptive_avg_pool2d(feature, size)
+            elif feature.shape[2:] != size:
+                feature = F.interpolate(feature, size=size, mode='nearest')
+            features.append(feature)
+        return self.layer(torch.cat(features, 1))
+
+
+class MobileUnetHistogramAttention(nn.Module):
+    """
+    Student colorizer with the interface of Dense121UnetHistogramAttention
+    Args:
+        args: input_channel, widths(stem, 1/2, 1/4, 1/8, 1/16, 1/32 channels), blocks(inverted
+              residual blocks per stage), warp_channels, hist_bins, hist_proj and hist_proj_channels
+    """
+
+    def __init__(self, args):
+        super(MobileUnetHistogramAttention, self).__init__()
+        widths = args.get('widths', [16, 24, 32, 64, 96, 160])
+        blocks = args.get('blocks', [1, 2, 3, 3, 2])
+
+        hist_bins = args.get('hist_bins', 256)
+        self.hist_layer_local = HistogramLayerLocal(hist_bins)
+        hist_channels = 2 * hist_bins
+        self.hist_proj = None
+        if args.get('hist_proj', 'none') != 'none':
+            self.hist_proj = HistogramProjection(hist_bins, 2, args['hist_proj_channels'],
+                                                 learned=args['hist_proj'] == 'learned')
+            hist_channels = args['hist_proj_channels']
+
+        # encoder, stem at full size then 5 stages halving the size
+        self.stem = nn.Sequential(nn.Conv2d(1, widths[0], kernel_size=3, padding=1), nn.ReLU6(inplace=True))
+        self.stages = nn.ModuleList()
+        for i, num_blocks in enumerate(blocks):
+            layers = [InvertedResidual(widths[i], widths[i + 1], stride=2)]
+            layers += [InvertedResidual(widths[i + 1], widths[i + 1]) for _ in range(num_blocks - 1)]
+            self.stages.append(nn.Sequential(*layers))
+
+        # fusion with the warped histogram and similarity map at 1/4, 1/8, 1/16 and 1/32
+        self.fusions = nn.ModuleList([LiteFusionModule(width + 1 + hist_channels, width)
+                                      for width in widths[2:]])
+
+        # decoder
+        self.ups = nn.ModuleList([LiteUp(widths[i + 1], widths[i], widths[i])
+                                  for i in reversed(range(len(widths) - 1))])
+        self.conv_final = nn.Conv2d(widths[0], args['input_channel'], kernel_size=3, padding=1)
+
+        self.warp_net = LiteWarpNet(feature_channel=args.get('warp_channels', 32),
+                                    inter_channels=args.get('warp_inter_channels', 64),
+                                    hist_channels=hist_channels)
+
+        self.register_buffer('att_mean', torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1), persistent=False)
+        self.register_buffer('att_std', torch.tensor(IMAGENET_STD).view(1, 3, 1, 1), persistent=False)
+
+    def extract_res_features(self, att_model, gray):
+        """
+        Resnet34 features of the gray images (size divide 4, 8, 16, 32)
+        """
+        if isinstance(att_model, FusedAttentionExtractModule):
+            return att_model(gray)
+        return att_model.extract_features((gray.repeat(1, 3, 1, 1) - self.att_mean) / self.att_std)
+
+    def forward(self, x, x_gray, ref, ref_gray, att_model):
+        """
+        :param x: input L
+        :param x_gray: input gray in [0, 1]
+        :param ref: reference ab
+        :param ref_gray: reference gray in [0, 1]
+        :param att_model: pretrained resnet34
+        """
+        return self.decode(x, self.correspond(x_gray, ref, ref_gray, att_model))
+
+    def reference_histogram(self, ref):
+        """
+        Local histogram of the reference ab at 1/8 size, projected if required
+        """
+        ref_resize_by_8 = F.avg_pool2d(ref, 8)
+        ref_hist = self.hist_layer_local(ref_resize_by_8, ref_resize_by_8)
+        if self.hist_proj is not None:
+            ref_hist = self.hist_proj(ref_hist)
+        return ref_hist
+
+    def correspond(self, x_gray, ref, ref_gray, att_model):
+        """
+        Warped reference histograms and similarity maps of the input, same levels as the teacher
+        """
+        res_features = self.extract_res_features(att_model, torch.cat([x_gray, ref_gray], 0))
+        return self.warp_net.forward_paired(self.reference_histogram(ref), *res_features)
+
+    def prepare_reference(self, ref, ref_gray, att_model):
+        """
+        Everything that only depends on the reference, computed once for a whole video shot
+        """
+        return {'hist': self.reference_histogram(ref),
+                'features': self.warp_net.encode(*self.extract_res_features(att_model, ref_gray))}
+
+    def warp_reference(self, x_gray, reference, att_model):
+        """
+        Warped histograms and similarity maps of the input with a prepared reference
+        """
+        x_features = self.warp_net.encode(*self.extract_res_features(att_model, x_gray))
+        return self.warp_net.correlate(reference['hist'], x_features, reference['features'])
+
+    def decode(self, x, sim_feature):
+        """
+        The mobile unet part, fused with the warped reference histograms
+        :param x: input L
+        :param sim_feature: warpnet output
+        """
+        features = [self.stem(x)]
+        down = features[0]
+        for i, stage in enumerate(self.stages):
+            down = stage(down)
+            if i >= 1:
+                down = self.fusions[i - 1](torch.cat([down, sim_feature[i - 1][1], sim_feature[i - 1][0]], 1))
+            features.append(down)
+
+        up = features[-1]
+        for up_layer, skip in zip(self.ups, reversed(features[:-1])):
+            up = up_layer(up, skip)
+
+        return {'output': self.conv_final(up)}
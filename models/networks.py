@@ -1,6 +1,8 @@
 """
 Some common blocks that may be called several times by different models
 """
+import copy
+
 import cv2
 
 import numpy as np
@@ -8,7 +10,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from torch.autograd import Variable
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 from torchvision.models import resnet34
 from torchvision.models.resnet import ResNet
 
@@ -298,34 +300,25 @@ class GaussianHistogram(nn.Module):
         self.min = min
         self.max = max
 
-        self.sigma = torch.tensor([sigma])
-        self.sigma = Variable(self.sigma, requires_grad=require_grad)
+        # sigma and centers are registered on the module so that .to(device) moves them once,
+        # instead of re-assigning them on every forward call
+        if require_grad:
+            self.sigma = nn.Parameter(torch.tensor([sigma]))
+        else:
+            self.register_buffer('sigma', torch.tensor([sigma]), persistent=False)
 
         self.delta = float(max - min) / float(bins)
-        self.centers = nn.Parameter(float(min) + self.delta * (torch.arange(bins).float() + 0.5), requires_grad=False)
+        self.register_buffer('centers', float(min) + self.delta * (torch.arange(bins).float() + 0.5))
 
     def forward(self, x, attention_mask=None):
-        print("\n -- GAUSSIAN HISTOGRAM --")
-        device = x.device
-        print("Device: " + str(device))
-        self.sigma = self.sigma.to(device)
-        self.centers = self.centers.to(device)
-
-        print("X INPUT = " + str(x.shape))
         x = torch.unsqueeze(x, dim=1) - torch.unsqueeze(self.centers, 1)
-        print("X UNSQUEEZE = " + str(x.shape))
         hist_dist = torch.exp(-0.5 * (x / self.sigma) ** 2) / (self.sigma * np.sqrt(np.pi * 2)) * self.delta
-        print("HIST DIST = " + str(hist_dist.shape))
         # multiply with attention mask
-        if not type(attention_mask) == type(None):
-            hist_dist *= torch.unsqueeze(attention_mask, 1)
+        if attention_mask is not None:
+            hist_dist = hist_dist * torch.unsqueeze(attention_mask, 1)
 
         hist = hist_dist.sum(dim=-1)
-        print("HIST SUM = " + str(hist.shape))
-        print("TORCH SUM = " + str(torch.sum(hist, dim=1, keepdim=True)))
         hist = hist / torch.sum(hist, dim=1, keepdim=True)
-        print("HIST DIV SUM = " + str(hist.shape))
-        print("\n")
 
         return hist, hist_dist
 
@@ -346,16 +339,79 @@ class AttentionExtractModule(ResNet):
         g2 = self.layer3(g1)
         g3 = self.layer4(g2)
 
-        gfinal = [g.pow(2).mean(1) for g in (g0, g1, g2, g3)], [g0, g1, g2, g3]
-        print("\n")
-        #print("\ngpow SHAPE = " + str(gfinal.shape))
-        print("g0 shape = " + str(gfinal[1][0].shape))
-        print("g0 shape = " + str(gfinal[1][1].shape))
-        print("g0 shape = " + str(gfinal[1][2].shape))
-        print("g0 shape = " + str(gfinal[1][3].shape))
-
         return [g.pow(2).mean(1) for g in (g0, g1, g2, g3)], [g0, g1, g2, g3]
 
+    def extract_features(self, x):
+        """
+        Only return the features of each stage, the attention maps are skipped
+        """
+        x = self.maxpool(self.relu(self.bn1(self.conv1(x))))
+
+        g0 = self.layer1(x)
+        g1 = self.layer2(g0)
+        g2 = self.layer3(g1)
+        g3 = self.layer4(g2)
+
+        return [g0, g1, g2, g3]
+
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+
+class FusedAttentionExtractModule(nn.Module):
+    """
+    Frozen, inference-only version of AttentionExtractModule. BatchNorm layers are folded into the
+    convolution weights and the imagenet normalization of the gray input is done by one affine op.
+    Only the stage features are computed.
+    Args:
+        att_model: AttentionExtractModule with loaded weights
+    """
+
+    def __init__(self, att_model):
+        super(FusedAttentionExtractModule, self).__init__()
+        att_model = copy.deepcopy(att_model).eval()
+
+        self.conv1 = fuse_conv_bn_eval(att_model.conv1, att_model.bn1)
+        self.relu = att_model.relu
+        self.maxpool = att_model.maxpool
+        for name in ['layer1', 'layer2', 'layer3', 'layer4']:
+            layer = getattr(att_model, name)
+            for block in layer:
+                block.conv1 = fuse_conv_bn_eval(block.conv1, block.bn1)
+                block.bn1 = nn.Identity()
+                block.conv2 = fuse_conv_bn_eval(block.conv2, block.bn2)
+                block.bn2 = nn.Identity()
+                if block.downsample is not None:
+                    block.downsample = nn.Sequential(fuse_conv_bn_eval(block.downsample[0], block.downsample[1]))
+            setattr(self, name, layer)
+
+        # (gray - mean) / std for all three channels, the gray image doesn't need to be repeated
+        mean = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1)
+        std = torch.tensor(IMAGENET_STD).view(1, 3, 1, 1)
+        self.register_buffer('scale', 1. / std)
+        self.register_buffer('shift', -mean / std)
+
+        self.eval()
+        for param in self.parameters():
+            param.requires_grad = False
+
+    def forward(self, x):
+        """
+        :param x: gray image in range [0, 1], shape (N, 1, H, W)
+        :return: features of the four resnet stages
+        """
+        x = x * self.scale + self.shift
+        x = self.maxpool(self.relu(self.conv1(x)))
+
+        g0 = self.layer1(x)
+        g1 = self.layer2(g0)
+        g2 = self.layer3(g1)
+        g3 = self.layer4(g2)
+
+        return [g0, g1, g2, g3]
+
+
 if __name__ == '__main__':
     data = 1.0 * torch.ones((2, 256, 400))
     mean = torch.ones(2, 1, 400) * 2.3
@@ -12,7 +12,6 @@ from torchvision.models import resnet34
 from torchvision.models.resnet import ResNet, BasicBlock
 
 from models.networks import GaussianHistogram, AttentionExtractModule
-from models.dense121_unet_histogram_attention import HistogramLayerLocal
 
 
 class ResidualBlock(nn.Module):
@@ -42,8 +41,8 @@ class ResidualBlock(nn.Module):
 
 def padding_customize(x1, x2):
 
-    diffY = torch.tensor([x2.size()[2] - x1.size()[2]])
-    diffX = torch.tensor([x2.size()[3] - x1.size()[3]])
+    diffY = x2.size()[2] - x1.size()[2]
+    diffX = x2.size()[3] - x1.size()[3]
     # in case input size are odd
     x1 = F.pad(x1, [diffX // 2, diffX - diffX // 2,
                     diffY // 2, diffY - diffY // 2], mode='replicate')
@@ -55,8 +54,9 @@ class WarpNet(nn.Module):
     """
     Inputs are the res34 features
     """
-    def __init__(self, feat1=64, feat2=128, feat3=256, feat4=512):
+    def __init__(self, feat1=64, feat2=128, feat3=256, feat4=512, hist_channels=512):
         super(WarpNet, self).__init__()
+        self.hist_channels = hist_channels
         self.feature_channel = 64
         self.in_channels = self.feature_channel * 4
         self.inter_channels = 256
@@ -139,31 +139,66 @@ class WarpNet(nn.Module):
         temperature=0.001 * 5,
         detach_flag=False,
     ):
+        return self.forward_paired(B_hist,
+                                   torch.cat((A_relu2_1, B_relu2_1), 0),
+                                   torch.cat((A_relu3_1, B_relu3_1), 0),
+                                   torch.cat((A_relu4_1, B_relu4_1), 0),
+                                   torch.cat((A_relu5_1, B_relu5_1), 0),
+                                   temperature=temperature,
+                                   detach_flag=detach_flag)
+
+    def forward_paired(self, B_hist, relu2_1, relu3_1, relu4_1, relu5_1, temperature=0.001 * 5, detach_flag=False):
+        """
+        Same as forward, but the input(A) and reference(B) features come concatenated along the batch
+        dimension, A first. Both branches share all the layers before the correlation, so they run as
+        one batch and are only split for theta/phi.
+        """
         batch_size = B_hist.shape[0]
+        features = self.encode(relu2_1, relu3_1, relu4_1, relu5_1)
 
-        # scale feature size to 44*44
-        A_feature2_1 = self.layer2_1(A_relu2_1)
-        B_feature2_1 = self.layer2_1(B_relu2_1)
-        A_feature3_1 = self.layer3_1(A_relu3_1)
-        B_feature3_1 = self.layer3_1(B_relu3_1)
-        A_feature4_1 = self.layer4_1(A_relu4_1)
-        B_feature4_1 = self.layer4_1(B_relu4_1)
-        A_feature5_1 = self.layer5_1(A_relu5_1)
-        B_feature5_1 = self.layer5_1(B_relu5_1)
+        return self.correlate(B_hist, features[:batch_size], features[batch_size:], temperature, detach_flag)
 
-        # concatenate features
-        if A_feature5_1.shape[2] != A_feature2_1.shape[2] or A_feature5_1.shape[3] != A_feature2_1.shape[3]:
-            A_feature2_1 = padding_customize(A_feature2_1, A_feature5_1)
-            A_feature3_1 = padding_customize(A_feature3_1, A_feature5_1)
-            A_feature4_1 = padding_customize(A_feature4_1, A_feature5_1)
+    def encode(self, relu2_1, relu3_1, relu4_1, relu5_1):
+        """
+        Shared feature layers before the correlation, for any batch of input or reference features
+        """
+        paddings = self.alignment_padding(relu2_1.shape[2:], relu3_1.shape[2:], relu4_1.shape[2:],
+                                          relu5_1.shape[2:])
 
-        if B_feature5_1.shape[2] != B_feature2_1.shape[2] or B_feature5_1.shape[3] != B_feature2_1.shape[3]:
-            B_feature2_1 = padding_customize(B_feature2_1, B_feature5_1)
-            B_feature3_1 = padding_customize(B_feature3_1, B_feature5_1)
-            B_feature4_1 = padding_customize(B_feature4_1, B_feature5_1)
+        # scale feature size to 44*44
+        features = [self.layer2_1(relu2_1), self.layer3_1(relu3_1), self.layer4_1(relu4_1)]
+        feature5_1 = self.layer5_1(relu5_1)
+        for i, padding in enumerate(paddings):
+            if padding is not None:
+                features[i] = F.pad(features[i], padding, mode='replicate')
 
-        A_features = self.layer(torch.cat((A_feature2_1, A_feature3_1, A_feature4_1, A_feature5_1), 1))
-        B_features = self.layer(torch.cat((B_feature2_1, B_feature3_1, B_feature4_1, B_feature5_1), 1))
+        # concatenate features
+        return self.layer(torch.cat(features + [feature5_1], 1))
+
+    @staticmethod
+    def alignment_padding(size2, size3, size4, size5):
+        """
+        The padding_customize paddings of the layer2_1, layer3_1 and layer4_1 outputs to the layer5_1
+        output size, computed from the input sizes only: layer2_1 halves the size(rounded up),
+        layer3_1 keeps it, layer4_1 doubles it and layer5_1 multiplies it by 4
+        :param size2: (H, W) of relu2_1, size3 to size5 the same for relu3_1 to relu5_1
+        :return: list of the three F.pad paddings, None where the sizes already match
+        """
+        target = [4 * s for s in size5]
+        outputs = [[(s + 1) // 2 for s in size2], list(size3), [2 * s for s in size4]]
+        paddings = []
+        for output in outputs:
+            diff_y, diff_x = target[0] - output[0], target[1] - output[1]
+            paddings.append([diff_x // 2, diff_x - diff_x // 2, diff_y // 2, diff_y - diff_y // 2]
+                            if diff_x or diff_y else None)
+        return paddings
+
+    def correlate(self, B_hist, A_features, B_features, temperature=0.001 * 5, detach_flag=False):
+        """
+        Warp the reference histogram with the correlation between the input and reference features
+        """
+        batch_size = B_hist.shape[0]
+        feature_height, feature_width = A_features.shape[2], A_features.shape[3]
 
         # pairwise cosine similarity
         theta = self.theta(A_features).view(batch_size, self.inter_channels, -1)  # 2*256*(feature_height*feature_width)
@@ -179,31 +214,28 @@ class WarpNet(nn.Module):
         if detach_flag:
             f = f.detach()
 
-        f_similarity = f.unsqueeze_(dim=1)
-        similarity_map = torch.max(f_similarity, -1, keepdim=True)[0]
-        similarity_map = similarity_map.view(batch_size, 1, A_feature2_1.shape[2],  A_feature2_1.shape[3])
+        similarity_map = torch.max(f, -1, keepdim=True)[0]
+        similarity_map = similarity_map.view(batch_size, 1, feature_height, feature_width)
 
         # f can be negative
-        f_WTA = f
-        f_WTA = f_WTA / temperature
-        f_div_C = F.softmax(f_WTA.squeeze_(), dim=-1)  # 2*1936*1936;
+        f_WTA = f / temperature
+        f_div_C = F.softmax(f_WTA, dim=-1)  # 2*1936*1936;
 
         # downsample the reference histogram
         feature_height, feature_width = B_hist.shape[2], B_hist.shape[3]
-        B_hist = B_hist.view(batch_size, 512, -1)
+        B_hist = B_hist.view(batch_size, self.hist_channels, -1)
         B_hist = B_hist.permute(0, 2, 1)
         y_hist = torch.matmul(f_div_C, B_hist)
         y_hist = y_hist.permute(0, 2, 1).contiguous()
-        y_hist_1 = y_hist.view(batch_size, 512, feature_height, feature_width)
+        y_hist_1 = y_hist.view(batch_size, self.hist_channels, feature_height, feature_width)
 
         # upsample, downspale the wrapped histogram feature for multi-level fusion
-        upsample = nn.Upsample(scale_factor=2)
-        y_hist_0 = upsample(y_hist_1)
+        y_hist_0 = F.interpolate(y_hist_1, scale_factor=2)
         y_hist_2 = F.avg_pool2d(y_hist_1, 2)
         y_hist_3 = F.avg_pool2d(y_hist_1, 4)
 
         # do the same thing to similarity map
-        similarity_map_0 = upsample(similarity_map)
+        similarity_map_0 = F.interpolate(similarity_map, scale_factor=2)
         similarity_map_1 = similarity_map
         similarity_map_2 = F.avg_pool2d(similarity_map_1, 2)
         similarity_map_3 = F.avg_pool2d(similarity_map_1, 4)
@@ -213,6 +245,8 @@ class WarpNet(nn.Module):
 
 
 if __name__ == '__main__':
+    from models.dense121_unet_histogram_attention import HistogramLayerLocal
+
     data = torch.randn((2, 3, 256, 256))
     gt = torch.randn((2, 3, 256, 256))
     data = data.cuda()
@@ -0,0 +1,19 @@
+"""
+main function for testing
+"""
+import os
+
+from utils import parser, inference
+from hypes_yaml import yaml_utils
+
+if __name__ == '__main__':
+    # load the configuration saved along with the trained model
+    opt = parser.test_parser()
+    hypes = yaml_utils.load_yaml(None, opt)
+
+    # gpu setup
+    use_gpu = hypes['train_params']['use_gpu']
+    if use_gpu:
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(hypes['train_params']['gpu_id'])
+
+    inference.test(opt, hypes, use_gpu)
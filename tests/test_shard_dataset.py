@@ -0,0 +1,32 @@
+"""
+ShardDataset yields every sample once whatever the shuffle buffer size, in shard order without
+shuffling.
+"""
+import os
+import random
+
+import cv2
+import numpy as np
+import pytest
+
+from datasets.ShardDataset import ShardDataset, write_shards
+
+
+@pytest.fixture
+def shards(tmp_path):
+    folder = tmp_path / 'images'
+    folder.mkdir()
+    for i in range(10):
+        cv2.imwrite(str(folder / ('%02d.png' % i)), np.full((8, 8, 3), i * 10, np.uint8))
+    return write_shards([str(folder)], str(tmp_path / 'shards'), shard_size_mb=0)
+
+
+@pytest.mark.parametrize('shuffle_buffer', [0, 1, 4, 100])
+def test_shuffle_buffer(shards, shuffle_buffer):
+    dataset = ShardDataset(shards, transform=None, shuffle_buffer=shuffle_buffer)
+    names = [data['image_name'] for data in dataset]
+    assert sorted(names) == sorted('%s/%08d' % (os.path.basename(shard), i) for i, shard in enumerate(shards))
+    if shuffle_buffer <= 1:
+        rng = random.Random(dataset.seed + dataset.epoch)
+        shard_order = [os.path.basename(shard) for shard in dataset._my_shards(rng)]
+        assert [name.split('/')[0] for name in names] == shard_order
@@ -3,7 +3,6 @@ A lib containing tools for generating damage effect
 """
 import cv2
 import numpy as np
-from scipy import ndimage
 from random import randint
 
 
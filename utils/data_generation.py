@@ -75,7 +75,7 @@ def process_single_image(image_full_name, input_folder, output_folder, hypes):
         for output in outputs:
             count += 1
             # crack generation
-            code = randint(1, 12)
+            code = random_crack_code()
             processed_image, _ = crack_generate(output.copy(), code)
             # dust generation
             code = randint(1, 11)
@@ -113,6 +113,8 @@ if __name__ == '__main__':
     input_folder = hypes['input_folder']
     output_folder = hypes['output_folder']
     multi_thread = hypes['multi_thread']
+    # frames of scratch videos as extra crack textures
+    load_texture_videos(hypes.get('texture_video'))
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
@@ -140,6 +142,8 @@ def generate():
     input_folder = hypes['input_folder']
     output_folder = hypes['output_folder']
     multi_thread = hypes['multi_thread']
+    # frames of scratch videos as extra crack textures
+    load_texture_videos(hypes.get('texture_video'))
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
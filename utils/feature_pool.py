@@ -0,0 +1,169 @@
+"""
+Process-wide pool of the frozen pretrained feature extractors: the vgg16_bn of the perceptual loss,
+the alexnet/vgg16/squeezenet of lpips and the resnet34 of the attention features. Every backbone is
+loaded once, frozen and moved to the device of its inputs, and the loss terms that ask for the
+features of the same tensor share a single forward pass.
+"""
+import contextlib
+import weakref
+
+import torch
+import torch.nn as nn
+
+
+class LayerFeatures(nn.Module):
+    """
+    Frozen sequential backbone returning the outputs of a set of layers. The consumers request their
+    layers once, every forward computes all the requested layers, and the last input and the last
+    target features are cached, so a second consumer of the same tensor does not run the backbone
+    again.
+    Args:
+        layers: nn.Sequential backbone, e.g. vgg16_bn().features
+    """
+
+    def __init__(self, layers):
+        super(LayerFeatures, self).__init__()
+        self.layers = layers
+        self.layer_ids = set()
+        # 'input'/'target' -> (weak reference of the tensor, its version, grad mode, normalization, features)
+        self.cache = {}
+        freeze(self)
+
+    def request(self, layer_ids):
+        """
+        Add the layers a consumer needs to the ones computed by every forward
+        """
+        self.layer_ids.update(layer_ids)
+        self.cache.clear()
+
+    def forward(self, x, layer_ids, target=False, normalize=None):
+        """
+        :param x: image batch, 1 channel images are repeated to 3 channels
+        :param layer_ids: indices of the layers to return, must have been requested
+        :param target: target features never need gradients and are computed without autograd
+        :param normalize: (mean, std) per channel tuples applied to x inside the pool, so the cache is
+                          keyed on the tensor of the caller and not on a new normalized one
+        :return: list of the layer outputs in the layer_ids order
+        """
+        key = 'target' if target else 'input'
+        grad = torch.is_grad_enabled() and not target
+        cached = self.cache.get(key)
+        if cached is None or cached[0]() is not x or cached[1] != x._version or cached[2] != grad \
+                or cached[3] != normalize:
+            features = self._run(x, target, normalize)
+            self.cache[key] = (weakref.ref(x, self._release(key)), x._version, grad, normalize, features)
+        else:
+            features = cached[4]
+        return [features[i] for i in layer_ids]
+
+    def _release(self, key):
+        # drop the cached features with the tensor they belong to
+        def callback(ref):
+            if key in self.cache and self.cache[key][0] is ref:
+                del self.cache[key]
+        return callback
+
+    def _run(self, x, target, normalize):
+        move_to(self, x.device)
+        if normalize is not None:
+            mean, std = [torch.tensor(v, dtype=x.dtype, device=x.device).view(1, -1, 1, 1) for v in normalize]
+            x = (x - mean) / std
+        if x.shape[1] == 1:
+            x = x.repeat(1, 3, 1, 1)
+        # inference mode when nothing needs the autograd graph, e.g. metrics and validation;
+        # target features of a training step may be saved for backward by the loss, so only no_grad
+        if not torch.is_grad_enabled():
+            context = torch.inference_mode()
+        elif target:
+            context = torch.no_grad()
+        else:
+            context = contextlib.nullcontext()
+
+        features = {}
+        last = max(self.layer_ids)
+        with context:
+            for i, layer in enumerate(self.layers):
+                x = layer(x)
+                if i in self.layer_ids:
+                    features[i] = x
+                if i == last:
+                    break
+        return features
+
+
+def freeze(module):
+    """
+    Evaluation mode and no parameter gradients
+    """
+    module.eval()
+    for param in module.parameters():
+        param.requires_grad_(False)
+    return module
+
+
+def move_to(module, device):
+    """
+    Move the module to the device if its parameters are elsewhere
+    """
+    param = next(module.parameters(), None)
+    if device is not None and param is not None and param.device != torch.device(device):
+        module.to(device)
+    return module
+
+
+def _vgg16_bn():
+    import torchvision.models as models
+    return LayerFeatures(models.vgg16_bn(pretrained=True).features)
+
+
+def _vgg16():
+    import torchvision.models as models
+    return LayerFeatures(models.vgg16(pretrained=True).features)
+
+
+def _alexnet():
+    import torchvision.models as models
+    return LayerFeatures(models.alexnet(pretrained=True).features)
+
+
+def _squeezenet1_1():
+    import torchvision.models as models
+    return LayerFeatures(models.squeezenet1_1(pretrained=True).features)
+
+
+def _resnet34_attention():
+    from utils import helper
+    return helper.create_att_model()
+
+
+# backbone name -> builder, the builders import their own dependencies
+BUILDERS = {
+    'vgg16_bn': _vgg16_bn,
+    'vgg16': _vgg16,
+    'alexnet': _alexnet,
+    'squeezenet1_1': _squeezenet1_1,
+    'resnet34_attention': _resnet34_attention,
+}
+
+_POOL = {}
+
+
+def get(name, device=None):
+    """
+    The shared frozen extractor, built on the first request
+    :param name: key of BUILDERS
+    :param device: move the extractor to this device, None keeps it where it is
+    :return: frozen module
+    """
+    if name not in _POOL:
+        if name not in BUILDERS:
+            raise ValueError('unknown feature extractor %s, supported: %s' % (name, ', '.join(sorted(BUILDERS))))
+        _POOL[name] = freeze(BUILDERS[name]())
+    return move_to(_POOL[name], device)
+
+
+def clear():
+    """
+    Release all the extractors of the pool
+    """
+    _POOL.clear()
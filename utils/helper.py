@@ -1,6 +1,7 @@
 """
 Helper functions for training and testing
 """
+import argparse
 import os
 import re
 import yaml
@@ -8,13 +9,19 @@ import importlib
 import glob
 from datetime import datetime
 
+import cv2
+import numpy as np
+import torch
 import torch.optim as optim
 import torchvision.utils as utils
 import torchvision.transforms as transforms
+from torchvision.models import resnet34
+from torchvision.models.resnet import BasicBlock
 
 from utils import loss
-from datasets.OldPhotoDataset import *
-from datasets.customized_transform import *
+from utils.color_space_convert import lab_to_rgb
+from hypes_yaml import yaml_utils
+from models.networks import AttentionExtractModule, FusedAttentionExtractModule
 
 
 def setup_train(hypes):
@@ -67,14 +74,27 @@ def setup_train_crack(hypes, model_name='cracknet_rdn'):
     return full_path
 
 
-def create_dataset(hypes, train=True, gan=False, real=False, crack_dir=None):
+def create_dataset(hypes, train=True, gan=False, real=False, crack_dir=None, epoch=0):
     """
     create customized Datasets
     :param gan: Whether for gan training
     :param hypes: config yaml file
     :param train: flag whether to train or test
+    :param epoch: training epoch, picks the crop/batch size of the progressive resolution stage
     :return:
     """
+    # the datasets and their augmentations are only needed for training/evaluation, not inference
+    from torch.utils.data import DataLoader
+    from datasets.OldPhotoDataset import OldPhotoDataset, RealOldPhotoDataset
+    from datasets.ShardDataset import ShardDataset
+    from datasets.VideoFrameDataset import VideoFrameDataset
+    from datasets.customized_transform import CrackGenerator, CropPadding, RandomBlur, RandomCrop, \
+        RandomCropWindow, TolABTensor
+
+    # training crop size, see benchmarks/capacity_planner.py
+    _, crop_size, batch_size = progressive_stage(hypes, epoch)
+    if gan:
+        batch_size = hypes['gan']['batch_size']
     if real:
         dataset = RealOldPhotoDataset(hypes['real_file'],
                                       transform=transforms.Compose(
@@ -83,41 +103,64 @@ def create_dataset(hypes, train=True, gan=False, real=False, crack_dir=None):
         if train:
             dataset = RealOldPhotoDataset(hypes['real_file'],
                                           transform=transforms.Compose(
-                                              [RandomCrop(256),
+                                              [RandomCrop(crop_size),
                                                TolABTensor()]))
             loader_train = DataLoader(dataset,
-                                      batch_size=hypes['gan'][
-                                          'batch_size'] if gan else
-                                      hypes['train_params'][
-                                          'batch_size'],
+                                      batch_size=batch_size,
                                       shuffle=True,
                                       num_workers=4)
             return loader_train, loader_train
         else:
             return dataset
 
+    if crack_dir:
+        # frames of scratch videos as extra crack textures, shared with the forked dataloader workers
+        from utils.texture_libs import load_texture_videos
+        load_texture_videos(hypes.get('texture_video'))
+
     if train:
         # if we only train the color restoration part
+        # crop first, the degradations and the lab conversion only run on the crop window
         if not crack_dir:
-            transform_operation = transforms.Compose([RandomCrop(256),
+            transform_operation = transforms.Compose([RandomCropWindow(crop_size),
                                                       TolABTensor()])
         else:
             transform_operation = transforms.Compose([
+                RandomCropWindow(crop_size, pad=16, upscale_later=True),
                 RandomBlur(),
                 CrackGenerator(),
-                RandomCrop(256),
+                CropPadding(),
                 TolABTensor()])
 
-        train_dataset = OldPhotoDataset(hypes['train_file'],
-                                        transform=transform_operation,
-                                        ref_json=hypes['train_params'][
-                                            'ref_json'])
-        loader_train = DataLoader(train_dataset,
-                                  batch_size=hypes['gan'][
-                                      'batch_size'] if gan else
-                                  hypes['train_params']['batch_size'],
-                                  shuffle=True,
-                                  num_workers=4)
+        video_params = hypes.get('train_video', {})
+        if video_params.get('videos'):
+            # stream the frames of color videos instead of reading train_file
+            train_dataset = VideoFrameDataset(video_params['videos'],
+                                              transform=transform_operation,
+                                              every_n=video_params['every_n'],
+                                              scene_threshold=video_params['scene_threshold'],
+                                              buffer_size=video_params['buffer_size'])
+            loader_train = DataLoader(train_dataset,
+                                      batch_size=batch_size,
+                                      num_workers=min(4, len(video_params['videos'])))
+        elif hypes.get('train_shards', {}).get('shards'):
+            # read tar shards sequentially instead of the image files of train_file
+            shard_params = hypes['train_shards']
+            train_dataset = ShardDataset(shard_params['shards'],
+                                         transform=transform_operation,
+                                         shuffle_buffer=shard_params['shuffle_buffer'])
+            loader_train = DataLoader(train_dataset,
+                                      batch_size=batch_size,
+                                      num_workers=min(4, len(train_dataset.shards)))
+        else:
+            train_dataset = OldPhotoDataset(hypes['train_file'],
+                                            transform=transform_operation,
+                                            ref_json=hypes['train_params'][
+                                                'ref_json'])
+            loader_train = DataLoader(train_dataset,
+                                      batch_size=batch_size,
+                                      shuffle=True,
+                                      num_workers=4)
 
         val_dataset = OldPhotoDataset(hypes['val_file'],
                                       transform=transforms.Compose(transform_operation))
@@ -138,6 +181,33 @@ def create_dataset(hypes, train=True, gan=False, real=False, crack_dir=None):
         return test_dataset
 
 
+def progressive_stage(hypes, epoch):
+    """
+    Crop size and batch size of an epoch with the progressive resolution schedule
+    (train_params: progressive), small crops with large batches first and larger crops later.
+    The stage only depends on the epoch, so a resumed training picks up the right stage.
+    :param hypes: config yaml dictionary
+    :param epoch: training epoch
+    :return: stage index, crop size, batch size
+    """
+    train_params = hypes['train_params']
+    crop_size, batch_size = train_params.get('crop_size', 256), train_params['batch_size']
+    progressive = train_params.get('progressive', {})
+    if not progressive.get('flag'):
+        return 0, crop_size, batch_size
+
+    stages = sorted(progressive['stages'], key=lambda stage: stage['epoch'])
+    index = max([i for i, stage in enumerate(stages) if stage['epoch'] <= epoch] or [0])
+    stage = stages[index]
+    if stage['crop_size'] % 32:
+        raise ValueError('progressive crop size %d is not a multiple of 32' % stage['crop_size'])
+    # by default keep the pixels per batch of crop_size x batch_size
+    stage_batch_size = stage.get('batch_size') or \
+        max(1, int(batch_size * (crop_size / float(stage['crop_size'])) ** 2))
+    stage_batch_size = min(stage_batch_size, progressive.get('max_batch_size', stage_batch_size))
+    return index, stage['crop_size'], stage_batch_size
+
+
 def create_model(hypes, dis=False, crack=False):
     """
     Import the module "models/[model_name].py
@@ -175,16 +245,88 @@ def create_model(hypes, dis=False, crack=False):
     return instance
 
 
-def print_network(net):
+def create_teacher(hypes):
+    """
+    Load the frozen teacher for distillation, its architecture comes from the config.yaml saved in
+    distill.teacher_dir, so any model trained with this repo can be the teacher
+    :param hypes: config yaml dictionary, arch is the student
+    :return: teacher model in eval mode
+    """
+    teacher_dir = hypes['distill']['teacher_dir']
+    teacher_hypes = yaml_utils.load_yaml(None, argparse.Namespace(model_dir=teacher_dir))
+    teacher = create_model(teacher_hypes)
+    initial_epoch, teacher = load_saved_model(teacher_dir, teacher)
+    if initial_epoch == 0:
+        raise ValueError('no teacher checkpoint found in %s' % teacher_dir)
+
+    teacher.eval()
+    for param in teacher.parameters():
+        param.requires_grad = False
+    return teacher
+
+
+def create_att_model(pretrained=True, fused=True):
+    """
+    Create the frozen resnet34 used to extract attention features of the input and reference
+    :param pretrained: whether load the imagenet weights
+    :param fused: fold the batchnorm and input normalization into the convolutions
+    :return:
+    """
+    base_resnet = resnet34(pretrained=pretrained)
+    att_model = AttentionExtractModule(BasicBlock, [3, 4, 6, 3])
+    att_model.load_state_dict(base_resnet.state_dict())
+    att_model.eval()
+    for param in att_model.parameters():
+        param.requires_grad = False
+
+    if fused:
+        att_model = FusedAttentionExtractModule(att_model)
+
+    return att_model
+
+
+def compile_model(model, hypes):
     """
-    Print the layers and number of params of the model
+    Wrap the model with torch.compile if the compiled mode is enabled in the yaml file.
+    The returned module shares parameters with the origin one, so keep using the origin
+    model for saving/loading the state dict.
+    :param model: model object
+    :param hypes: config yaml dictionary
+    :return: compiled model, or the model itself if compiled mode is off
+    """
+    if 'compile' not in hypes or not hypes['compile']['flag']:
+        return model
+    if not hasattr(torch, 'compile'):
+        raise ValueError('compiled mode requires pytorch >= 2.0, but %s is installed' % torch.__version__)
+
+    compile_params = hypes['compile']
+    return torch.compile(model,
+                         backend=compile_params.get('backend', 'inductor'),
+                         mode=compile_params.get('mode', 'default'),
+                         fullgraph=compile_params.get('fullgraph', False))
+
+
+def print_network(net, inputs=None, backward=False, sort='flops', depth=None, top=40):
+    """
+    Print the layers and number of params of the model, or with inputs the per module FLOPs, memory
+    and time table of one pass, see utils/model_analyzer.py
     :param net: neural network object
+    :param inputs: tuple of the forward arguments
+    :param backward: also analyze the backward pass
+    :param sort: column of the table to sort by
+    :param depth: deepest module level shown
+    :param top: number of rows shown
     :return:
     """
     num_params = 0
     for param in net.parameters():
         num_params += param.numel()
-    print(net)
+    if inputs is None:
+        print(net)
+    else:
+        from utils import model_analyzer
+        analyzer = model_analyzer.analyze(lambda: net(*inputs), net, backward=backward)
+        print(model_analyzer.format_table(analyzer.rows(sort=sort, depth=depth), top))
     print('Total number of parameters: %d' % num_params)
 
 
@@ -196,7 +338,7 @@ def setup_loss(hypes):
     """
     criterion = {}
     for name, value in hypes['train_params']['loss'].items():
-        loss_func = getattr(loss, name)(value['args'])
+        loss_func = loss.create_loss(name, value['args'])
         if hypes['train_params']['use_gpu']:
             loss_func.cuda()
         criterion[name] = loss_func
@@ -204,7 +346,7 @@ def setup_loss(hypes):
     if 'intermediate' in hypes['train_params']:
         for name, value in hypes['train_params']['intermediate'][
             'loss'].items():
-            loss_func = getattr(loss, name)(value['args'])
+            loss_func = loss.create_loss(name, value['args'])
             if hypes['train_params']['use_gpu']:
                 loss_func.cuda()
             criterion['intermediate_' + name] = loss_func
@@ -223,7 +365,7 @@ def setup_gan_loss(hypes, dis=False):
     if not dis:
         criterion = setup_loss(hypes)
     for name, value in hypes['gan']['loss'].items():
-        loss_func = getattr(loss, name)(value['args'])
+        loss_func = loss.create_loss(name, value['args'])
         if hypes['train_params']['use_gpu']:
             loss_func.cuda()
         criterion.update({name: loss_func})
@@ -249,6 +391,24 @@ def setup_optimizer(method, model):
         return optimizer_method(model.parameters(), lr=method_dict['lr'])
 
 
+def findLastCheckpoint(save_dir):
+    """
+    Latest epoch of the *epoch*.pth checkpoints of a folder
+    :param save_dir: model saved path
+    :return: epoch number, 0 if there is no checkpoint
+    """
+    file_list = glob.glob(os.path.join(save_dir, '*epoch*.pth'))
+    if file_list:
+        epochs_exist = []
+        for file_ in file_list:
+            result = re.findall(".*epoch(.*).pth.*", file_)
+            epochs_exist.append(int(result[0]))
+        initial_epoch_ = max(epochs_exist)
+    else:
+        initial_epoch_ = 0
+    return initial_epoch_
+
+
 def load_saved_model(saved_path, model):
     """
     Load saved model if exiseted
@@ -259,18 +419,6 @@ def load_saved_model(saved_path, model):
     if not os.path.exists(saved_path):
         raise ValueError('{} not found'.format(saved_path))
 
-    def findLastCheckpoint(save_dir):
-        file_list = glob.glob(os.path.join(save_dir, '*epoch*.pth'))
-        if file_list:
-            epochs_exist = []
-            for file_ in file_list:
-                result = re.findall(".*epoch(.*).pth.*", file_)
-                epochs_exist.append(int(result[0]))
-            initial_epoch_ = max(epochs_exist)
-        else:
-            initial_epoch_ = 0
-        return initial_epoch_
-
     initial_epoch = findLastCheckpoint(saved_path)
     if initial_epoch > 0:
         print('resuming by loading epoch %d' % initial_epoch)
@@ -346,9 +494,10 @@ def log_images_crack(input_l, gt_l, writer, model, epoch):
     return writer
 
 
+@torch.inference_mode()
 def val_eval(model, att_model, loader_val, writer, opt, epoch, crack_net):
     """
-    evaluate on validation dataset
+    evaluate on validation dataset, nothing is trained so the crack net and the model run without autograd
     :param epoch:  current training epoch
     :param model:  trained model
     :param loader_val:  pytorch data loader for validaion dataset
@@ -0,0 +1,259 @@
+"""
+Functions for colorizing old photos with a trained model
+"""
+import os
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from skimage.color import rgb2lab
+
+from utils import feature_pool, helper, reference_index, runtime, weight_store
+from utils.result_cache import ResultCache, cache_key, model_digest
+from models.customized_layers import guided_upsample
+from utils.color_space_convert import lab_to_rgb
+from datasets.customized_transform import rgbtolab
+
+
+def prepare_image_pair(input_image, ref_image):
+    """
+    Convert the decoded gray input image and color reference image to model inputs
+    :param input_image: gray uint8 array, (H, W)
+    :param ref_image: rgb uint8 array, (H, W, 3)
+    :return: input_image, input_L, ref_ab, ref_gray, each one has shape (1, C, H, W)
+    """
+    input_image, input_l = rgbtolab(input_image)
+
+    # the reference has to share the input size for the correlation in warpnet
+    ref_image = cv2.resize(ref_image, (input_image.shape[2], input_image.shape[1]))
+
+    ref_gray = cv2.cvtColor(ref_image, cv2.COLOR_RGB2GRAY)
+    ref_gray = np.asarray(ref_gray[np.newaxis], dtype=np.float32) / 255.
+    ref_ab = rgb2lab(ref_image).astype("float32")[:, :, 1:] / 110.
+    ref_ab = ref_ab.transpose((2, 0, 1))
+
+    return torch.from_numpy(input_image).unsqueeze(0), \
+        torch.from_numpy(input_l).unsqueeze(0), \
+        torch.from_numpy(ref_ab).unsqueeze(0), \
+        torch.from_numpy(ref_gray).unsqueeze(0)
+
+
+def read_image_pair(input_path, ref_path):
+    """
+    Read the input image as gray and the reference image as rgb
+    :return: input_image(H, W), ref_image(H, W, 3) uint8 arrays
+    """
+    input_image = cv2.imread(input_path, 0)
+    ref_image = cv2.cvtColor(cv2.imread(ref_path), cv2.COLOR_BGR2RGB)
+    return input_image, ref_image
+
+
+def load_image_pair(input_path, ref_path):
+    """
+    Read the gray input image and the color reference image and convert them to model inputs
+    :param input_path: path to the input old photo
+    :param ref_path: path to the reference image
+    :return: input_image, input_L, ref_ab, ref_gray, each one has shape (1, C, H, W)
+    """
+    return prepare_image_pair(*read_image_pair(input_path, ref_path))
+
+
+def current_store(model_dir):
+    """
+    Manifest of the weight store of a model folder, None if there is no store or if the checkpoint
+    it was converted from is out of date, see weight_store.stale_reason
+    """
+    if not weight_store.has_store(model_dir):
+        return None
+    manifest = weight_store.read_manifest(model_dir)
+    reason = weight_store.stale_reason(model_dir, manifest)
+    if reason:
+        print('the weight store of %s is out of date(%s), loading the checkpoint. '
+              'Run python -m utils.weight_store --model_dir %s to update the store'
+              % (model_dir, reason, model_dir))
+        return None
+    return manifest
+
+
+def load_models(hypes, model_dir, crack_dir=None, use_gpu=False):
+    """
+    Create the colorization model, the attention model and optionally the crack net, then
+    load their trained weights. Folders converted with utils.weight_store are memory mapped, unless
+    the store is older than their latest checkpoint.
+    :param hypes: config yaml dictionary
+    :param model_dir: saved colorization model path
+    :param crack_dir: saved crack net path
+    :param use_gpu: whether use gpu
+    :return: model, att_model, crack_net(None if crack_dir is not given)
+    """
+    manifest = current_store(model_dir)
+    if manifest is not None:
+        model = weight_store.load_module(model_dir, 'net', lambda: helper.create_model(hypes),
+                                         manifest=manifest)
+        # the store loads without network access, the attention model is not downloaded
+        if 'att' not in manifest['entries']:
+            raise ValueError('the weight store of %s has no attention model, run python -m utils.weight_store '
+                             '--model_dir %s without --crack' % (model_dir, model_dir))
+        att_model = weight_store.load_module(model_dir, 'att',
+                                             lambda: helper.create_att_model(pretrained=False),
+                                             manifest=manifest)
+    else:
+        att_model = feature_pool.get('resnet34_attention')
+        model = helper.create_model(hypes)
+        _, model = helper.load_saved_model(model_dir, model)
+    model.eval()
+
+    crack_net = None
+    if crack_dir:
+        crack_manifest = current_store(crack_dir)
+        if crack_manifest is not None:
+            crack_net = weight_store.load_module(crack_dir, 'net',
+                                                 lambda: helper.create_model(hypes, crack=True),
+                                                 manifest=crack_manifest)
+        else:
+            crack_net = helper.create_model(hypes, crack=True)
+            _, crack_net = helper.load_saved_model(crack_dir, crack_net)
+        crack_net.eval()
+
+    if use_gpu:
+        att_model.cuda()
+        model.cuda()
+        if crack_net is not None:
+            crack_net.cuda()
+
+    return model, att_model, crack_net
+
+
+def setup_models(opt, hypes, use_gpu=False):
+    """
+    Apply the cpu runtime settings, load the models, compile and warm them up
+    :param opt: arg parse with model_dir and optionally crack_dir, runtime_yaml and process_index
+    :param hypes: config yaml dictionary
+    :param use_gpu: whether use gpu
+    :return: model, att_model, crack_net
+    """
+    runtime_params = runtime.load_runtime(hypes, getattr(opt, 'runtime_yaml', None))
+    runtime.apply_runtime(runtime_params, getattr(opt, 'process_index', 0))
+
+    model, att_model, crack_net = load_models(hypes, opt.model_dir, getattr(opt, 'crack_dir', None), use_gpu)
+    # torch.compile the model if required
+    model = helper.compile_model(model, hypes)
+    return runtime.prepare_models(runtime_params, model, att_model, crack_net, use_gpu)
+
+
+def low_resolution_size(height, width, chroma_scale):
+    """
+    Size of the downscaled model input, kept divisible by 32
+    """
+    return max(32, height // chroma_scale // 32 * 32), max(32, width // chroma_scale // 32 * 32)
+
+
+def predict_ab(model, att_model, input_image, input_l, ref_ab, ref_gray, crack_net=None, chroma_scale=1):
+    """
+    Predict the ab channels of the input
+    :param model: colorization model
+    :param att_model: pretrained resnet34
+    :param input_image: gray input, (N, 1, H, W)
+    :param input_l: L channel of the input, (N, 1, H, W)
+    :param ref_ab: ab channels of the reference, (N, 2, H, W)
+    :param ref_gray: gray reference, (N, 1, H, W)
+    :param crack_net: restore the L channel first if given
+    :param chroma_scale: run the model on a 1/chroma_scale input and upsample the predicted ab
+                         with a guided filter driven by the full resolution L
+    :return: L channel(restored if crack_net is given), predicted ab
+    """
+    # inputs in the memory format of the weights, see runtime.prepare_models
+    to_format = lambda x: runtime.to_memory_format(model, x)
+    with torch.no_grad():
+        if crack_net is not None:
+            input_l = crack_net(runtime.to_memory_format(crack_net, input_l))['output']
+
+        if chroma_scale > 1:
+            size = low_resolution_size(input_l.shape[2], input_l.shape[3], chroma_scale)
+            input_l_lr = F.interpolate(input_l, size=size, mode='area')
+            out_dict = model(to_format(input_l_lr),
+                             to_format(F.interpolate(input_image, size=size, mode='area')),
+                             to_format(F.interpolate(ref_ab, size=size, mode='area')),
+                             to_format(F.interpolate(ref_gray, size=size, mode='area')),
+                             att_model)
+            output = guided_upsample(input_l_lr, out_dict['output'], input_l)
+        else:
+            output = model(to_format(input_l), to_format(input_image), to_format(ref_ab), to_format(ref_gray),
+                           att_model)['output']
+        output = torch.clamp(output, -1., 1.)
+
+    return input_l, output
+
+
+def colorize(model, att_model, input_image, input_l, ref_ab, ref_gray, crack_net=None, chroma_scale=1):
+    """
+    Predict the ab channels of the input and convert the result to rgb, see predict_ab
+    :return: rgb image tensor on cpu, (N, 3, H, W)
+    """
+    return lab_to_rgb(*predict_ab(model, att_model, input_image, input_l, ref_ab, ref_gray,
+                                  crack_net, chroma_scale))
+
+
+def create_result_cache(opt, hypes, model, crack_net=None):
+    """
+    Create the result cache and the part of the cache key shared by all the requests
+    :param opt: arg parse with cache_dir, cache_size_mb and chroma_scale
+    :param hypes: config yaml dictionary
+    :return: ResultCache and the key arguments, (None, None) if cache_dir is not given
+    """
+    if not getattr(opt, 'cache_dir', None):
+        return None, None
+    cache = ResultCache(opt.cache_dir, int(opt.cache_size_mb * 1024 * 1024))
+    key_args = {'model_hash': model_digest(model),
+                'crack_hash': model_digest(crack_net),
+                'settings': {'arch': hypes['arch'], 'chroma_scale': opt.chroma_scale}}
+    return cache, key_args
+
+
+def test(opt, hypes, use_gpu=False):
+    """
+    Colorize a single image with the trained model and save it under the model folder
+    :param opt: arg parse
+    :param hypes: config yaml dictionary
+    :param use_gpu: whether use gpu
+    :return: rgb output tensor
+    """
+    model, att_model, crack_net = setup_models(opt, hypes, use_gpu)
+
+    cache, key_args = create_result_cache(opt, hypes, model, crack_net)
+
+    ref_path = opt.ref_path
+    if not ref_path:
+        # pick the most similar photo of the reference library
+        index = reference_index.ReferenceIndex.load(opt.ref_index)
+        ref_path, score = reference_index.select_references(index, att_model,
+                                                            [cv2.imread(opt.input_path, 0)], k=1)[0][0]
+        print('reference %s selected, similarity %.4f' % (ref_path, score))
+
+    input_pixels, ref_pixels = read_image_pair(opt.input_path, ref_path)
+    input_image, input_l, ref_ab, ref_gray = prepare_image_pair(input_pixels, ref_pixels)
+
+    cached = None
+    if cache is not None:
+        key = cache_key(input_pixels, ref_pixels, **key_args)
+        cached = cache.get(key)
+
+    if cached is not None:
+        ab, restored_l = cached
+        output = lab_to_rgb(input_l if restored_l is None else restored_l, ab)
+    else:
+        if use_gpu:
+            input_image, input_l = input_image.cuda(), input_l.cuda()
+            ref_ab, ref_gray = ref_ab.cuda(), ref_gray.cuda()
+        l_channel, ab = predict_ab(model, att_model, input_image, input_l, ref_ab, ref_gray, crack_net,
+                                   chroma_scale=opt.chroma_scale)
+        if cache is not None:
+            cache.put(key, ab, l_channel if crack_net is not None else None)
+        output = lab_to_rgb(l_channel, ab)
+
+    image_name = os.path.splitext(os.path.basename(opt.input_path))[0]
+    helper.write_test(output, opt.model_dir, image_name)
+
+    return output
@@ -1,17 +1,16 @@
 """
-Loss functions
+Loss functions. Heavy dependencies(vgg16 weights, lpips, skimage) are imported by the loss that
+needs them, so importing this module for inference or a data loader worker stays cheap. The
+pretrained backbones come from utils.feature_pool and are shared by all the loss terms.
 """
-from fastai.torch_core import *
-from fastai.callbacks import hook_outputs
-
 import numpy as np
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from utils.ssim import SSIM
-import torchvision.models as models
-from skimage.metrics import peak_signal_noise_ratio as compare_psnr
 
 from models import networks
-from utils.lpips_pytorch import LPIPS, lpips
+from utils import feature_pool
 from utils.color_space_convert import RgbToHsv, RgbToYuv
 
 
@@ -24,38 +23,33 @@ class PerceptualLoss(nn.Module):
 
     def __init__(self, layer_wgts=[10, 20, 70, 10]):
         super().__init__()
-
-        self.m_feat = models.vgg16_bn(pretrained=True).features.cuda().eval()
-        requires_grad(self.m_feat, False)
+        # the vgg16_bn is shared through the pool, not a submodule of the loss
+        extractor = feature_pool.get('vgg16_bn')
 
         blocks = [
             i - 1
-            for i, o in enumerate(children(self.m_feat))
+            for i, o in enumerate(extractor.layers.children())
             if isinstance(o, nn.MaxPool2d)
         ]
 
-        layer_ids = blocks[2:5]
-        self.loss_features = [self.m_feat[i] for i in layer_ids]
-        self.hooks = hook_outputs(self.loss_features, detach=False)
+        self.layer_ids = blocks[2:5]
+        extractor.request(self.layer_ids)
         self.wgts = layer_wgts[1:]
-        self.metric_names = ['pixel'] + [f'feat_{i}' for i in range(len(layer_ids))]
+        self.metric_names = ['pixel'] + [f'feat_{i}' for i in range(len(self.layer_ids))]
         self.base_loss = F.l1_loss
         self.base_weight = layer_wgts[0]
         self.feat_losses = None
         self.metrics = None
 
-    def _make_features(self, x, clone=False):
-        self.m_feat(x)
-        return [(o.clone() if clone else o) for o in self.hooks.stored]
-
     def forward(self, input, target):
+        extractor = feature_pool.get('vgg16_bn')
+        out_feat = extractor(target, self.layer_ids, target=True)
+        in_feat = extractor(input, self.layer_ids)
+
         if input.shape[1] == 1:
             input = input.repeat(1, 3, 1, 1)
         if target.shape[1] == 1:
             target = target.repeat(1, 3, 1, 1)
-
-        out_feat = self._make_features(target, clone=True)
-        in_feat = self._make_features(input)
         self.feat_losses = [self.base_weight * self.base_loss(input, target)]
         self.feat_losses += [
             self.base_loss(f_in, f_out) * w
@@ -64,9 +58,6 @@ class PerceptualLoss(nn.Module):
         self.metrics = dict(zip(self.metric_names, self.feat_losses))
         return sum(self.feat_losses)
 
-    def __del__(self):
-        self.hooks.remove()
-
 
 class WassersteinLoss(nn.Module):
     """
@@ -131,18 +122,30 @@ class HistogramLoss(nn.Module):
         super().__init__()
         self.creterion = EarthMoverDisteLoss()
         self.histlayer = networks.GaussianHistogram(bins=256, min=0, max=1, sigma=0.01)
+        # the target histograms only depend on the histogram layer, see LossEngine
+        self.stats_key = ('histogram', self.histlayer.bins, self.histlayer.min, self.histlayer.max,
+                          float(self.histlayer.sigma))
 
-    def forward(self, input, target):
-        channels = input.shape[1]
-        losses = []
-        for i in range(channels):
-            input_channel = torch.flatten(input[:, i, :, :], start_dim=1, end_dim=-1)
-            target_channel = torch.flatten(target[:, i, :, :], start_dim=1, end_dim=-1)
+    def histograms(self, x):
+        """
+        Normalized gaussian histograms of every channel
+        :param x: (N, C, H, W)
+        :return: (N, C, bins)
+        """
+        return torch.stack([self.histlayer(torch.flatten(x[:, i, :, :], start_dim=1, end_dim=-1))[0]
+                            for i in range(x.shape[1])], dim=1)
 
-            input_hist, _ = self.histlayer(input_channel)
-            target_hist, _ = self.histlayer(target_channel)
-            losses.append(self.creterion(input_hist, target_hist))
+    def target_stats(self, target):
+        """
+        Histograms of the target, to be shared by several histogram terms
+        """
+        with torch.no_grad():
+            return self.histograms(target)
 
+    def forward(self, input, target, target_stats=None):
+        input_hist = self.histograms(input)
+        target_hist = self.target_stats(target) if target_stats is None else target_stats
+        losses = [self.creterion(input_hist[:, i], target_hist[:, i]) for i in range(input.shape[1])]
         return sum(losses)
 
 
@@ -155,12 +158,14 @@ def histogram(args):
     return HistogramLoss()
 
 
-def lipis_eval(net_type='alex'):
+def lipis_eval(args=None):
     """
     LIPIS metric
-    :param net_type: supported: alexnet, vgg16 and squeezenet
+    :param args: net_type, supported: alex(default), vgg and squeeze
     :return:
     """
+    from utils.lpips_pytorch import LPIPS
+    net_type = args.get('net_type', 'alex') if args else 'alex'
     return LPIPS(net_type=net_type, version='0.1')
 
 
@@ -207,6 +212,30 @@ def l1(args=None):
     return nn.L1Loss()
 
 
+# loss name in the yaml file -> factory, the factories import their own dependencies
+LOSS_REGISTRY = {
+    'histogram': histogram,
+    'lipis_eval': lipis_eval,
+    'wasserstein': wasserstein,
+    'perceptual': perceptual,
+    'ssim': ssim,
+    'mse': mse,
+    'l1': l1,
+}
+
+
+def create_loss(name, args=None):
+    """
+    Create a loss function by its yaml name
+    :param name: key of LOSS_REGISTRY
+    :param args: loss arguments in the yaml file
+    :return:
+    """
+    if name not in LOSS_REGISTRY:
+        raise ValueError('unknown loss %s, supported: %s' % (name, ', '.join(sorted(LOSS_REGISTRY))))
+    return LOSS_REGISTRY[name](args)
+
+
 def intermediate_loss(hypes, layer, loss_func, predict_batch, target_batch):
     """
     Calculate the intermediate loss based on loss name
@@ -217,40 +246,155 @@ def intermediate_loss(hypes, layer, loss_func, predict_batch, target_batch):
     :param target_batch:  target output
     :return:
     """
-    if not hypes['color_pretrain']['flag']:
-        downsampled_target_batch = F.interpolate(target_batch,
-                                                 scale_factor=1 / hypes['arch']['args']['scale'],
-                                                 mode='bicubic')
-    else:
-        downsampled_target_batch = target_batch
+    engine = cached_engine(hypes)
+    step = StepTransforms()
+    predict_layer = engine.project(step, layer, predict_batch)
+    if predict_layer is None:
+        return None
+    return engine.term_loss(step, loss_func, predict_layer,
+                            engine.project(step, layer, engine.downsample(step, target_batch)))
+
+
+class StepTransforms(object):
+    """
+    Memoized transforms of the tensors of one training step, e.g. the downsampled target, its color
+    space conversions and the target statistics of the losses
+    """
+
+    def __init__(self):
+        # key -> (tensors the value was computed from, value), the tensors keep their ids valid
+        self.values = {}
+
+    def get(self, key, tensors, func):
+        key = key + tuple(id(tensor) for tensor in tensors)
+        if key not in self.values:
+            self.values[key] = (tensors, func())
+        return self.values[key][1]
+
+
+class LossEngine(object):
+    """
+    All the loss terms of the yaml planned once: the final output terms and the intermediate terms of
+    every layer. Per step, the transforms shared by several terms (downsampled target, gray/hsv/yuv
+    projections, target statistics such as the ssim local moments and the target histograms) are
+    computed once, and the weighted sum is returned with the value of every term.
+    Args:
+        hypes: yaml dict
+        criterion: dictionary of all loss functions, see helper.setup_loss
+    """
+
+    def __init__(self, hypes, criterion):
+        self.hypes = hypes
+        loss_param = hypes['train_params']['loss']
+        # (name, weight, loss function, reversed like ssim)
+        self.terms = [(name, loss_param[name]['weight'], loss_func, name == 'ssim')
+                      for name, loss_func in criterion.items() if name in loss_param]
+
+        self.intermediate_terms = []
+        if 'intermediate' in hypes['train_params']:
+            intermediate_dict = hypes['train_params']['intermediate']
+            for layer in intermediate_dict['layer']:
+                for name, loss_func in criterion.items():
+                    if 'intermediate' not in name:
+                        continue
+                    func_origin_name = name.replace('intermediate_', '')
+                    self.intermediate_terms.append(('%s_%s' % (name, layer), layer,
+                                                    intermediate_dict['loss'][func_origin_name]['weight'],
+                                                    loss_func, func_origin_name == 'ssim'))
+        self.hsv = RgbToHsv()
+        self.yuv = RgbToYuv()
+
+    def downsample(self, step, target_batch):
+        """
+        Target at the size of the intermediate output
+        """
+        if self.hypes['color_pretrain']['flag']:
+            return target_batch
+        scale = self.hypes['arch']['args']['scale']
+        return step.get(('downsample',), (target_batch,),
+                        lambda: F.interpolate(target_batch, scale_factor=1 / scale, mode='bicubic'))
+
+    def project(self, step, layer, batch):
+        """
+        The channels an intermediate layer is compared on: rgb, gray, hs of hsv or uv of yuv
+        """
+        if 'rgb' in layer:
+            return batch
+        if 'gray' in layer:
+            return step.get(('gray',), (batch,), lambda: torch.mean(batch, dim=1).unsqueeze(dim=1))
+        if 'hsv' in layer:
+            return step.get(('hsv',), (batch,), lambda: self.hsv(batch)[:, :2, :, :])
+        if 'yuv' in layer:
+            return step.get(('yuv',), (batch,), lambda: self.yuv(batch)[:, 1:, :, :])
+        return None
+
+    def term_loss(self, step, loss_func, predict_batch, target_batch):
+        """
+        One loss term, with the shared target statistics when the loss has some
+        """
+        if hasattr(loss_func, 'target_stats') and not target_batch.requires_grad:
+            target_stats = step.get(loss_func.stats_key, (target_batch,),
+                                    lambda: loss_func.target_stats(target_batch))
+            return loss_func(predict_batch, target_batch, target_stats=target_stats)
+        return loss_func(predict_batch, target_batch)
 
-    if 'rgb' in layer:
-        return loss_func(predict_batch, downsampled_target_batch)
+    def __call__(self, predict_dict, target_batch):
+        """
+        :param predict_dict: prediction dictionary
+        :param target_batch: groundtruth
+        :return: weighted sum of all the terms, dictionary of the detached term values
+        """
+        step = StepTransforms()
+        final_loss = target_batch.new_zeros(())
+        values = {}
+        predict_batch = predict_dict['output']
+        for name, weight, loss_func, reverse in self.terms:
+            current_loss = self.term_loss(step, loss_func, predict_batch, target_batch)
+            # ssim need to be reversed
+            if reverse:
+                current_loss = 1 - current_loss
+            values[name] = current_loss.detach()
+            final_loss = final_loss + weight * current_loss
+
+        if self.intermediate_terms:
+            predict_batch = predict_dict['aux']
+            downsampled_target_batch = self.downsample(step, target_batch)
+        for name, layer, weight, loss_func, reverse in self.intermediate_terms:
+            predict_layer = self.project(step, layer, predict_batch)
+            if predict_layer is None:
+                continue
+            term = self.term_loss(step, loss_func, predict_layer, self.project(step, layer, downsampled_target_batch))
+            values[name] = (1 - term if reverse else term).detach()
+            current_loss = weight * term
+            if reverse:
+                current_loss = weight - current_loss
+            final_loss = final_loss + current_loss
+        return final_loss, values
 
-    if 'gray' in layer:
-        downsampled_target_batch = torch.mean(downsampled_target_batch, dim=1)
-        downsampled_target_batch = downsampled_target_batch.unsqueeze(dim=1)
 
-        predict_batch = torch.mean(predict_batch, dim=1)
-        predict_batch = predict_batch.unsqueeze(dim=1)
-        return loss_func(predict_batch, downsampled_target_batch)
+# (id(hypes), id(criterion)) -> (hypes, criterion, engine), the references keep the ids valid
+_ENGINES = {}
 
-    if 'hsv' in layer:
-        hsv = RgbToHsv()
-        downsampled_target_batch_hsv = hsv(downsampled_target_batch)
-        predict_batch_hsv = hsv(predict_batch)
-        return loss_func(predict_batch_hsv[:, :2, :, :], downsampled_target_batch_hsv[:, :2, :, :])
 
-    if 'yuv' in layer:
-        yuv = RgbToYuv()
-        downsampled_target_batch_yuv = yuv(downsampled_target_batch)
-        predict_batch_yuv = yuv(predict_batch)
-        return loss_func(predict_batch_yuv[:, 1:, :, :], downsampled_target_batch_yuv[:, 1:, :, :])
+def cached_engine(hypes, criterion=None):
+    """
+    The LossEngine of the hypes and criterion, built on the first call. The yaml is not expected to
+    change between the calls
+    :param criterion: dictionary of all loss functions, None for the intermediate projections only
+    :return: LossEngine
+    """
+    key = (id(hypes), id(criterion))
+    if key not in _ENGINES:
+        if len(_ENGINES) >= 8:
+            _ENGINES.clear()
+        _ENGINES[key] = (hypes, criterion, LossEngine(hypes, criterion or {}))
+    return _ENGINES[key][2]
 
 
 def loss_sum(hypes, creterion, predict_dict, target_batch, ref_batch=None):
     """
-    Sum up all loss with their weights
+    Sum up all loss with their weights, see LossEngine to keep the plan across steps and get the
+    value of every term
     :param creterion: dictionary of all loss functions
     :param hypes: yaml dict
     :param predict_dict:  prediction dictionary
@@ -258,40 +402,24 @@ def loss_sum(hypes, creterion, predict_dict, target_batch, ref_batch=None):
     :param ref_batch: reference batch
     :return:
     """
-    # final output
-    predict_batch = predict_dict['output']
-    final_loss = None
-    loss_param = hypes['train_params']['loss']
-    for name, loss_func in creterion.items():
-        if name not in loss_param:
-            continue
-        current_loss = loss_func(predict_batch, target_batch)
-        # ssim need to be reversed
-        if name == 'ssim':
-            current_loss = 1 - current_loss
-        if not final_loss:
-            final_loss = loss_param[name]['weight'] * current_loss
-        else:
-            final_loss += loss_param[name]['weight'] * current_loss
+    return cached_engine(hypes, creterion)(predict_dict, target_batch)[0]
 
-    if 'intermediate' in hypes['train_params']:
-        intermediate_dict = hypes['train_params']['intermediate']
-        for layer in intermediate_dict['layer']:
-            predict_batch = predict_dict['aux']
-            for name, loss_func in creterion.items():
-                if 'intermediate' not in name:
-                    continue
-                func_origin_name = name.replace('intermediate_', '')
-                current_loss = intermediate_dict['loss'][func_origin_name]['weight'] * \
-                               intermediate_loss(hypes,
-                                                 layer,
-                                                 loss_func,
-                                                 predict_batch,
-                                                 target_batch)
-                if func_origin_name == 'ssim':
-                    current_loss = intermediate_dict['loss'][func_origin_name]['weight'] - current_loss
-
-                final_loss += current_loss
+
+def distill_loss(hypes, student_dict, student_sim, teacher_dict, teacher_sim):
+    """
+    Distillation loss of a student colorizer: l1 to the teacher ab output and to the teacher
+    warpnet similarity maps of every level
+    :param hypes: yaml dict
+    :param student_dict: student prediction dictionary
+    :param student_sim: student warpnet output, list of (warped histogram, similarity map)
+    :param teacher_dict: teacher prediction dictionary
+    :param teacher_sim: teacher warpnet output
+    :return:
+    """
+    distill_params = hypes['distill']
+    final_loss = distill_params['output_weight'] * F.l1_loss(student_dict['output'], teacher_dict['output'])
+    for (_, student_map), (_, teacher_map) in zip(student_sim, teacher_sim):
+        final_loss += distill_params['similarity_weight'] * F.l1_loss(student_map, teacher_map)
     return final_loss
 
 
@@ -328,6 +456,8 @@ def batch_psnr(img, imclean, data_range):
     :param data_range:  maximum value
     :return:
     """
+    from skimage.metrics import peak_signal_noise_ratio as compare_psnr
+
     Img = img.data.cpu().numpy().astype(np.float32)
     Iclean = imclean.data.cpu().numpy().astype(np.float32)
     PSNR = 0
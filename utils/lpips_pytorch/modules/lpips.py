@@ -13,8 +13,11 @@ class LPIPS(nn.Module):
         net_type (str): the network type to compare the features: 
                         'alex' | 'squeeze' | 'vgg'. Default: 'alex'.
         version (str): the version of LPIPS. Default: 0.1.
+        gpu (bool): move the linear layers to cuda. Default: False, the caller moves
+                    the criterion (helper.setup_loss with use_gpu) and the pooled
+                    backbone follows the device of its inputs.
     """
-    def __init__(self, net_type: str = 'alex', version: str = '0.1', gpu: bool = True):
+    def __init__(self, net_type: str = 'alex', version: str = '0.1', gpu: bool = False):
 
         assert version in ['0.1'], 'v0.1 is only supported now'
 
@@ -31,7 +34,8 @@ class LPIPS(nn.Module):
             self.lin.cuda()
 
     def forward(self, x: torch.Tensor, y: torch.Tensor):
-        feat_x, feat_y = self.net(x), self.net(y)
+        # y is the target, its features never need gradients
+        feat_x, feat_y = self.net(x), self.net(y, target=True)
 
         diff = [(fx - fy) ** 2 for fx, fy in zip(feat_x, feat_y)]
         res = [l(d).mean((2, 3), True) for d, l in zip(diff, self.lin)]
@@ -4,8 +4,8 @@ from itertools import chain
 
 import torch
 import torch.nn as nn
-from torchvision import models
 
+from utils import feature_pool
 from .utils import normalize_activation
 
 
@@ -34,6 +34,11 @@ class LinLayers(nn.ModuleList):
 
 
 class BaseNet(nn.Module):
+    """
+    The pretrained backbone is shared through utils.feature_pool
+    """
+    backbone = None
+
     def __init__(self):
         super(BaseNet, self).__init__()
 
@@ -43,6 +48,13 @@ class BaseNet(nn.Module):
         self.register_buffer(
             'std', torch.Tensor([.458, .448, .450])[None, :, None, None])
 
+    def request_layers(self):
+        # target_layers count from 1
+        self.layer_ids = [i - 1 for i in self.target_layers]
+        feature_pool.get(self.backbone).request(self.layer_ids)
+        # z_score runs inside the pool, keyed on the tensor before the normalization
+        self.normalize = (tuple(self.mean.flatten().tolist()), tuple(self.std.flatten().tolist()))
+
     def set_requires_grad(self, state: bool):
         for param in chain(self.parameters(), self.buffers()):
             param.requires_grad = state
@@ -51,47 +63,45 @@ class BaseNet(nn.Module):
         device = x.device
         return (x - self.mean.to(device)) / self.std.to(device)
 
-    def forward(self, x: torch.Tensor):
-        x = self.z_score(x)
-
-        output = []
-        for i, (_, layer) in enumerate(self.layers._modules.items(), 1):
-            x = layer(x)
-            if i in self.target_layers:
-                output.append(normalize_activation(x))
-            if len(output) == len(self.target_layers):
-                break
-        return output
+    def forward(self, x: torch.Tensor, target: bool = False):
+        output = feature_pool.get(self.backbone)(x, self.layer_ids, target=target, normalize=self.normalize)
+        return [normalize_activation(o) for o in output]
 
 
 class SqueezeNet(BaseNet):
+    backbone = 'squeezenet1_1'
+
     def __init__(self):
         super(SqueezeNet, self).__init__()
 
-        self.layers = models.squeezenet1_1(True).features
         self.target_layers = [2, 5, 8, 10, 11, 12, 13]
         self.n_channels_list = [64, 128, 256, 384, 384, 512, 512]
 
+        self.request_layers()
         self.set_requires_grad(False)
 
 
 class AlexNet(BaseNet):
+    backbone = 'alexnet'
+
     def __init__(self):
         super(AlexNet, self).__init__()
 
-        self.layers = models.alexnet(True).features
         self.target_layers = [2, 5, 8, 10, 12]
         self.n_channels_list = [64, 192, 384, 256, 256]
 
+        self.request_layers()
         self.set_requires_grad(False)
 
 
 class VGG16(BaseNet):
+    backbone = 'vgg16'
+
     def __init__(self):
         super(VGG16, self).__init__()
 
-        self.layers = models.vgg16(True).features
         self.target_layers = [4, 9, 16, 23, 30]
         self.n_channels_list = [64, 128, 256, 512, 512]
 
+        self.request_layers()
         self.set_requires_grad(False)
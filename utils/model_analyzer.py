@@ -0,0 +1,319 @@
+"""
+Per-module cost of one forward (and optionally backward) pass: FLOPs/MACs, output activation bytes,
+peak activation memory and time of every module. Every aten op is attributed to all the modules
+running it, so custom code inside a module, e.g. the matmuls of the warpnet correspondence, the
+broadcast of GaussianHistogram or the concatenations of _DenseBlock, is counted with its module.
+
+python -m utils.model_analyzer --hypes_yaml hypes_yaml/config.yaml --size 256 --depth 3 --backward \
+    --sort time_ms --output logs/model_analysis.csv
+"""
+import argparse
+import collections
+import csv
+import json
+import time
+import weakref
+
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from torch.utils._pytree import tree_flatten
+
+# ops counted with one flop per input element, the other non matmul/conv ops count one per output
+# element if they are pointwise and nothing if they only move data (cat, view, copy, index)
+REDUCTION_OPS = ('sum', 'mean', 'amax', 'amin', 'max', 'min', 'prod', 'var', 'std', 'norm', 'logsumexp',
+                 'cumsum', '_softmax', '_log_softmax', 'native_batch_norm', '_native_batch_norm_legit',
+                 'native_layer_norm', 'native_group_norm', 'avg_pool', 'max_pool', 'adaptive_avg_pool',
+                 'upsample', 'grid_sampler', 'scatter_add', 'index_add', 'topk', 'sort')
+
+# methods running whole stages of the models outside of a module forward, e.g. the correspondence
+# of WarpNet, analyzed as their own rows named <module>.<method>()
+METHODS = ('correspond', 'reference_histogram', 'decode', 'forward_paired', 'encode', 'correlate')
+
+COLUMNS = ('module', 'calls', 'params', 'flops', 'macs', 'output_bytes', 'peak_bytes', 'time_ms',
+           'backward_flops', 'backward_peak_bytes', 'backward_time_ms')
+
+
+def _tensors(value):
+    return [item for item in tree_flatten(value)[0] if isinstance(item, torch.Tensor)]
+
+
+def op_flops(func, args, kwargs, out):
+    """
+    :return: flops and multiply-accumulates of an aten op
+    """
+    from torch.utils.flop_counter import flop_registry
+
+    packet = func.overloadpacket
+    if packet in flop_registry:
+        flops = flop_registry[packet](*args, **kwargs, out_val=out)
+        return flops, flops // 2
+    name = packet.__name__
+    if name.startswith(REDUCTION_OPS):
+        return max([t.numel() for t in _tensors((args, kwargs))] or [0]), 0
+    if torch.Tag.pointwise in func.tags:
+        return sum(t.numel() for t in _tensors(out)), 0
+    return 0, 0
+
+
+class ModelAnalyzer(TorchDispatchMode):
+    """
+    Context manager collecting the cost of every module run inside it. The module hierarchy comes from
+    torch.utils.module_tracker, a module is named by its class and attribute path, e.g.
+    DenseUnetHistogramAttention.encoder.denseblock1, modules called several times (the histogram
+    layers, the attention model) add up their calls.
+    The memory is the bytes of the tensors allocated by the ops and still alive, the inputs and
+    parameters allocated before are not counted: peak_bytes is the highest live memory during a
+    module call over the live memory when it started.
+    The time is the time of the ops run by a module, the analysis overhead is left out. The backward
+    ops are attributed to the modules of the forward op that created their autograd node.
+    Args:
+        model: the METHODS of its modules are analyzed too
+        methods: names of the analyzed methods
+        sync_cuda: synchronize cuda around every op, needed for correct gpu times
+    """
+
+    def __init__(self, model=None, methods=METHODS, sync_cuda=False):
+        super(ModelAnalyzer, self).__init__()
+        try:
+            from torch.utils.module_tracker import ModuleTracker
+        except ImportError:
+            raise ValueError('the model analyzer requires pytorch >= 2.3, but %s is installed' % torch.__version__)
+
+        self.tracker = ModuleTracker()
+        self.model = model
+        self.methods = methods
+        self.patched = []
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.stats = collections.defaultdict(lambda: collections.defaultdict(float))
+        self.params = {}
+        # storage pointer -> [bytes, number of live tensors on it]
+        self.storages = {}
+        self.tensor_storage = {}
+        self.live_bytes = 0
+        # module -> live bytes at the start of its current call
+        self.entry_bytes = {}
+        # sequence number of a backward node -> modules of its forward op
+        self.node_modules = {}
+        self.sequence_nr = None
+        self.hook = None
+
+    def __enter__(self):
+        self.tracker.__enter__()
+        self.sequence_nr = torch._C._autograd._get_sequence_nr()
+        self.hook = torch.nn.modules.module.register_module_forward_hook(self._forward_hook)
+        if self.model is not None:
+            for module in self.model.modules():
+                for method in self.methods:
+                    if callable(getattr(module, method, None)):
+                        setattr(module, method, self._scoped(module, method, getattr(module, method)))
+                        self.patched.append((module, method))
+        return super(ModelAnalyzer, self).__enter__()
+
+    def __exit__(self, *args):
+        super(ModelAnalyzer, self).__exit__(*args)
+        # the instance attributes hide the class methods
+        for module, method in self.patched:
+            delattr(module, method)
+        self.patched = []
+        self.hook.remove()
+        self.tracker.__exit__(*args)
+
+    def _scoped(self, module, method, func):
+        # run the method as a scope of the module hierarchy
+        def run(*args, **kwargs):
+            name = '%s.%s()' % (self.tracker._get_mod_name(module), method)
+            if name in self.tracker.parents:
+                return func(*args, **kwargs)
+            self.tracker.parents.add(name)
+            try:
+                output = func(*args, **kwargs)
+            finally:
+                self.tracker.parents.discard(name)
+            self.stats[name]['calls'] += 1
+            self.stats[name]['output_bytes'] += sum(t.numel() * t.element_size() for t in _tensors(output))
+            return output
+        return run
+
+    def _forward_hook(self, module, inputs, output):
+        # the tracker has named the module in its pre hook
+        name = self.tracker._get_mod_name(module)
+        self.stats[name]['calls'] += 1
+        self.stats[name]['output_bytes'] += sum(t.numel() * t.element_size() for t in _tensors(output))
+        if name not in self.params:
+            self.params[name] = sum(p.numel() for p in module.parameters())
+
+    def _release(self, tensor_id):
+        key = self.tensor_storage.pop(tensor_id)
+        self.storages[key][1] -= 1
+        if self.storages[key][1] == 0:
+            self.live_bytes -= self.storages.pop(key)[0]
+
+    def _track(self, out):
+        for tensor in _tensors(out):
+            if id(tensor) in self.tensor_storage or tensor.device.type == 'meta':
+                continue
+            storage = tensor.untyped_storage()
+            if storage.nbytes() == 0:
+                continue
+            key = (tensor.device, storage.data_ptr())
+            if key not in self.storages:
+                self.storages[key] = [storage.nbytes(), 0]
+                self.live_bytes += storage.nbytes()
+            self.storages[key][1] += 1
+            self.tensor_storage[id(tensor)] = key
+            weakref.finalize(tensor, self._release, id(tensor))
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        if self.tracker.is_bw:
+            node = torch._C._current_autograd_node()
+            parents = self.node_modules.get(node._sequence_nr(), set()) if node is not None else set()
+            prefix = 'backward_'
+        else:
+            parents = set(self.tracker.parents) - {'Global'}
+            prefix = ''
+            # autograd numbers the backward node of an op before running it, the backward ops of the
+            # node are attributed to the modules of the forward op
+            sequence_nr = torch._C._autograd._get_sequence_nr()
+            if sequence_nr != self.sequence_nr:
+                self.node_modules[sequence_nr - 1] = parents
+                self.sequence_nr = sequence_nr
+        # the modules entered since the last op start at the current live memory
+        for name in set(self.entry_bytes) - parents:
+            del self.entry_bytes[name]
+        for name in parents - set(self.entry_bytes):
+            self.entry_bytes[name] = self.live_bytes
+
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = func(*args, **kwargs)
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        seconds = time.perf_counter() - start
+
+        flops, macs = op_flops(func, args, kwargs, out)
+        self._track(out)
+        for name in parents:
+            stats = self.stats[name]
+            stats[prefix + 'flops'] += flops
+            stats[prefix + 'time_ms'] += 1000 * seconds
+            if not prefix:
+                stats['macs'] += macs
+            stats[prefix + 'peak_bytes'] = max(stats[prefix + 'peak_bytes'], self.live_bytes - self.entry_bytes[name])
+        return out
+
+    def rows(self, sort='flops', depth=None):
+        """
+        :param sort: column to sort by, descending
+        :param depth: only keep the modules up to this depth, 0 is the root model
+        :return: list of dicts with the COLUMNS keys
+        """
+        if sort not in COLUMNS:
+            raise ValueError('unknown sort column %s, supported: %s' % (sort, ', '.join(COLUMNS)))
+        rows = []
+        for name, stats in self.stats.items():
+            if depth is not None and name.count('.') > depth:
+                continue
+            row = {column: stats.get(column, 0) if 'time' in column else int(stats.get(column, 0))
+                   for column in COLUMNS[1:]}
+            row['params'] = self.params.get(name, 0)
+            row['module'] = name
+            rows.append(row)
+        return sorted(rows, key=lambda row: row[sort], reverse=sort != 'module')
+
+
+def format_table(rows, top=None):
+    """
+    Text table of the rows, flops in G and bytes in MB
+    """
+    lines = ['%-60s %6s %9s %10s %10s %10s %10s %10s %10s %10s' % (
+        'module', 'calls', 'params M', 'GFLOPs', 'GMACs', 'out MB', 'peak MB', 'ms', 'bw GFLOPs', 'bw ms')]
+    for row in rows[:top]:
+        lines.append('%-60s %6d %9.3f %10.3f %10.3f %10.2f %10.2f %10.2f %10.3f %10.2f' % (
+            row['module'][-60:], row['calls'], row['params'] / 1e6, row['flops'] / 1e9, row['macs'] / 1e9,
+            row['output_bytes'] / 1024 ** 2, row['peak_bytes'] / 1024 ** 2, row['time_ms'],
+            row['backward_flops'] / 1e9, row['backward_time_ms']))
+    return '\n'.join(lines)
+
+
+def write_report(rows, path):
+    """
+    Save the rows as csv, or as json if the path ends with .json
+    """
+    if path.endswith('.json'):
+        with open(path, 'w') as f:
+            json.dump(rows, f, indent=2)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def analyze(forward, model=None, backward=False, sync_cuda=False):
+    """
+    Run forward(), and a backward of the mean of its output, under the analyzer
+    :param forward: function calling the model, returning a tensor or the model output dict
+    :param model: analyze the METHODS of its modules too
+    :param backward: also analyze the backward pass
+    :param sync_cuda: synchronize cuda around every op
+    :return: ModelAnalyzer holding the stats
+    """
+    analyzer = ModelAnalyzer(model, sync_cuda=sync_cuda)
+    with analyzer:
+        with torch.set_grad_enabled(backward):
+            output = forward()
+            if backward:
+                output = output['output'] if isinstance(output, dict) else output
+                output.float().mean().backward()
+    return analyzer
+
+
+def main():
+    from hypes_yaml import yaml_utils
+    from utils import helper
+
+    parser = argparse.ArgumentParser(description="per module FLOPs, memory and time of a model")
+    parser.add_argument('--hypes_yaml', type=str, default='hypes_yaml/config.yaml')
+    parser.add_argument('--model_dir', type=str, default='', help='analyze the model of a trained folder')
+    parser.add_argument('--crack', action='store_true', help='analyze the crack net')
+    parser.add_argument('--size', type=int, default=256)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--backward', action='store_true')
+    parser.add_argument('--sort', type=str, default='flops', choices=COLUMNS)
+    parser.add_argument('--depth', type=int, default=None, help='deepest module level shown, 0 is the model')
+    parser.add_argument('--top', type=int, default=40, help='printed rows, the output file has all of them')
+    parser.add_argument('--output', type=str, default='', help='csv or json report')
+    parser.add_argument('--use_gpu', action='store_true')
+    opt = parser.parse_args()
+
+    hypes = yaml_utils.load_yaml(opt.hypes_yaml if not opt.model_dir else None, opt)
+    device = 'cuda' if opt.use_gpu else 'cpu'
+    torch.manual_seed(0)
+    # the weights do not change the costs, no pretrained download
+    model = helper.create_model(hypes, crack=opt.crack).to(device)
+    input_l = torch.rand(opt.batch_size, 1, opt.size, opt.size, device=device) * 2 - 1
+    if opt.crack:
+        forward = lambda: model(input_l)
+    else:
+        att_model = helper.create_att_model(pretrained=False).to(device)
+        input_image = torch.rand(opt.batch_size, 1, opt.size, opt.size, device=device)
+        ref_ab = (torch.rand(opt.batch_size, 2, opt.size, opt.size, device=device) * 2 - 1) * 0.5
+        ref_gray = torch.rand(opt.batch_size, 1, opt.size, opt.size, device=device)
+        forward = lambda: model(input_l, input_image, ref_ab, ref_gray, att_model)
+    model.train(opt.backward)
+
+    # warm up the kernels and allocators first
+    with torch.no_grad():
+        forward()
+    analyzer = analyze(forward, model, backward=opt.backward, sync_cuda=opt.use_gpu)
+    rows = analyzer.rows(sort=opt.sort, depth=opt.depth)
+    print(format_table(rows, opt.top))
+    if opt.output:
+        write_report(rows, opt.output)
+        print('report written to %s' % opt.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,11 +19,65 @@ def test_parser():
     parser.add_argument('--model_dir', type=str, required=True, help='model path')
     parser.add_argument('--input_path', type=str, required=True,
                         help='path to input image')
-    parser.add_argument('--ref_path', type=str, required=True,
-                        help='path to ref image')
+    reference = parser.add_mutually_exclusive_group(required=True)
+    reference.add_argument('--ref_path', type=str, default='',
+                           help='path to ref image')
+    reference.add_argument('--ref_index', type=str, default='',
+                           help='pick the best reference from this index(utils/reference_index.py)')
     parser.add_argument('--crack_dir', type=str, help='crack net path')
     parser.add_argument('--real_test', action='store_true')
+    parser.add_argument('--chroma_scale', type=int, default=1,
+                        help='predict ab at 1/chroma_scale resolution and upsample it guided by the full '
+                             'resolution L, e.g. 2 or 4 for faster inference')
+    parser.add_argument('--cache_dir', type=str, default='',
+                        help='reuse the results of repeated requests from this folder')
+    parser.add_argument('--cache_size_mb', type=float, default=1024, help='max size of the result cache')
+    parser.add_argument('--runtime_yaml', type=str, default='',
+                        help='cpu runtime settings written by benchmarks/runtime_search.py')
 
     opt = parser.parse_args()
     return opt
 
+
+
+def server_parser():
+    parser = argparse.ArgumentParser(description="colorization server")
+    parser.add_argument('--model_dir', type=str, required=True, help='model path')
+    parser.add_argument('--crack_dir', type=str, help='crack net path')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=8,
+                        help='max number of same size requests in one forward pass')
+    parser.add_argument('--max_wait_ms', type=float, default=10,
+                        help='max time a request waits for others to fill its batch')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='number of batches running at the same time')
+    parser.add_argument('--chroma_scale', type=int, default=1,
+                        help='predict ab at 1/chroma_scale resolution, see test.py')
+    parser.add_argument('--cache_dir', type=str, default='',
+                        help='reuse the results of repeated requests from this folder')
+    parser.add_argument('--cache_size_mb', type=float, default=1024, help='max size of the result cache')
+    parser.add_argument('--runtime_yaml', type=str, default='',
+                        help='cpu runtime settings written by benchmarks/runtime_search.py')
+    parser.add_argument('--process_index', type=int, default=0,
+                        help='index of this server among runtime.processes, selects its cpu cores')
+
+    opt = parser.parse_args()
+    return opt
+
+
+def video_parser():
+    parser = argparse.ArgumentParser(description="colorize a video")
+    parser.add_argument('--model_dir', type=str, required=True, help='model path')
+    parser.add_argument('--video_path', type=str, required=True, help='path to input video')
+    parser.add_argument('--ref_path', type=str, required=True, help='reference image of the shot')
+    parser.add_argument('--output_path', type=str, required=True, help='output mp4 path')
+    parser.add_argument('--warp_threshold', type=float, default=0.02,
+                        help='reuse the keyframe warp when the mean L change is below it')
+    parser.add_argument('--propagate_threshold', type=float, default=0.005,
+                        help='propagate the keyframe ab when the mean L change is below it')
+    parser.add_argument('--runtime_yaml', type=str, default='',
+                        help='cpu runtime settings written by benchmarks/runtime_search.py')
+
+    opt = parser.parse_args()
+    return opt
@@ -0,0 +1,360 @@
+"""
+Reference selection from a library of color photos. Every library image is embedded with the frozen
+attention resnet34 (pooled layer3/layer4 features of its gray version) and stored in an on disk
+index. Small libraries are searched exactly, large ones with an IVF-PQ index: a k-means coarse
+quantizer plus product quantized residuals, re-ranked with the exact embeddings.
+
+python -m utils.reference_index build --library photos_folder --index_dir ref_index --write_matches
+python -m utils.reference_index query --index_dir ref_index --input_path old_photo.jpg --k 5
+"""
+import argparse
+import json
+import os
+
+import cv2
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+
+from models.networks import FusedAttentionExtractModule, IMAGENET_MEAN, IMAGENET_STD
+
+IMAGE_EXTENSIONS = ('.jpg', '.png')
+# queries scored at once by the exact search, bounds the score matrix to QUERY_CHUNK x library size
+QUERY_CHUNK = 1024
+
+
+class GrayImageDataset(Dataset):
+    """
+    Gray, resized library images for the embedding
+    """
+
+    def __init__(self, image_paths, size=256):
+        self.image_paths = image_paths
+        self.size = size
+
+    def __len__(self):
+        return len(self.image_paths)
+
+    def __getitem__(self, idx):
+        image = cv2.imread(self.image_paths[idx], 0)
+        if image is None:
+            raise ValueError('can not read %s' % self.image_paths[idx])
+        image = cv2.resize(image, (self.size, self.size), interpolation=cv2.INTER_AREA)
+        return torch.from_numpy(np.asarray(image[np.newaxis], dtype=np.float32) / 255.)
+
+
+def list_images(folders):
+    image_paths = []
+    for folder in folders:
+        image_paths += sorted([os.path.join(folder, x) for x in os.listdir(folder)
+                               if x.endswith(IMAGE_EXTENSIONS)])
+    return image_paths
+
+
+def embed_gray(att_model, gray):
+    """
+    Global average pooled layer3 and layer4 features, each part l2 normalized so both weigh the same
+    :param att_model: FusedAttentionExtractModule or AttentionExtractModule
+    :param gray: gray images in range [0, 1], (N, 1, H, W)
+    :return: unit length embeddings, (N, 768)
+    """
+    with torch.no_grad():
+        if isinstance(att_model, FusedAttentionExtractModule):
+            features = att_model(gray)
+        else:
+            mean = gray.new_tensor(IMAGENET_MEAN).view(1, 3, 1, 1)
+            std = gray.new_tensor(IMAGENET_STD).view(1, 3, 1, 1)
+            features = att_model.extract_features((gray.repeat(1, 3, 1, 1) - mean) / std)
+        pooled = [F.normalize(F.adaptive_avg_pool2d(g, 1).flatten(1), dim=1) for g in features[2:]]
+        return F.normalize(torch.cat(pooled, 1), dim=1)
+
+
+def embed_images(att_model, image_paths, size=256, batch_size=16, num_workers=0, use_gpu=False):
+    """
+    :return: float32 embeddings of the images, (N, D)
+    """
+    loader = DataLoader(GrayImageDataset(image_paths, size), batch_size=batch_size,
+                        num_workers=num_workers)
+    embeddings = []
+    for gray in loader:
+        if use_gpu:
+            gray = gray.cuda()
+        embeddings.append(embed_gray(att_model, gray).cpu())
+    return torch.cat(embeddings, 0).numpy()
+
+
+def top_k(scores, k):
+    """
+    Indices of the k largest scores along the last axis, in descending order, without sorting
+    the whole axis
+    """
+    if k < scores.shape[-1]:
+        candidates = np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+    else:
+        candidates = np.broadcast_to(np.arange(scores.shape[-1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, candidates, -1), -1)
+    return np.take_along_axis(candidates, order, -1)
+
+
+def kmeans(x, num_clusters, iterations=20, seed=0):
+    """
+    Lloyd k-means on the rows of x with squared l2 distance, empty clusters are re-seeded
+    :param x: float32 tensor, (N, D)
+    :return: centroids (num_clusters, D), assignment (N,)
+    """
+    generator = torch.Generator().manual_seed(seed)
+    num_clusters = min(num_clusters, x.shape[0])
+    centroids = x[torch.randperm(x.shape[0], generator=generator)[:num_clusters]].clone()
+    for _ in range(iterations):
+        assignment = torch.cdist(x, centroids).argmin(1)
+        counts = torch.bincount(assignment, minlength=num_clusters)
+        sums = torch.zeros_like(centroids).index_add_(0, assignment, x)
+        empty = counts == 0
+        centroids = sums / counts.clamp(min=1).unsqueeze(1).float()
+        if empty.any():
+            centroids[empty] = x[torch.randint(x.shape[0], (int(empty.sum()),), generator=generator)]
+    return centroids, torch.cdist(x, centroids).argmin(1)
+
+
+class ReferenceIndex(object):
+    """
+    Inner product (cosine) search over the library embeddings.
+    Args:
+        image_paths: library image paths
+        embeddings: float32 unit length embeddings, (N, D)
+        method: exact, ivfpq or auto(exact up to exact_threshold images)
+        nlist: number of coarse ivf clusters
+        pq_m: number of pq sub vectors, has to divide D
+        arrays: trained ivfpq arrays of a saved index, skips the training
+    """
+
+    def __init__(self, image_paths, embeddings, method='auto', nlist=256, pq_m=48, exact_threshold=50000,
+                 arrays=None):
+        if len(image_paths) != embeddings.shape[0]:
+            raise ValueError('%d images but %d embeddings' % (len(image_paths), embeddings.shape[0]))
+        if method == 'auto':
+            method = 'exact' if len(image_paths) <= exact_threshold else 'ivfpq'
+        if method not in ['exact', 'ivfpq']:
+            raise ValueError('unknown index method %s' % method)
+
+        self.image_paths = image_paths
+        self.embeddings = embeddings
+        self.method = method
+        self.arrays = arrays or {}
+        if method == 'ivfpq' and not self.arrays:
+            self.arrays = self.train_ivfpq(torch.from_numpy(np.asarray(embeddings, dtype=np.float32)),
+                                           nlist, pq_m)
+
+    @staticmethod
+    def train_ivfpq(x, nlist, pq_m, pq_bits=8, max_train=65536):
+        """
+        Coarse k-means, then k-means per sub space of the residuals
+        :return: dict of the index arrays, the ids and codes are sorted by inverted list
+        """
+        if x.shape[1] % pq_m != 0:
+            raise ValueError('pq_m %d does not divide the embedding size %d' % (pq_m, x.shape[1]))
+        generator = torch.Generator().manual_seed(0)
+        train = x[torch.randperm(x.shape[0], generator=generator)[:max_train]]
+
+        coarse, _ = kmeans(train, nlist)
+        assignment = torch.cdist(x, coarse).argmin(1)
+        residual = x - coarse[assignment]
+
+        sub_dim = x.shape[1] // pq_m
+        train_residual = residual[torch.randperm(x.shape[0], generator=generator)[:max_train]]
+        codebooks = torch.zeros(pq_m, 2 ** pq_bits, sub_dim)
+        codes = torch.zeros(x.shape[0], pq_m, dtype=torch.uint8)
+        for j in range(pq_m):
+            sub_slice = slice(j * sub_dim, (j + 1) * sub_dim)
+            centroids, _ = kmeans(train_residual[:, sub_slice], 2 ** pq_bits, seed=j + 1)
+            codebooks[j, :centroids.shape[0]] = centroids
+            codes[:, j] = torch.cdist(residual[:, sub_slice], codebooks[j]).argmin(1).to(torch.uint8)
+
+        order = torch.argsort(assignment, stable=True)
+        list_offsets = torch.zeros(coarse.shape[0] + 1, dtype=torch.int64)
+        list_offsets[1:] = torch.cumsum(torch.bincount(assignment, minlength=coarse.shape[0]), 0)
+        return {'coarse': coarse.numpy(), 'codebooks': codebooks.numpy(), 'ids': order.numpy(),
+                'codes': codes[order].numpy(), 'list_offsets': list_offsets.numpy()}
+
+    def search(self, queries, k=5, nprobe=16, rerank=4):
+        """
+        :param queries: unit length query embeddings, (Q, D)
+        :param k: number of results per query
+        :param nprobe: ivf lists visited per query
+        :param rerank: ivfpq re-ranks the best k * rerank candidates with the exact embeddings
+        :return: scores (Q, k) and library ids (Q, k), -1 for missing results
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self.image_paths))
+        if self.method == 'exact':
+            embeddings = np.asarray(self.embeddings, dtype=np.float32)
+            all_scores, all_ids = [], []
+            for start in range(0, queries.shape[0], QUERY_CHUNK):
+                scores = queries[start:start + QUERY_CHUNK] @ embeddings.T
+                ids = top_k(scores, k)
+                all_scores.append(np.take_along_axis(scores, ids, 1))
+                all_ids.append(ids)
+            if not all_ids:
+                return np.zeros((0, k), np.float32), np.zeros((0, k), np.int64)
+            return np.concatenate(all_scores), np.concatenate(all_ids)
+
+        all_scores, all_ids = [np.zeros((0, k), np.float32)], [np.zeros((0, k), np.int64)]
+        for start in range(0, queries.shape[0], QUERY_CHUNK):
+            scores, ids = self._search_ivfpq(queries[start:start + QUERY_CHUNK], k, nprobe, rerank)
+            all_scores.append(scores)
+            all_ids.append(ids)
+        return np.concatenate(all_scores), np.concatenate(all_ids)
+
+    def _search_ivfpq(self, queries, k, nprobe, rerank):
+        """
+        Search a chunk of queries together: every probed inverted list is scored once for all the
+        queries probing it
+        """
+        coarse, codebooks = self.arrays['coarse'], self.arrays['codebooks']
+        pq_m, sub_dim = codebooks.shape[0], codebooks.shape[2]
+        offsets = self.arrays['list_offsets']
+        num_queries, num_best = queries.shape[0], k * rerank
+
+        coarse_scores = queries @ coarse.T
+        probes = top_k(coarse_scores, min(nprobe, coarse.shape[0]))
+        # inner product lookup table of every sub space centroid, (Q, M, C)
+        tables = np.einsum('mcd,qmd->qmc', codebooks, queries.reshape(num_queries, pq_m, sub_dim))
+
+        # best approximate scores of every query so far, merged list by list
+        best_scores = np.full((num_queries, num_best), -np.inf, dtype=np.float32)
+        best_ids = np.full((num_queries, num_best), -1, dtype=np.int64)
+        for probe in np.unique(probes):
+            start, end = offsets[probe], offsets[probe + 1]
+            if start == end:
+                continue
+            query_ids = np.nonzero((probes == probe).any(1))[0]
+            codes = self.arrays['codes'][start:end].astype(np.int64)
+            approx = np.repeat(coarse_scores[query_ids, probe][:, None], end - start, 1)
+            for j in range(pq_m):
+                approx += tables[query_ids, j][:, codes[:, j]]
+
+            merged_scores = np.concatenate([best_scores[query_ids], approx], 1)
+            merged_ids = np.concatenate([best_ids[query_ids],
+                                         np.broadcast_to(self.arrays['ids'][start:end], approx.shape)], 1)
+            order = top_k(merged_scores, num_best)
+            best_scores[query_ids] = np.take_along_axis(merged_scores, order, 1)
+            best_ids[query_ids] = np.take_along_axis(merged_ids, order, 1)
+
+        # re-rank the candidates with the exact embeddings, read once for the whole chunk
+        candidate_ids = np.unique(best_ids[best_ids >= 0])
+        embeddings = np.asarray(self.embeddings[candidate_ids], dtype=np.float32)
+        rows = np.searchsorted(candidate_ids, np.maximum(best_ids, 0))
+        exact = np.einsum('qd,qrd->qr', queries, embeddings[rows]) if len(candidate_ids) else \
+            np.zeros(best_ids.shape, np.float32)
+        exact[best_ids < 0] = -np.inf
+
+        order = top_k(exact, k)
+        scores = np.take_along_axis(exact, order, 1)
+        ids = np.take_along_axis(best_ids, order, 1)
+        ids[np.isinf(scores)] = -1
+        return scores, ids
+
+    def save(self, index_dir):
+        """
+        index.json holds the config and image paths, embeddings.npy the float16 embeddings(memory
+        mapped on load) and ivfpq.npz the quantizer arrays
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        with open(os.path.join(index_dir, 'index.json'), 'w') as f:
+            json.dump({'method': self.method, 'image_paths': self.image_paths}, f)
+        np.save(os.path.join(index_dir, 'embeddings.npy'), np.asarray(self.embeddings, dtype=np.float16))
+        if self.arrays:
+            np.savez(os.path.join(index_dir, 'ivfpq.npz'), **self.arrays)
+
+    @classmethod
+    def load(cls, index_dir):
+        with open(os.path.join(index_dir, 'index.json')) as f:
+            config = json.load(f)
+        arrays = None
+        if config['method'] == 'ivfpq':
+            with np.load(os.path.join(index_dir, 'ivfpq.npz')) as data:
+                arrays = {key: data[key] for key in data.files}
+        return cls(config['image_paths'], np.load(os.path.join(index_dir, 'embeddings.npy'), mmap_mode='r'),
+                   config['method'], arrays=arrays)
+
+
+def select_references(index, att_model, gray_images, k=5, size=256, nprobe=16):
+    """
+    Top k library references for each gray input
+    :param index: ReferenceIndex
+    :param att_model: the attention model used to build the index
+    :param gray_images: list of gray uint8 arrays
+    :return: list of [(image path, score), ...] per input
+    """
+    gray = np.stack([cv2.resize(image, (size, size), interpolation=cv2.INTER_AREA)
+                     for image in gray_images])[:, np.newaxis].astype(np.float32) / 255.
+    scores, ids = index.search(embed_gray(att_model, torch.from_numpy(gray)).numpy(), k, nprobe)
+    return [[(index.image_paths[j], float(score)) for j, score in zip(row_ids, row_scores) if j >= 0]
+            for row_ids, row_scores in zip(ids, scores)]
+
+
+def write_matches(index, k=5, nprobe=16):
+    """
+    Write <folder>/matches/<image>.json for every library image with its top k references in the
+    format read by OldPhotoDataset(ref_json), the image itself is skipped
+    """
+    embeddings = np.asarray(index.embeddings, dtype=np.float32)
+    scores, ids = index.search(embeddings, k + 1, nprobe)
+    for i, image_path in enumerate(index.image_paths):
+        folder, image_name = os.path.split(image_path)
+        matches = []
+        for j, score in zip(ids[i], scores[i]):
+            if j < 0 or j == i or len(matches) == k:
+                continue
+            ref_name = os.path.relpath(index.image_paths[j], folder)
+            # the dataset appends .jpg to a name without extension
+            if ref_name.endswith('.jpg'):
+                ref_name = ref_name[:-4]
+            matches.append({'name': ref_name, 'score': float(score)})
+
+        os.makedirs(os.path.join(folder, 'matches'), exist_ok=True)
+        with open(os.path.join(folder, 'matches', os.path.splitext(image_name)[0] + '.json'), 'w') as f:
+            json.dump(matches, f, indent=1)
+
+
+def main():
+    from utils import feature_pool
+
+    parser = argparse.ArgumentParser(description="reference library index")
+    parser.add_argument('command', choices=['build', 'query'])
+    parser.add_argument('--index_dir', type=str, required=True)
+    parser.add_argument('--library', type=str, nargs='+', help='folders of color photos to index')
+    parser.add_argument('--method', type=str, default='auto', choices=['auto', 'exact', 'ivfpq'])
+    parser.add_argument('--nlist', type=int, default=256)
+    parser.add_argument('--pq_m', type=int, default=48)
+    parser.add_argument('--nprobe', type=int, default=16)
+    parser.add_argument('--size', type=int, default=256, help='images are resized to size x size')
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--num_workers', type=int, default=0)
+    parser.add_argument('--write_matches', action='store_true',
+                        help='also write the matches json files of the library folders')
+    parser.add_argument('--input_path', type=str, help='gray image to query')
+    parser.add_argument('--k', type=int, default=5)
+    opt = parser.parse_args()
+
+    att_model = feature_pool.get('resnet34_attention')
+    if opt.command == 'build':
+        if not opt.library:
+            raise ValueError('build needs --library')
+        image_paths = list_images(opt.library)
+        embeddings = embed_images(att_model, image_paths, opt.size, opt.batch_size, opt.num_workers)
+        index = ReferenceIndex(image_paths, embeddings, opt.method, opt.nlist, opt.pq_m)
+        index.save(opt.index_dir)
+        print('%d images indexed with %s search' % (len(image_paths), index.method))
+        if opt.write_matches:
+            write_matches(index, opt.k, opt.nprobe)
+    else:
+        index = ReferenceIndex.load(opt.index_dir)
+        for path, score in select_references(index, att_model, [cv2.imread(opt.input_path, 0)], opt.k,
+                                             opt.size, opt.nprobe)[0]:
+            print('%.4f %s' % (score, path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+On disk content addressed cache of the predicted ab planes. The key covers the input and reference
+pixels, the model and crack net weights and the inference settings, so a repeated request costs a
+hash and a read. Safe to share between processes: entries are written to a temporary file and
+renamed, and eviction holds a file lock.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+
+def array_digest(array):
+    """
+    sha256 of the shape, dtype and bytes of a numpy array
+    """
+    array = np.ascontiguousarray(array)
+    sha = hashlib.sha256()
+    sha.update(('%s%s' % (array.shape, array.dtype)).encode())
+    sha.update(array.data)
+    return sha.hexdigest()
+
+
+def model_digest(model):
+    """
+    sha256 of the model state dict, None for a missing model. The torch.compile wrapper prefix is
+    left out of the names, so a compiled and an eager model with the same weights share the digest
+    """
+    if model is None:
+        return None
+    sha = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        sha.update(name.replace('_orig_mod.', '').encode())
+        sha.update(array_digest(tensor.detach().cpu().numpy()).encode())
+    return sha.hexdigest()
+
+
+def cache_key(input_image, ref_image, model_hash, crack_hash=None, settings=None):
+    """
+    :param input_image: decoded gray input pixels
+    :param ref_image: decoded rgb reference pixels
+    :param model_hash: model_digest of the colorization model
+    :param crack_hash: model_digest of the crack net
+    :param settings: json serializable inference settings that change the output
+    :return: hex key
+    """
+    content = json.dumps([array_digest(input_image), array_digest(ref_image),
+                          model_hash, crack_hash, settings], sort_keys=True)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+# an eviction removes the least recently used entries until this fraction of max_bytes is left
+EVICT_FRACTION = 0.9
+
+
+class ResultCache(object):
+    """
+    Size bounded LRU cache. The file modification time is the recency, it is refreshed on every hit.
+    The total size of the entries is kept in the .size file of the folder, shared by the processes,
+    so the folder is only scanned when the total goes over max_bytes. The eviction then goes down to
+    EVICT_FRACTION of max_bytes, so the next scans are that much writing apart.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+        self.lock_path = os.path.join(cache_dir, '.lock')
+        self.size_path = os.path.join(cache_dir, '.size')
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.npz')
+
+    def get(self, key):
+        """
+        :return: predicted ab and the restored L(None without crack net) as float32 tensors of shape
+                 (1, C, H, W), or None on a miss
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                ab = torch.from_numpy(data['ab'].astype(np.float32))
+                l_channel = torch.from_numpy(data['L'].astype(np.float32)) if 'L' in data else None
+            os.utime(path)
+        except (FileNotFoundError, ValueError, OSError):
+            # evicted by another process or a broken file
+            return None
+        return ab, l_channel
+
+    def put(self, key, ab, l_channel=None):
+        """
+        Store the predicted ab planes in float16, plus the crack net restored L if given
+        """
+        path = self._path(key)
+        folder = os.path.dirname(path)
+        os.makedirs(folder, exist_ok=True)
+
+        try:
+            old_size = os.path.getsize(path)
+        except FileNotFoundError:
+            old_size = 0
+
+        arrays = {'ab': ab.detach().cpu().numpy().astype(np.float16)}
+        if l_channel is not None:
+            arrays['L'] = l_channel.detach().cpu().numpy().astype(np.float16)
+
+        fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.add_size(os.path.getsize(path) - old_size)
+
+    def add_size(self, delta):
+        """
+        Add delta bytes to the shared size total, and evict if the total is over max_bytes or unknown
+        """
+        with open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            total = self._read_size()
+            if total is None or total + delta > self.max_bytes:
+                self._evict_locked()
+            else:
+                self._write_size(total + delta)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits EVICT_FRACTION of max_bytes
+        """
+        with open(self.lock_path, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._evict_locked()
+
+    def _read_size(self):
+        try:
+            with open(self.size_path) as f:
+                return int(f.read())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _write_size(self, total):
+        with open(self.size_path, 'w') as f:
+            f.write(str(total))
+
+    def _evict_locked(self):
+        # full scan, it also corrects the size total
+        entries = []
+        for folder in os.scandir(self.cache_dir):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if not entry.name.endswith('.npz'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * EVICT_FRACTION:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._write_size(total)
@@ -0,0 +1,107 @@
+"""
+Cpu inference runtime settings: thread counts, core pinning, memory format, oneDNN and warm-up.
+The settings come from the runtime section of the yaml, benchmarks/runtime_search.py finds good
+values for a machine.
+"""
+import copy
+import os
+
+import torch
+import yaml
+
+DEFAULT_RUNTIME = {'processes': 1,  # inference processes sharing the machine, each gets its own cores
+                   'intra_op_threads': 0,  # 0 uses all the cores of the process
+                   'inter_op_threads': 0,  # 0 keeps the torch default
+                   'pin_cores': False,
+                   'channels_last': False,
+                   'mkldnn': True,
+                   'warmup_runs': 1,
+                   'warmup_size': 256}
+
+
+def load_runtime(hypes, runtime_yaml=None):
+    """
+    Runtime settings of the yaml with the defaults filled in
+    :param hypes: config yaml dictionary
+    :param runtime_yaml: optional yaml file written by benchmarks/runtime_search.py, overrides hypes
+    """
+    runtime = dict(DEFAULT_RUNTIME)
+    runtime.update(hypes.get('runtime') or {})
+    if runtime_yaml:
+        with open(runtime_yaml) as f:
+            runtime.update(yaml.safe_load(f)['runtime'])
+    return runtime
+
+
+def partition_cores(processes, process_index, cores=None):
+    """
+    Split the available cores into equal contiguous slices, one per process
+    :return: list of core ids of this process
+    """
+    cores = sorted(os.sched_getaffinity(0)) if cores is None else cores
+    if not 0 <= process_index < processes:
+        raise ValueError('process index %d out of range for %d processes' % (process_index, processes))
+    per_process = max(len(cores) // processes, 1)
+    start = (process_index * per_process) % len(cores)
+    return cores[start:start + per_process]
+
+
+def apply_runtime(runtime, process_index=0):
+    """
+    Set the process wide settings, call it before the models run anything
+    :param runtime: see load_runtime
+    :param process_index: index of this process among runtime['processes']
+    :return: the cores of this process
+    """
+    cores = partition_cores(runtime['processes'], process_index)
+    if runtime['pin_cores'] and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+
+    torch.set_num_threads(runtime['intra_op_threads'] or len(cores))
+    if runtime['inter_op_threads']:
+        try:
+            torch.set_num_interop_threads(runtime['inter_op_threads'])
+        except RuntimeError:
+            # can only be set once, before any inter-op parallel work
+            print('inter op threads already set to %d' % torch.get_num_interop_threads())
+    torch.backends.mkldnn.enabled = runtime['mkldnn']
+    return cores
+
+
+def to_memory_format(module, x):
+    """
+    The input in the memory format of the module weights, a channels last model would reorder its
+    contiguous inputs in every convolution
+    """
+    return x.contiguous(memory_format=getattr(module, 'memory_format', torch.contiguous_format))
+
+
+def prepare_models(runtime, model, att_model, crack_net=None, use_gpu=False):
+    """
+    Convert the weights to channels last if required and run the warm-up passes, so the first
+    request does not pay for the oneDNN primitive creation and the allocator growth.
+    The model and the crack net are converted in place. The attention model is usually the one
+    shared by utils.feature_pool, so a converted copy is returned instead.
+    :return: model, att_model, crack_net
+    """
+    if runtime['channels_last']:
+        att_model = copy.deepcopy(att_model)
+        for module in [model, att_model, crack_net]:
+            if module is not None:
+                module.to(memory_format=torch.channels_last)
+                # read by to_memory_format to convert the inputs
+                module.memory_format = torch.channels_last
+
+    size = runtime['warmup_size']
+    x = torch.rand(1, 1, size, size)
+    ref_ab = torch.rand(1, 2, size, size) * 2 - 1
+    if use_gpu:
+        x, ref_ab = x.cuda(), ref_ab.cuda()
+    x, ref_ab = to_memory_format(model, x), to_memory_format(model, ref_ab)
+    with torch.no_grad():
+        for _ in range(runtime['warmup_runs']):
+            model(x * 2 - 1, x, ref_ab, x, att_model)
+            if crack_net is not None:
+                crack_net(x * 2 - 1)
+
+    return model, att_model, crack_net
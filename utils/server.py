@@ -0,0 +1,330 @@
+"""
+Local http inference server. Concurrent requests are coalesced into batches of the same image shape
+and run on a small worker pool, so the model sees batched forward passes instead of single images.
+
+POST /colorize   {"input": base64 image, "reference": base64 image} -> {"output": base64 png}
+GET  /stats      latency/throughput statistics
+"""
+import base64
+import collections
+import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import cv2
+import numpy as np
+import torch
+
+from utils import inference, result_cache
+from utils.color_space_convert import lab_to_rgb
+
+
+def percentile(values, q):
+    """
+    Nearest rank percentile of a list, 0 for an empty list
+    """
+    if not values:
+        return 0.
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100. * (len(values) - 1))))]
+
+
+class ServerStats(object):
+    """
+    Thread safe request/batch statistics. Latencies are kept for the last window requests only.
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.batches = 0
+        self.batched_images = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.queue_waits = collections.deque(maxlen=window)
+
+    def record_request(self, latency, queue_wait, error=False, cache_hit=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.cache_hits += int(cache_hit)
+            self.latencies.append(latency)
+            self.queue_waits.append(queue_wait)
+
+    def record_batch(self, batch_size):
+        with self.lock:
+            self.batches += 1
+            self.batched_images += batch_size
+
+    def snapshot(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            queue_waits = list(self.queue_waits)
+            elapsed = time.time() - self.start_time
+            return {'requests': self.requests,
+                    'errors': self.errors,
+                    'cache_hits': self.cache_hits,
+                    'batches': self.batches,
+                    'mean_batch_size': self.batched_images / max(self.batches, 1),
+                    'throughput': self.requests / max(elapsed, 1e-6),
+                    'latency_ms': {'p50': 1000 * percentile(latencies, 50),
+                                   'p95': 1000 * percentile(latencies, 95),
+                                   'p99': 1000 * percentile(latencies, 99)},
+                    'mean_queue_wait_ms': 1000 * sum(queue_waits) / max(len(queue_waits), 1),
+                    'uptime': elapsed}
+
+
+class DynamicBatcher(object):
+    """
+    Collect submitted requests in per shape buckets. A bucket is flushed once it holds
+    max_batch_size requests or its oldest request waited max_wait seconds, and only when a worker
+    is free, so batches grow by themselves while the workers are busy.
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait=0.01, num_workers=1, stats=None):
+        """
+        :param run_batch: function(list of inputs) -> list of outputs, called on a worker thread
+        :param max_batch_size: max requests in one batch
+        :param max_wait: max seconds the oldest request of a bucket waits for more requests
+        :param num_workers: number of batches running at the same time
+        :param stats: optional ServerStats
+        """
+        if max_batch_size < 1 or num_workers < 1:
+            raise ValueError('max_batch_size and num_workers have to be positive')
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.stats = stats
+
+        self.buckets = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.free_workers = threading.Semaphore(num_workers)
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.closed = False
+
+        self.dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self.dispatcher.start()
+
+    def submit(self, key, inputs):
+        """
+        Queue one request
+        :param key: bucket key, requests are only batched with requests of the same key
+        :param inputs: request inputs passed to run_batch
+        :return: Future of the request output
+        """
+        future = Future()
+        with self.condition:
+            if self.closed:
+                raise ValueError('the batcher is closed')
+            self.buckets.setdefault(key, []).append((inputs, future, time.time()))
+            self.condition.notify()
+        return future
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+
+    def _next_batch(self):
+        """
+        Wait until a bucket is ready and pop it, None when closed. Called with the condition held.
+        """
+        while True:
+            now = time.time()
+            ready_key, deadline = None, None
+            for key, items in self.buckets.items():
+                oldest = items[0][2]
+                if len(items) >= self.max_batch_size or now - oldest >= self.max_wait or self.closed:
+                    if ready_key is None or oldest < self.buckets[ready_key][0][2]:
+                        ready_key = key
+                elif deadline is None or oldest + self.max_wait < deadline:
+                    deadline = oldest + self.max_wait
+
+            if ready_key is not None:
+                items = self.buckets[ready_key]
+                batch = items[:self.max_batch_size]
+                if len(items) > self.max_batch_size:
+                    self.buckets[ready_key] = items[self.max_batch_size:]
+                else:
+                    del self.buckets[ready_key]
+                return batch
+            if self.closed:
+                return None
+            self.condition.wait(None if deadline is None else deadline - now)
+
+    def _dispatch(self):
+        while True:
+            self.free_workers.acquire()
+            with self.condition:
+                batch = self._next_batch()
+            if batch is None:
+                self.free_workers.release()
+                return
+            self.executor.submit(self._run, batch)
+
+    def _run(self, batch):
+        start_time = time.time()
+        try:
+            outputs = self.run_batch([inputs for inputs, _, _ in batch])
+            for (_, future, _), output in zip(batch, outputs):
+                future.set_result(output)
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+        finally:
+            self.free_workers.release()
+
+        if self.stats is not None:
+            self.stats.record_batch(len(batch))
+            for _, future, arrival in batch:
+                self.stats.record_request(time.time() - arrival, start_time - arrival,
+                                          error=future.exception() is not None)
+
+
+def create_batch_runner(model, att_model, crack_net=None, chroma_scale=1, use_gpu=False):
+    """
+    Wrap inference.predict_ab into a function that colorizes a list of same shape requests at once
+    :return: function(list of (input_image, input_L, ref_ab, ref_gray)) -> list of (L, ab) tensors
+    """
+    def run_batch(requests):
+        inputs = [torch.cat(tensors, 0) for tensors in zip(*requests)]
+        if use_gpu:
+            inputs = [x.cuda() for x in inputs]
+        l_channel, ab = inference.predict_ab(model, att_model, *inputs, crack_net=crack_net,
+                                             chroma_scale=chroma_scale)
+        return list(zip(l_channel.cpu().split(1, 0), ab.cpu().split(1, 0)))
+
+    return run_batch
+
+
+def decode_request(body):
+    """
+    Decode the json request body
+    :param body: json bytes with base64 encoded input and reference images
+    :return: gray input pixels, rgb reference pixels
+    """
+    request = json.loads(body)
+    if 'input' not in request or 'reference' not in request:
+        raise ValueError('the request needs both input and reference images')
+
+    input_image = cv2.imdecode(np.frombuffer(base64.b64decode(request['input']), np.uint8),
+                               cv2.IMREAD_GRAYSCALE)
+    ref_image = cv2.imdecode(np.frombuffer(base64.b64decode(request['reference']), np.uint8),
+                             cv2.IMREAD_COLOR)
+    if input_image is None or ref_image is None:
+        raise ValueError('can not decode the input or reference image')
+    if input_image.shape[0] < 32 or input_image.shape[1] < 32:
+        raise ValueError('the input image has to be at least 32x32')
+
+    return input_image, cv2.cvtColor(ref_image, cv2.COLOR_BGR2RGB)
+
+
+def encode_output(output):
+    """
+    Encode a (1, 3, H, W) rgb tensor to base64 png
+    """
+    save_out = np.uint8(255 * output.numpy().squeeze()).transpose(1, 2, 0)
+    _, buffer = cv2.imencode('.png', cv2.cvtColor(save_out, cv2.COLOR_RGB2BGR))
+    return base64.b64encode(buffer.tobytes()).decode('ascii')
+
+
+class ColorizeHandler(BaseHTTPRequestHandler):
+    """
+    Decoding and encoding run on the http threads, only the model runs on the batch workers
+    """
+
+    def _reply(self, code, content):
+        body = json.dumps(content).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.stats.snapshot())
+        else:
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/colorize':
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            input_pixels, ref_pixels = decode_request(body)
+            inputs = inference.prepare_image_pair(input_pixels, ref_pixels)
+        except Exception as e:
+            # malformed json/base64, undecodable or unusable images
+            self._reply(400, {'error': str(e)})
+            return
+
+        cache = self.server.cache
+        cached = None
+        if cache is not None:
+            start_time = time.time()
+            key = result_cache.cache_key(input_pixels, ref_pixels, **self.server.cache_key_args)
+            cached = cache.get(key)
+
+        if cached is not None:
+            ab, restored_l = cached
+            l_channel = inputs[1] if restored_l is None else restored_l
+            # batched requests are recorded by the batcher, cache hits never reach it
+            self.server.stats.record_request(time.time() - start_time, 0., cache_hit=True)
+        else:
+            try:
+                # bucket by the input size, the reference is already resized to it
+                l_channel, ab = self.server.batcher.submit(tuple(inputs[0].shape[2:]), inputs).result()
+            except Exception as e:
+                self._reply(500, {'error': str(e)})
+                return
+            if cache is not None:
+                cache.put(key, ab, l_channel if self.server.restores_l else None)
+
+        self._reply(200, {'output': encode_output(lab_to_rgb(l_channel, ab))})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(opt, hypes, use_gpu=False):
+    """
+    Load the models once and serve colorization requests until interrupted
+    :param opt: arg parse
+    :param hypes: config yaml dictionary
+    :param use_gpu: whether use gpu
+    """
+    model, att_model, crack_net = inference.setup_models(opt, hypes, use_gpu)
+
+    cache, cache_key_args = inference.create_result_cache(opt, hypes, model, crack_net)
+
+    stats = ServerStats()
+    batcher = DynamicBatcher(create_batch_runner(model, att_model, crack_net, opt.chroma_scale, use_gpu),
+                             max_batch_size=opt.max_batch_size,
+                             max_wait=opt.max_wait_ms / 1000.,
+                             num_workers=opt.num_workers,
+                             stats=stats)
+
+    server = ThreadingHTTPServer((opt.host, opt.port), ColorizeHandler)
+    server.daemon_threads = True
+    server.batcher = batcher
+    server.stats = stats
+    server.cache = cache
+    server.cache_key_args = cache_key_args
+    server.restores_l = crack_net is not None
+
+    print('serving on http://%s:%d' % (opt.host, opt.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        batcher.close()
@@ -16,16 +16,23 @@ def create_window(window_size, channel):
     return window
 
 
-def _ssim(img1, img2, window, window_size, channel, size_average = True):
-    mu1 = F.conv2d(img1, window, padding = window_size//2, groups = channel)
+def _ssim_target_stats(img2, window, window_size, channel):
     mu2 = F.conv2d(img2, window, padding = window_size//2, groups = channel)
+    mu2_sq = mu2.pow(2)
+    sigma2_sq = F.conv2d(img2*img2, window, padding = window_size//2, groups = channel) - mu2_sq
+    return mu2, mu2_sq, sigma2_sq
+
+
+def _ssim(img1, img2, window, window_size, channel, size_average = True, target_stats = None):
+    mu1 = F.conv2d(img1, window, padding = window_size//2, groups = channel)
+    if target_stats is None:
+        target_stats = _ssim_target_stats(img2, window, window_size, channel)
+    mu2, mu2_sq, sigma2_sq = target_stats
 
     mu1_sq = mu1.pow(2)
-    mu2_sq = mu2.pow(2)
     mu1_mu2 = mu1*mu2
 
     sigma1_sq = F.conv2d(img1*img1, window, padding = window_size//2, groups = channel) - mu1_sq
-    sigma2_sq = F.conv2d(img2*img2, window, padding = window_size//2, groups = channel) - mu2_sq
     sigma12 = F.conv2d(img1*img2, window, padding = window_size//2, groups = channel) - mu1_mu2
 
     C1 = 0.01**2
@@ -46,23 +53,32 @@ class SSIM(torch.nn.Module):
         self.size_average = size_average
         self.channel = 1
         self.window = create_window(window_size, self.channel)
-
-    def forward(self, img1, img2):
-        (_, channel, _, _) = img1.size()
-
-        if channel == self.channel and self.window.data.type() == img1.data.type():
-            window = self.window
-        else:
-            window = create_window(self.window_size, channel)
-            
-            if img1.is_cuda:
-                window = window.cuda(img1.get_device())
-            window = window.type_as(img1)
-            
-            self.window = window
-            self.channel = channel
-
-        return _ssim(img1, img2, window, self.window_size, channel, self.size_average)
+        # the target statistics only depend on the window, see utils.loss.LossEngine
+        self.stats_key = ('ssim', window_size)
+
+    def _window(self, img):
+        channel = img.size(1)
+        if channel == self.channel and self.window.data.type() == img.data.type():
+            return self.window
+
+        window = create_window(self.window_size, channel)
+        if img.is_cuda:
+            window = window.cuda(img.get_device())
+        window = window.type_as(img)
+
+        self.window = window
+        self.channel = channel
+        return window
+
+    def target_stats(self, img2):
+        """
+        Local mean, squared mean and variance of the target, to be shared by several ssim terms
+        """
+        return _ssim_target_stats(img2, self._window(img2), self.window_size, img2.size(1))
+
+    def forward(self, img1, img2, target_stats = None):
+        window = self._window(img1)
+        return _ssim(img1, img2, window, self.window_size, self.channel, self.size_average, target_stats)
 
 
 def ssim(img1, img2, window_size = 11, size_average = True):
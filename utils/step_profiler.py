@@ -0,0 +1,204 @@
+"""
+Per-step time breakdown of the training loop. Every step is split into named phases (data loading,
+host to device copy, crack net, attention model, forward, loss, backward, optimizer step, logging),
+their timings are aggregated as mean/p50/p95, written to tensorboard and a json summary, and a
+torch.profiler trace can be captured for a window of steps. The memory and the cost of a summary do
+not grow with the length of the training: the percentiles use the last window steps and the whole
+run mean is a running sum.
+"""
+import collections
+import contextlib
+import json
+import time
+
+import numpy as np
+import torch
+
+
+class StepProfiler(object):
+    """
+    Phases can be nested, the time of an inner phase is removed from the outer one, so the phases of
+    a step add up to the step time. Time outside any phase is reported as 'other'.
+    Args:
+        enabled: when false every call is a no-op
+        sync_cuda: synchronize cuda at the phase boundaries, needed for correct gpu timings
+        trace_dir: folder of the torch.profiler trace (tensorboard plugin format)
+        trace_start: first step of the trace window
+        trace_steps: number of traced steps, 0 disables the trace
+        window: number of last steps kept for the percentiles
+        record_steps: also keep the timings of every step, written by save
+    """
+
+    def __init__(self, enabled=True, sync_cuda=False, trace_dir=None, trace_start=0, trace_steps=0, window=1000,
+                 record_steps=False):
+        self.enabled = enabled
+        self.sync_cuda = sync_cuda and torch.cuda.is_available()
+        self.window = window
+        # phase name -> durations of the last window steps
+        self.history = collections.OrderedDict()
+        # phase name -> [sum of the durations, number of steps] of the whole run
+        self.totals = collections.OrderedDict()
+        self.records = [] if record_steps else None
+        self.current = collections.defaultdict(float)
+        self.stack = []
+        self.step_start = None
+        self.steps = 0
+
+        self.trace = None
+        if enabled and trace_steps > 0:
+            # one warm-up step before the active window
+            self.trace = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=max(trace_start - 1, 0), warmup=min(trace_start, 1),
+                                                 active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(trace_dir),
+                record_shapes=True)
+            self.trace.start()
+
+    def _now(self):
+        if self.sync_cuda:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def _begin(self):
+        if self.step_start is None:
+            self.step_start = self._now()
+        self.stack.append([self._now(), 0.])
+
+    def _end(self, name):
+        start, children = self.stack.pop()
+        duration = self._now() - start
+        self.current[name] += duration - children
+        if self.stack:
+            self.stack[-1][1] += duration
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time the block as the phase name
+        """
+        if not self.enabled:
+            yield
+            return
+        self._begin()
+        try:
+            yield
+        finally:
+            self._end(name)
+
+    def iterate(self, iterable, name='data'):
+        """
+        Time the wait for every item of the iterable, e.g. a dataloader
+        """
+        iterator = iter(iterable)
+        end = object()
+        while True:
+            with self.phase(name):
+                item = next(iterator, end)
+            if item is end:
+                # the last wait does not belong to any step
+                self.current = collections.defaultdict(float)
+                self.step_start = None
+                return
+            yield item
+
+    def hook_module(self, module, name):
+        """
+        Time every forward call of the module inside a phase as the phase name, use it for modules
+        called inside other phases such as the attention model inside the model forward
+        :return: the hook handles
+        """
+        if not self.enabled:
+            return []
+        # calls outside the phases of a step, e.g. validation, are not timed
+        timed = []
+
+        def pre_hook(*args):
+            timed.append(bool(self.stack))
+            if timed[-1]:
+                self._begin()
+
+        def hook(*args):
+            if timed.pop():
+                self._end(name)
+        return [module.register_forward_pre_hook(pre_hook), module.register_forward_hook(hook)]
+
+    def end_step(self):
+        """
+        Close the current step, call it once at the end of every training step
+        """
+        if not self.enabled:
+            return
+        total = self._now() - self.step_start if self.step_start is not None else 0.
+        self.current['other'] = max(total - sum(self.current.values()), 0.)
+        self.current['step'] = total
+        for name in set(self.history) | set(self.current):
+            duration = self.current.get(name, 0.)
+            self.history.setdefault(name, collections.deque(maxlen=self.window)).append(duration)
+            total = self.totals.setdefault(name, [0., 0])
+            total[0] += duration
+            total[1] += 1
+        if self.records is not None:
+            self.records.append(dict(self.current))
+        self.current = collections.defaultdict(float)
+        self.step_start = None
+        self.steps += 1
+        if self.trace is not None:
+            self.trace.step()
+
+    def _mean(self, name, last):
+        if last:
+            return float(np.mean(list(self.history[name])[-last:]))
+        return self.totals[name][0] / self.totals[name][1]
+
+    def summary(self, last=0):
+        """
+        :param last: only the last n steps(at most window), 0 for the whole run mean and the
+                     percentiles of the last window steps
+        :return: dict of phase name to mean/p50/p95 milliseconds and share of the step time
+        """
+        results = collections.OrderedDict()
+        step_mean = self._mean('step', last) if self.history.get('step') else 0.
+        for name, durations in self.history.items():
+            durations = np.asarray(list(durations)[-last:]) * 1000
+            mean = self._mean(name, last)
+            results[name] = {'mean_ms': 1000 * mean,
+                             'p50_ms': float(np.percentile(durations, 50)),
+                             'p95_ms': float(np.percentile(durations, 95)),
+                             'share': mean / step_mean if step_mean else 0.}
+        return results
+
+    def write(self, writer, step, last=0):
+        """
+        Add the phase means and p95 of the last steps to tensorboard
+        """
+        if not self.enabled or not self.steps:
+            return
+        for name, result in self.summary(last).items():
+            writer.add_scalar('step_time/%s_mean_ms' % name, result['mean_ms'], step)
+            writer.add_scalar('step_time/%s_p95_ms' % name, result['p95_ms'], step)
+
+    def save(self, path):
+        """
+        Write the summary as json, with the milliseconds of every step if they are recorded
+        """
+        if not self.enabled or not self.steps:
+            return
+        results = {'steps': self.steps, 'window': self.window, 'phases': self.summary()}
+        if self.records is not None:
+            results['records'] = [{name: 1000 * value for name, value in record.items()}
+                                  for record in self.records]
+        with open(path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    def print_summary(self):
+        if not self.enabled or not self.steps:
+            return
+        print('%-12s %10s %10s %10s %7s' % ('phase', 'mean ms', 'p50 ms', 'p95 ms', 'share'))
+        for name, result in sorted(self.summary().items(), key=lambda x: -x[1]['mean_ms']):
+            print('%-12s %10.1f %10.1f %10.1f %6.1f%%' % (name, result['mean_ms'], result['p50_ms'],
+                                                          result['p95_ms'], 100 * result['share']))
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
@@ -1,50 +1,198 @@
 """ a lib containing tools to generate crack/dust effect"""
 import os
+import collections
 import cv2
 import numpy as np
 import imutils
 
 from random import randint
 
+# texture01-12.jpg in the texture folder
+CRACK_TEXTURES = 12
+# name prefix of the crack textures added from videos
+VIDEO_PREFIX = 'video'
 
-def video2frame(video, output_folder):
+
+def iter_video_frames(video, every_n=1, scene_threshold=0., max_frames=0):
+    """
+    Decode a video in one sequential pass and yield the kept frames, nothing is written to disk
+    :param video: video path
+    :param every_n: keep every n-th frame, the others are grabbed without being decoded to images
+    :param scene_threshold: drop a frame if its mean absolute difference(0-1 range, on a 32x32 gray
+                            thumbnail) to the last kept frame is below it, 0 keeps all the frames
+    :param max_frames: stop after this many kept frames, 0 means no limit
+    :return: generator of (frame index, bgr frame)
     """
-    Convert texture video to frames
+    vidcap = cv2.VideoCapture(video)
+    if not vidcap.isOpened():
+        raise ValueError('can not open %s' % video)
+
+    index = 0
+    kept = 0
+    last_thumbnail = None
+    try:
+        while True:
+            # grab only demuxes/decodes, retrieve is skipped for the dropped frames
+            if not vidcap.grab():
+                break
+            if index % every_n == 0:
+                success, image = vidcap.retrieve()
+                if not success:
+                    break
+                thumbnail = cv2.resize(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), (32, 32),
+                                       interpolation=cv2.INTER_AREA).astype(np.float32) / 255.
+                if last_thumbnail is None or np.abs(thumbnail - last_thumbnail).mean() >= scene_threshold:
+                    last_thumbnail = thumbnail
+                    kept += 1
+                    yield index, image
+                    if kept == max_frames:
+                        break
+            index += 1
+    finally:
+        vidcap.release()
+
+
+def video2frame(video, output_folder, every_n=1, scene_threshold=0.):
+    """
+    Convert texture video to frames. The videos of the texture_video yaml section are added to the
+    crack textures in memory instead, see load_texture_videos
     :param output_folder:
     :param video:
+    :param every_n: keep every n-th frame
+    :param scene_threshold: drop near duplicate frames, see iter_video_frames
     :return:
     """
-    vidcap = cv2.VideoCapture(video)
-    success, image = vidcap.read()
-    count = 0
-    while success:
+    for count, (_, image) in enumerate(iter_video_frames(video, every_n, scene_threshold)):
         cv2.imwrite(output_folder + "scratch_%03d.jpg" % count, image)
-        success, image = vidcap.read()
-        count += 1
 
 
-def dust_generate(image, code):
+class TextureBank(object):
+    """
+    In memory textures by name. Missing names are read once from the texture folder, so the crack
+    and dust generation does not decode a jpg for every sample, and video frames can be added
+    without the disk round trip.
+    Args:
+        texture_dir: folder of the texture jpgs
+        max_textures: the oldest added textures are dropped above it, 0 means no limit
+    """
+
+    def __init__(self, texture_dir=None, max_textures=0):
+        if texture_dir is None:
+            texture_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), '../data/texture2')
+        self.texture_dir = texture_dir
+        self.max_textures = max_textures
+        self.textures = collections.OrderedDict()
+        self.videos = set()
+
+    def __len__(self):
+        return len(self.textures)
+
+    def names(self, prefix=''):
+        return [name for name in self.textures if name.startswith(prefix)]
+
+    def add(self, name, texture):
+        self.textures[name] = texture
+        self.textures.move_to_end(name)
+        while self.max_textures and len(self.textures) > self.max_textures:
+            self.textures.popitem(last=False)
+
+    def add_video(self, video, prefix=VIDEO_PREFIX, every_n=1, scene_threshold=0., max_frames=0):
+        """
+        Add the frames of a texture video as <prefix>_<video index>_%03d, a video already added is
+        skipped
+        :return: number of frames added
+        """
+        if video in self.videos:
+            return 0
+        name = '%s_%02d_%%03d' % (prefix, len(self.videos))
+        self.videos.add(video)
+        count = 0
+        for count, (_, image) in enumerate(iter_video_frames(video, every_n, scene_threshold, max_frames), 1):
+            self.add(name % (count - 1), image)
+        return count
+
+    def get(self, name):
+        """
+        :return: a copy of the texture, the generators modify it in place
+        """
+        if name not in self.textures:
+            texture = cv2.imread(os.path.join(self.texture_dir, name + '.jpg'))
+            if texture is None:
+                raise ValueError('texture %s not found in %s' % (name, self.texture_dir))
+            self.add(name, texture)
+        return self.textures[name].copy()
+
+
+texture_bank = TextureBank()
+
+
+def load_texture_videos(video_params):
+    """
+    Add the frames of the scratch videos of the texture_video yaml section to the crack textures,
+    call it before the dataloader workers start so they share the frames
+    :param video_params: texture_video yaml dict, None or no videos does nothing
+    :return: number of frames added
+    """
+    if not video_params or not video_params.get('videos'):
+        return 0
+    return sum(texture_bank.add_video(video, every_n=video_params.get('every_n', 1),
+                                      scene_threshold=video_params.get('scene_threshold', 0.),
+                                      max_frames=video_params.get('max_frames', 0))
+               for video in video_params['videos'])
+
+
+def random_crack_code():
+    """
+    :return: a crack texture code, 1-12 for the texture jpgs or the name of a video frame texture
+    """
+    video_names = texture_bank.names(VIDEO_PREFIX)
+    code = randint(1, CRACK_TEXTURES + len(video_names))
+    return code if code <= CRACK_TEXTURES else video_names[code - CRACK_TEXTURES - 1]
+
+
+def resize_window(texture, full_height, full_width, top, left, height, width):
+    """
+    The window of cv2.resize(texture, (full_width, full_height)) starting at (top, left), without
+    resizing the texture to the full size
+    """
+    scale_x = texture.shape[1] / float(full_width)
+    scale_y = texture.shape[0] / float(full_height)
+    # same pixel center mapping as cv2.resize with linear interpolation
+    matrix = np.float32([[scale_x, 0, (left + 0.5) * scale_x - 0.5],
+                         [0, scale_y, (top + 0.5) * scale_y - 0.5]])
+    return cv2.warpAffine(texture, matrix, (width, height), flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                          borderMode=cv2.BORDER_REPLICATE)
+
+
+def dust_generate(image, code, window=None, mean_color=None):
     """
     dust effect generation
     :param image:
     :param code:
+    :param window: (top, left, full height, full width) if image is a crop of a larger image, the
+                   dust is placed as on the full image
+    :param mean_color: mean of the middle row of the full image, computed from image if not given
     :return:
     """
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    texutre = cv2.imread(os.path.join(dir_path, '../data/texture2/dust%02d.jpg' % code))
+    texutre = texture_bank.get('dust%02d' % code)
 
     if code in [8, 9, 10, 11]:
         texutre[texutre <= 50] = 0
     else:
         texutre[texutre <= 100] = 0
 
-    mean_color = min(np.mean(image[image.shape[0] // 2, :])*3, 255)
+    if mean_color is None:
+        mean_color = np.mean(image[image.shape[0] // 2, :])
+    mean_color = min(mean_color * 3, 255)
     texutre[texutre != 0] = mean_color
-    if image.shape[0] > texutre.shape[0] or image.shape[1] > texutre.shape[1]:
-        texutre = cv2.resize(texutre, (image.shape[1], image.shape[0]))
+
+    top, left, full_height, full_width = window if window is not None else \
+        (0, 0, image.shape[0], image.shape[1])
+    if full_height > texutre.shape[0] or full_width > texutre.shape[1]:
+        texutre = resize_window(texutre, full_height, full_width, top, left, image.shape[0], image.shape[1])
     else:
-        randx = randint(0, texutre.shape[0] - image.shape[0])
-        randy = randint(0, texutre.shape[1] - image.shape[1])
+        randx = randint(0, texutre.shape[0] - full_height) + top
+        randy = randint(0, texutre.shape[1] - full_width) + left
         texutre = texutre[randx:randx+image.shape[0], randy:randy+image.shape[1]]
 
     image[texutre != 0] = texutre[texutre != 0]
@@ -52,15 +200,16 @@ def dust_generate(image, code):
     return image
 
 
-def crack_generate(image, code):
+def crack_generate(image, code, window=None):
     """
     Generate cracks
-    :param code:
+    :param code: texture jpg code, or the name of a video frame texture, see random_crack_code
     :param image:
+    :param window: (top, left, full height, full width) if image is a crop of a larger image, the
+                   crack is placed as on the full image
     :return: texture
     """
-    dir_path = os.path.dirname(os.path.realpath(__file__))
-    texture = cv2.imread(os.path.join(dir_path,'../data/texture2/texture%02d.jpg' % code))
+    texture = texture_bank.get(code if isinstance(code, str) else 'texture%02d' % code)
     if code == 12:
         texture[texture < 120] = 0
 
@@ -79,7 +228,11 @@ def crack_generate(image, code):
     x_start, y_start = random_list[seed]
     texture = texture[y_start:y_start + row // 2, x_start:x_start + col // 2]
 
-    texture = cv2.resize(texture, (image.shape[1], image.shape[0]))
+    if window is None:
+        texture = cv2.resize(texture, (image.shape[1], image.shape[0]))
+    else:
+        top, left, full_height, full_width = window
+        texture = resize_window(texture, full_height, full_width, top, left, image.shape[0], image.shape[1])
     image[texture > image] = texture[texture > image]
 
     return image, texture
@@ -1,15 +1,18 @@
+import json
+import math
 import os
+import time
 
 import torch
 import torch.optim.lr_scheduler as lr_scheduler
 
 from tensorboardX import SummaryWriter
-from torchvision.models import resnet34, resnet101
-from torchvision.models.resnet import BasicBlock, Bottleneck
+from torch.utils.data import DataLoader
 
-from utils import helper, loss
+from utils import feature_pool, helper, loss, result_cache
+from utils.step_profiler import StepProfiler
+from datasets.RestoredPoolDataset import RestoredPoolDataset
 from utils.color_space_convert import lab_to_rgb
-from models.networks import AttentionExtractModule
 
 
 def train(opt, hypes, use_gpu=True):
@@ -21,19 +24,9 @@ def train(opt, hypes, use_gpu=True):
     :return:
     """
 
-    print('loading dataset')
-    loader_train, loader_val = helper.create_dataset(hypes,
-                                                     train=True,
-                                                     gan=False,
-                                                     real=opt.real_test,
-                                                     crack_dir=opt.crack_dir)
-
     print('creating model')
-    # pretrained resnet for attention extraction
-    base_resnet = resnet34(pretrained=True)
-    att_model = AttentionExtractModule(BasicBlock, [3, 4, 6, 3])
-    att_model.load_state_dict(base_resnet.state_dict())
-    att_model.eval()
+    # pretrained resnet for attention extraction, shared with the other frozen extractors
+    att_model = feature_pool.get('resnet34_attention')
 
     # crack net to refine L channel
     crack_net = helper.create_model(hypes, crack=True)
@@ -44,12 +37,18 @@ def train(opt, hypes, use_gpu=True):
     #print("\n\n")
     # helper.print_network(model)
     
+    # frozen teacher when the model is trained by distillation
+    teacher = helper.create_teacher(hypes) if hypes.get('distill', {}).get('flag') else None
+
     if use_gpu:
         att_model.cuda()
         crack_net.cuda()
         model.cuda()
+        if teacher is not None:
+            teacher.cuda()
     # define the loss criterion
     criterion = helper.setup_loss(hypes)
+    loss_engine = loss.LossEngine(hypes, criterion)
 
     # optimizer setup
     optimizer = helper.setup_optimizer(hypes['train_params']['solver'], model)
@@ -69,21 +68,77 @@ def train(opt, hypes, use_gpu=True):
         # setup saved model folder
         init_epoch = 0
         saved_path = helper.setup_train(hypes)
+    # torch.compile the model if required, the origin model is still used for checkpoint saving
+    compiled_model = helper.compile_model(model, hypes)
     # record training
     writer = SummaryWriter(saved_path)
-    crack_net.eval()
+    # the crack net is frozen, it only runs without autograd
+    feature_pool.freeze(crack_net)
+
+    # optionally restore a pool of degraded samples once and train on it instead of running the
+    # crack net every step
+    pool_params = hypes.get('crack_pool', {})
+    pool = None
+
+    # per-step phase timings, the attention model is timed by hooks unless it runs inside a compiled graph
+    profile_params = hypes['train_params'].get('profile', {})
+    profiler = StepProfiler(enabled=profile_params.get('flag', False),
+                            sync_cuda=use_gpu,
+                            trace_dir=os.path.join(saved_path, 'trace'),
+                            trace_start=profile_params.get('trace_start', 0),
+                            trace_steps=profile_params.get('trace_steps', 0),
+                            window=profile_params.get('window', 1000),
+                            record_steps=profile_params.get('record_steps', False))
+    if compiled_model is model:
+        profiler.hook_module(att_model, 'attention')
 
     print('training start')
     epoches = hypes['train_params']['epoches']
-    step = 0
+    # set when the first loader is built, a resumed training continues the step count of its run
+    step = None
+    stage = None
+
     for epoch in range(init_epoch, max(epoches, init_epoch)):
         scheduler.step(epoch)
+        # the loaders are built for the crop/batch size of the progressive resolution stage, the
+        # stage only depends on the epoch so a resumed training continues in its stage
+        stage_index, crop_size, batch_size = helper.progressive_stage(hypes, epoch)
+        new_stage = stage_index != stage
+        if new_stage:
+            stage = stage_index
+            print('loading dataset, crop size %d, batch size %d' % (crop_size, batch_size))
+            loader_train, loader_val = helper.create_dataset(hypes,
+                                                             train=True,
+                                                             gan=False,
+                                                             real=opt.real_test,
+                                                             crack_dir=opt.crack_dir,
+                                                             epoch=epoch)
+        # reshuffle the shard order of the streamed datasets
+        if hasattr(loader_train.dataset, 'set_epoch'):
+            loader_train.dataset.set_epoch(epoch)
+        if new_stage:
+            loader_step = loader_train
+            if opt.crack_dir and pool_params.get('flag'):
+                pool = create_pool(pool_params, loader_train, crack_net, saved_path, crop_size, use_gpu)
+                loader_step = DataLoader(pool, batch_size=batch_size, shuffle=True)
+            # frames streamed from videos have no length
+            num_batches = len(loader_step) if hasattr(loader_step.dataset, '__len__') else '?'
+            if step is None:
+                num_samples = len(loader_step.dataset) if hasattr(loader_step.dataset, '__len__') else None
+                step = resume_step(saved_path, hypes, init_epoch, num_samples)
+        elif pool is not None:
+            start_time = time.time()
+            pool.refresh(loader_train, crack_net, pool_params['refresh'], use_gpu)
+            print('refreshed %.0f%% of the crack net pool in %.1fs' % (100 * pool_params['refresh'],
+                                                                      time.time() - start_time))
         for param_group in optimizer.param_groups:
             print('learning rate %f' % param_group["lr"])
+        writer.add_scalar('progressive/crop_size', crop_size, step)
+        writer.add_scalar('progressive/batch_size', batch_size, step)
 
-        for i, batch_data in enumerate(loader_train):
+        for i, batch_data in enumerate(profiler.iterate(loader_step, 'data')):
             # clean up grad first
-            model.train()
+            compiled_model.train()
             model.zero_grad()
             optimizer.zero_grad()
 
@@ -94,53 +149,134 @@ def train(opt, hypes, use_gpu=True):
             
             
             if use_gpu:
-                input_batch = input_batch.cuda()
-                input_l = input_l.cuda()
-                gt_ab = gt_ab.cuda()
-                gt_l = gt_l.cuda()
-                ref_gray = ref_gray.cuda()
-                ref_ab = ref_ab.cuda()
+                with profiler.phase('to_device'):
+                    input_batch = input_batch.cuda()
+                    input_l = input_l.cuda()
+                    gt_ab = gt_ab.cuda()
+                    gt_l = gt_l.cuda()
+                    ref_gray = ref_gray.cuda()
+                    ref_ab = ref_ab.cuda()
             # if the cracknet is also involved, then use it to restore
             # the image first
-            if opt.crack_dir:
-                input_l = crack_net(input_l)['output']
+            if opt.crack_dir and pool is None:
+                with profiler.phase('crack_net'), torch.no_grad():
+                    input_l = crack_net(input_l)['output']
 
             # model inference and loss cal
-            out_dict = model(input_l, input_batch, ref_ab, ref_gray, att_model)
-            final_loss = loss.loss_sum(hypes, criterion, out_dict, gt_ab)
+            if teacher is None:
+                with profiler.phase('forward'):
+                    out_dict = compiled_model(input_l, input_batch, ref_ab, ref_gray, att_model)
+                with profiler.phase('loss'):
+                    final_loss, loss_values = loss_engine(out_dict, gt_ab)
+            else:
+                with profiler.phase('teacher'), torch.no_grad():
+                    teacher_sim = teacher.correspond(input_batch, ref_ab, ref_gray, att_model)
+                    teacher_dict = teacher.decode(input_l, teacher_sim)
+                with profiler.phase('forward'):
+                    student_sim = model.correspond(input_batch, ref_ab, ref_gray, att_model)
+                    out_dict = model.decode(input_l, student_sim)
+                with profiler.phase('loss'):
+                    gt_loss, loss_values = loss_engine(out_dict, gt_ab)
+                    final_loss = hypes['distill']['gt_weight'] * gt_loss + \
+                        loss.distill_loss(hypes, out_dict, student_sim, teacher_dict, teacher_sim)
 
             # back-propagation
-            final_loss.backward()
-            optimizer.step()
+            with profiler.phase('backward'):
+                final_loss.backward()
+            with profiler.phase('optimizer'):
+                optimizer.step()
 
             # plot and print training info
-            if step % hypes['train_params']['display_freq'] == 0:
-                model.eval()
-                out_dict = model(input_l, input_batch, ref_ab, ref_gray, att_model)
-                out_train = torch.clamp(out_dict['output'], -1., 1.)
-
-                if use_gpu:
-                  out_train = lab_to_rgb(input_l, out_train).cuda()
-                  target_train = lab_to_rgb(gt_l, gt_ab).cuda()
-                else:
-                  out_train = lab_to_rgb(input_l, out_train)
-                  target_train = lab_to_rgb(gt_l, gt_ab)
-
-                psnr_train = loss.batch_psnr(out_train, target_train, 1.)
-                print("[epoch %d][%d/%d], total loss: %.4f, PSNR: %.4f" % (epoch + 1, i + 1, len(loader_train),
-                                                                           final_loss.item(), psnr_train))
-                writer.add_scalar('generator pretrain loss', final_loss.item(), step)
-                writer.add_scalar('PSNR during pretrain', psnr_train, step)
+            with profiler.phase('logging'):
+                if step % hypes['train_params']['display_freq'] == 0:
+                    compiled_model.eval()
+                    with torch.no_grad():
+                        out_dict = compiled_model(input_l, input_batch, ref_ab, ref_gray, att_model)
+                    out_train = torch.clamp(out_dict['output'], -1., 1.)
+
+                    if use_gpu:
+                      out_train = lab_to_rgb(input_l, out_train).cuda()
+                      target_train = lab_to_rgb(gt_l, gt_ab).cuda()
+                    else:
+                      out_train = lab_to_rgb(input_l, out_train)
+                      target_train = lab_to_rgb(gt_l, gt_ab)
+
+                    psnr_train = loss.batch_psnr(out_train, target_train, 1.)
+                    print("[epoch %d][%d/%s], total loss: %.4f, PSNR: %.4f" % (epoch + 1, i + 1, num_batches,
+                                                                               final_loss.item(), psnr_train))
+                    writer.add_scalar('generator pretrain loss', final_loss.item(), step)
+                    writer.add_scalar('PSNR during pretrain', psnr_train, step)
+                    for name, value in loss_values.items():
+                        writer.add_scalar('loss/%s' % name, value.item(), step)
+                if profiler.enabled and step % profile_params.get('log_freq', 50) == 0:
+                    profiler.write(writer, step, last=profile_params.get('log_freq', 50))
+            profiler.end_step()
             step += 1
 
         # log images
-        writer = helper.log_images(input_l, input_batch, ref_ab, ref_gray, writer, model, epoch, att_model, use_gpu)
+        writer = helper.log_images(input_l, input_batch, ref_ab, ref_gray, writer, compiled_model, epoch,
+                                   att_model, use_gpu)
 
         # evaluate model on validation dataset
         if epoch % hypes['train_params']['eval_freq'] == 0:
-            writer = helper.val_eval(model, att_model, loader_val, writer, opt, epoch, crack_net)
+            writer = helper.val_eval(compiled_model, att_model, loader_val, writer, opt, epoch, crack_net)
 
         if epoch % hypes['train_params']['writer_freq'] == 0:
             torch.save(model.state_dict(), os.path.join(saved_path, 'net_epoch%d.pth' % (epoch + 1)))
+            save_step(saved_path, epoch + 1, step)
+
+        profiler.save(os.path.join(saved_path, 'step_profile.json'))
+        profiler.print_summary()
 
+    profiler.close()
     return model, att_model, crack_net, writer
+
+
+def resume_step(saved_path, hypes, init_epoch, num_samples):
+    """
+    Global step at the start of init_epoch: the one saved with the checkpoint, else the batches of
+    the earlier epochs, each one with the batch size of its progressive stage
+    :param num_samples: training samples per epoch, None if unknown
+    """
+    path = os.path.join(saved_path, 'train_steps.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            steps = json.load(f)
+        if str(init_epoch) in steps:
+            return steps[str(init_epoch)]
+    if num_samples is None:
+        return 0
+    return sum(math.ceil(num_samples / float(helper.progressive_stage(hypes, epoch)[2]))
+               for epoch in range(init_epoch))
+
+
+def save_step(saved_path, epoch, step):
+    """
+    Record the global step at the start of epoch, next to its checkpoint
+    """
+    path = os.path.join(saved_path, 'train_steps.json')
+    steps = {}
+    if os.path.exists(path):
+        with open(path) as f:
+            steps = json.load(f)
+    steps[str(epoch)] = step
+    with open(path, 'w') as f:
+        json.dump(steps, f, indent=2)
+
+
+def create_pool(pool_params, loader_train, crack_net, saved_path, crop_size, use_gpu):
+    """
+    Load the crack net restored pool of this crop size and crack net weights, or fill it from the
+    training loader and save it
+    :return: RestoredPoolDataset
+    """
+    pool = RestoredPoolDataset(pool_params['size'])
+    cache_path = pool_params.get('cache') or os.path.join(saved_path, 'crack_pool_%d.pt' % crop_size)
+    crack_digest = result_cache.model_digest(crack_net)
+    if pool.load(cache_path, crack_digest, crop_size):
+        print('loaded %d crack net restored samples from %s' % (len(pool), cache_path))
+    else:
+        print('generating %d crack net restored samples' % pool.size)
+        pool.fill(loader_train, crack_net, use_gpu)
+        pool.save(cache_path, crack_digest)
+    return pool
@@ -0,0 +1,140 @@
+"""
+Streaming video colorization. Frames are decoded, colorized and written one by one, so memory stays
+flat for any video length. The reference is prepared once for the whole shot, and frames close to
+the last keyframe reuse its work:
+    - L change below propagate_threshold: the keyframe ab is propagated to the new L with a guided
+      filter, the model is not run at all
+    - L change below warp_threshold: the keyframe attention features and warped histograms are
+      reused, only the dense unet runs
+    - otherwise the frame becomes a new keyframe
+"""
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from utils import inference, runtime
+from utils.color_space_convert import lab_to_rgb
+from datasets.customized_transform import rgbtolab
+from models.customized_layers import guided_upsample
+
+
+class VideoColorizer(object):
+    """
+    Colorize the frames of one shot with a single reference
+    Args:
+        model: colorization model
+        att_model: frozen resnet34
+        ref_image: rgb uint8 reference, (H, W, 3)
+        warp_threshold: mean absolute L change(L in [-1, 1]) below which the keyframe warp is reused
+        propagate_threshold: mean absolute L change below which the keyframe ab is propagated
+        use_gpu: whether use gpu
+    """
+
+    def __init__(self, model, att_model, ref_image, warp_threshold=0.02, propagate_threshold=0.005,
+                 use_gpu=False):
+        if propagate_threshold > warp_threshold:
+            raise ValueError('propagate_threshold can not be larger than warp_threshold')
+        self.model = model
+        self.att_model = att_model
+        self.ref_image = ref_image
+        self.warp_threshold = warp_threshold
+        self.propagate_threshold = propagate_threshold
+        self.use_gpu = use_gpu
+
+        self.reference = None
+        self.keyframe = None
+        self.counts = {'keyframe': 0, 'warp_reuse': 0, 'propagate': 0}
+
+    def _to_device(self, x):
+        # also in the memory format of the weights, see runtime.prepare_models
+        return runtime.to_memory_format(self.model, x.cuda() if self.use_gpu else x)
+
+    def colorize_frame(self, frame):
+        """
+        :param frame: gray uint8 frame, (H, W)
+        :return: rgb uint8 frame, cropped to a multiple of 32 like the single image test
+        """
+        with torch.no_grad():
+            if self.reference is None:
+                # the reference only depends on the frame size, prepare it once for the whole shot
+                _, _, ref_ab, ref_gray = inference.prepare_image_pair(frame, self.ref_image)
+                self.reference = self.model.prepare_reference(self._to_device(ref_ab),
+                                                              self._to_device(ref_gray), self.att_model)
+
+            input_image, input_l = rgbtolab(frame)
+            input_image = self._to_device(torch.from_numpy(input_image).unsqueeze(0))
+            input_l = self._to_device(torch.from_numpy(input_l).unsqueeze(0))
+
+            change = float('inf') if self.keyframe is None else \
+                (input_l - self.keyframe['L']).abs().mean().item()
+
+            if change < self.propagate_threshold:
+                self.counts['propagate'] += 1
+                output = guided_upsample(self.keyframe['L'], self.keyframe['ab'], input_l)
+            elif change < self.warp_threshold:
+                self.counts['warp_reuse'] += 1
+                output = self.model.decode(input_l, self.keyframe['sim_feature'])['output']
+            else:
+                self.counts['keyframe'] += 1
+                sim_feature = self.model.warp_reference(input_image, self.reference, self.att_model)
+                output = self.model.decode(input_l, sim_feature)['output']
+                self.keyframe = {'L': input_l, 'sim_feature': sim_feature,
+                                 'ab': torch.clamp(output, -1., 1.)}
+            output = torch.clamp(output, -1., 1.)
+
+        rgb = lab_to_rgb(input_l, output).numpy().squeeze(0).transpose(1, 2, 0)
+        return np.uint8(np.clip(rgb, 0, 1) * 255)
+
+
+def colorize_video(model, att_model, video_path, ref_path, output_path, warp_threshold=0.02,
+                   propagate_threshold=0.005, use_gpu=False):
+    """
+    Decode, colorize and encode the video frame by frame
+    :return: dict of the number of keyframes/reused/propagated frames and the frames per second
+    """
+    ref_image = cv2.cvtColor(cv2.imread(ref_path), cv2.COLOR_BGR2RGB)
+    colorizer = VideoColorizer(model, att_model, ref_image, warp_threshold, propagate_threshold, use_gpu)
+
+    capture = cv2.VideoCapture(video_path)
+    if not capture.isOpened():
+        raise ValueError('can not open %s' % video_path)
+    fps = capture.get(cv2.CAP_PROP_FPS) or 25
+    writer = None
+
+    start_time = time.perf_counter()
+    frames = 0
+    try:
+        success, frame = capture.read()
+        while success:
+            output = colorizer.colorize_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY))
+            if writer is None:
+                writer = cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                                         (output.shape[1], output.shape[0]))
+            writer.write(cv2.cvtColor(output, cv2.COLOR_RGB2BGR))
+            frames += 1
+            success, frame = capture.read()
+    finally:
+        capture.release()
+        if writer is not None:
+            writer.release()
+
+    stats = dict(colorizer.counts)
+    stats['fps'] = frames / max(time.perf_counter() - start_time, 1e-6)
+    return stats
+
+
+def test_video(opt, hypes, use_gpu=False):
+    """
+    Colorize a video with the trained model
+    :param opt: arg parse
+    :param hypes: config yaml dictionary
+    :param use_gpu: whether use gpu
+    """
+    model, att_model, _ = inference.setup_models(opt, hypes, use_gpu)
+    stats = colorize_video(model, att_model, opt.video_path, opt.ref_path, opt.output_path,
+                           opt.warp_threshold, opt.propagate_threshold, use_gpu)
+    print('%d keyframes, %d frames reused the warp, %d frames propagated, %.2f fps' %
+          (stats['keyframe'], stats['warp_reuse'], stats['propagate'], stats['fps']))
+    return stats
@@ -0,0 +1,216 @@
+"""
+Memory mapped weight store for fast inference start up. Every entry (e.g. the colorization net, the
+fused attention model) is one flat binary file of aligned raw tensors, and manifest.json in the
+model folder maps the entry name to its file and tensor offsets, so no glob, no unpickling and no
+download is needed. Modules are created on the meta device and their tensors are assigned straight
+from the memory map, pages are only read from disk when they are first touched.
+
+Convert a trained model folder once(needs the imagenet resnet34 weights for the attention model):
+python -m utils.weight_store --model_dir logs/your_model_folder
+"""
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+MANIFEST = 'manifest.json'
+ALIGNMENT = 64
+
+# torch dtype name -> numpy dtype used for the raw bytes, bfloat16 is stored as its int16 bits
+DTYPES = {'float32': np.float32, 'float16': np.float16, 'bfloat16': np.int16, 'float64': np.float64,
+          'int64': np.int64, 'int32': np.int32, 'uint8': np.uint8, 'bool': np.bool_}
+
+
+def has_store(model_dir):
+    return os.path.exists(os.path.join(model_dir, MANIFEST))
+
+
+def read_manifest(model_dir):
+    path = os.path.join(model_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {'format': 1, 'entries': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_atomic(path, write):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def module_tensors(module):
+    """
+    All the parameters and buffers of a module, including the non persistent buffers that are not
+    in the state dict, since the meta device module can not recreate them
+    """
+    tensors = dict(module.named_parameters())
+    tensors.update(module.named_buffers())
+    return tensors
+
+
+def checkpoint_source(model_dir, checkpoint, next_checkpoint=None):
+    """
+    Record of the checkpoint an entry is converted from, see stale_reason
+    :param checkpoint: checkpoint file name in the model folder
+    :param next_checkpoint: file name of the next checkpoint training would write
+    """
+    return {'file': checkpoint, 'mtime_ns': os.stat(os.path.join(model_dir, checkpoint)).st_mtime_ns,
+            'next_file': next_checkpoint}
+
+
+def stale_reason(model_dir, manifest, name='net'):
+    """
+    Why an entry is older than the checkpoints of its folder. Only the converted checkpoint and the
+    next one training would write are looked up, the folder is not listed
+    :return: reason, None if the entry is current
+    """
+    source = manifest['entries'].get(name, {}).get('source')
+    if not source:
+        return 'no source checkpoint is recorded'
+    path = os.path.join(model_dir, source['file'])
+    if os.path.exists(path) and os.stat(path).st_mtime_ns != source['mtime_ns']:
+        return '%s was written again' % source['file']
+    if source.get('next_file') and os.path.exists(os.path.join(model_dir, source['next_file'])):
+        return '%s is newer' % source['next_file']
+    return None
+
+
+def save_module(model_dir, name, module, epoch=None, source=None):
+    """
+    Write the module tensors to <name>.bin and register the entry in the manifest
+    :param model_dir: model folder
+    :param name: entry name, e.g. net, att
+    :param module: nn.Module
+    :param epoch: training epoch of the weights, only recorded
+    :param source: checkpoint_source of the weights, None if they do not come from a checkpoint
+    """
+    tensors = {}
+    offset = 0
+    arrays = []
+    for key, original in module_tensors(module).items():
+        tensor = original.detach().cpu().contiguous()
+        dtype = str(tensor.dtype).replace('torch.', '')
+        if dtype not in DTYPES:
+            raise ValueError('dtype %s of %s is not supported by the weight store' % (dtype, key))
+        if dtype == 'bfloat16':
+            tensor = tensor.view(torch.int16)
+        array = tensor.numpy()
+
+        offset = (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        tensors[key] = {'dtype': dtype, 'shape': list(array.shape), 'offset': offset,
+                        'parameter': isinstance(original, nn.Parameter),
+                        'requires_grad': original.requires_grad}
+        arrays.append((offset, array))
+        offset += array.nbytes
+
+    def write(f):
+        for array_offset, array in arrays:
+            f.write(b'\0' * (array_offset - f.tell()))
+            f.write(array.tobytes())
+
+    file_name = '%s.bin' % name
+    _write_atomic(os.path.join(model_dir, file_name), write)
+
+    manifest = read_manifest(model_dir)
+    manifest['entries'][name] = {'file': file_name, 'epoch': epoch, 'source': source, 'tensors': tensors}
+    _write_atomic(os.path.join(model_dir, MANIFEST),
+                  lambda f: f.write(json.dumps(manifest, indent=1).encode()))
+
+
+def load_tensors(model_dir, name, prefix='', manifest=None):
+    """
+    Memory map the tensors of an entry, nothing is read from disk until a tensor is used
+    :param prefix: only return the tensors under this sub module name, e.g. 'features.'
+    :return: dict of tensor name without prefix -> (tensor, tensor info from the manifest)
+    """
+    manifest = read_manifest(model_dir) if manifest is None else manifest
+    if name not in manifest['entries']:
+        raise ValueError('%s not found in the weight store of %s' % (name, model_dir))
+    entry = manifest['entries'][name]
+
+    # copy on write mapping: writable tensors without touching the file
+    buffer = np.memmap(os.path.join(model_dir, entry['file']), dtype=np.uint8, mode='c')
+    tensors = {}
+    for key, info in entry['tensors'].items():
+        if not key.startswith(prefix):
+            continue
+        count = int(np.prod(info['shape']))
+        array = np.frombuffer(buffer, dtype=DTYPES[info['dtype']], count=count, offset=info['offset'])
+        tensor = torch.from_numpy(array).view(info['shape'])
+        if info['dtype'] == 'bfloat16':
+            tensor = tensor.view(torch.bfloat16)
+        tensors[key[len(prefix):]] = (tensor, info)
+    return tensors
+
+
+def load_module(model_dir, name, create_module, prefix='', manifest=None):
+    """
+    Create a module without initializing its weights and assign the memory mapped tensors to it
+    :param model_dir: model folder with manifest.json
+    :param name: entry name
+    :param create_module: function that builds the module, it is called on the meta device
+    :param prefix: load a sub module only, e.g. prefix='features.' and a create_module building
+                   the encoder
+    :return: module with cpu tensors, in evaluation mode
+    """
+    tensors = load_tensors(model_dir, name, prefix, manifest)
+    with torch.device('meta'):
+        module = create_module()
+
+    missing = []
+    for key in module_tensors(module):
+        if key not in tensors:
+            missing.append(key)
+            continue
+        owner_name, _, attr = key.rpartition('.')
+        owner = module.get_submodule(owner_name)
+        tensor, info = tensors[key]
+        if info['parameter']:
+            owner._parameters[attr] = nn.Parameter(tensor, requires_grad=info['requires_grad'])
+        else:
+            owner._buffers[attr] = tensor
+    if missing:
+        raise ValueError('%s of %s has no weights for %s' % (name, model_dir, ', '.join(missing)))
+
+    return module.eval()
+
+
+def main():
+    # convert the latest pth checkpoint of a model folder and the attention model into the store
+    from hypes_yaml import yaml_utils
+    from utils import helper
+
+    parser = argparse.ArgumentParser(description="convert a model folder to the weight store")
+    parser.add_argument('--model_dir', type=str, required=True, help='model path')
+    parser.add_argument('--crack', action='store_true', help='the folder holds a crack net')
+    opt = parser.parse_args()
+
+    hypes = yaml_utils.load_yaml(None, opt)
+    model = helper.create_model(hypes, crack=opt.crack)
+    epoch, model = helper.load_saved_model(opt.model_dir, model)
+    if epoch == 0:
+        raise ValueError('no checkpoint found in %s' % opt.model_dir)
+    # training writes a checkpoint every writer_freq epochs
+    source = checkpoint_source(
+        opt.model_dir, 'net_epoch%d.pth' % epoch,
+        'net_epoch%d.pth' % (epoch + hypes['train_params'].get('writer_freq', 1)))
+    save_module(opt.model_dir, 'net', model.eval(), epoch, source)
+    if not opt.crack:
+        save_module(opt.model_dir, 'att', helper.create_att_model())
+    print('weight store written to %s' % opt.model_dir)
+
+
+if __name__ == '__main__':
+    main()